@@ -21,6 +21,31 @@ from suitcase.exceptions import (
 
 DEBUG = False
 
+def get_working_dir(global_config, package_name):
+    """Returns where a package's files are laid out before packing"""
+    return os.path.expanduser("%s/temp/%s" % (
+        global_config["build_directory"], 
+        package_name
+    ))
+
+def get_staging_dir(global_config, package_name):
+    """Returns where a package's files are kept between incremental builds"""
+    return os.path.expanduser("%s/staging/%s" % (
+        global_config["build_directory"],
+        package_name
+    ))
+
+def get_manifest_filename(global_config, package_name):
+    """Returns where what's in a package's staging dir is recorded"""
+    return "%s.manifest" % get_staging_dir(global_config, package_name)
+
+def is_incremental(global_config, package_config):
+    """Checks whether a package's working dir is kept between builds"""
+    return package_config.get(
+        "incremental_staging",
+        global_config.get("incremental_staging", False)
+    )
+
 class BuilderBase:
     
     """Base builder class to subclass from"""
@@ -46,10 +71,13 @@ class BuilderBase:
     def make_working_dir(self):
         """Makes a working directory under global build dir"""
 
-        working_dir = os.path.expanduser("%s/temp/%s" % (
-            self.global_config["build_directory"], 
+        if is_incremental(self.global_config, self.package_config):
+            return self.make_staging_dir()
+
+        working_dir = get_working_dir(
+            self.global_config,
             self.package_config["package"]
-        ))
+        )
 
         if os.path.exists(working_dir):
             if not self.global_config['assume_yes']:
@@ -61,7 +89,7 @@ class BuilderBase:
                 if result == 'no':
                     sys.exit(1)
                     
-            run_command("rm -rf %s" % working_dir)
+            run_command(["rm", "-rf", working_dir])
 
         if DEBUG:
             print "MAKING: " + working_dir
@@ -72,3 +100,31 @@ class BuilderBase:
             raise SuitcasePackagingError(error)
             
         return working_dir
+
+    def make_staging_dir(self):
+        """Makes or reuses the working directory kept between builds
+
+        It's only reused if the last build finished and recorded what's in
+        it, otherwise it's emptied first.
+
+        """
+        working_dir = get_staging_dir(
+            self.global_config,
+            self.package_config["package"]
+        )
+        manifest_filename = get_manifest_filename(
+            self.global_config,
+            self.package_config["package"]
+        )
+
+        if os.path.exists(working_dir) and \
+            not os.path.exists(manifest_filename):
+            run_command(["rm", "-rf", working_dir])
+
+        if not os.path.exists(working_dir):
+            try:
+                os.makedirs(working_dir)
+            except OSError, error:
+                raise SuitcasePackagingError(error)
+
+        return working_dir
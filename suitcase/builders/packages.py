@@ -25,6 +25,12 @@ class Packages(BuilderBase):
         self.package_config['working_dir'] = self.make_working_dir()
 
         self.packer.run_hook('pre_copy')
+
+        # packages built before from the same inputs aren't built again
+        if self.packer.fetch_cached_package():
+            self.packer.move_package()
+            return
+
         self.packer.copy_files_to_package_dir()
         self.packer.run_hook('post_copy')
 
@@ -35,4 +41,5 @@ class Packages(BuilderBase):
         self.packer.run_hook('post_conf')
 
         self.packer.build_package()
+        self.packer.store_cached_package()
         self.packer.move_package()
@@ -6,32 +6,99 @@ the functionality in this class.
 """
 
 import os
+import sys
+import time
+import Queue
+import signal
+import traceback
 from copy import deepcopy
-
-try:
-    import yaml
-except ImportError:
-    print "pyyaml not installed, see http://pyyaml.org/wiki/PyYAML"
+from multiprocessing import Pool
+from StringIO import StringIO
 
 from suitcase.exceptions import (
+    SuitcaseException,
     SuitcaseImportError,
     SuitcasePackagingError,
-    SuitcaseConfigurationError
+    SuitcaseConfigurationError,
+    SuitcaseVcsError,
 )
 from suitcase.utils.common import (
     dynamic_import,
     get_dynamic_class_instance,
+    get_vcs_instance,
     display_warning,
+    get_user_input,
+    clean_fakeroot,
+)
+from suitcase.builders.base import get_working_dir, is_incremental
+from suitcase.utils.copy import copy_file_list, link_file
+from suitcase.utils.config import load_yaml, get_config_cache
+from suitcase.utils.walker import walk_package_dirs, compile_exclusions
+from suitcase.utils.runner import get_runner
+from suitcase.utils.scheduler import (
+    BuildScheduler,
+    read_timings,
+    save_timings,
 )
-from suitcase.utils.copy import copy_files
-from suitcase.utils.singleton import Singleton
 
 CONTROL_FILE_NAME = "debian.yml"
 DEBUG = False
 
-class PackageBase(Singleton):
+# How long a worker can take over one package, in seconds
+BUILD_TIMEOUT = 24 * 60 * 60
+
+def ignore_interrupts():
+    """Leaves ctrl-c to the parent process, which stops the workers"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def build_in_worker(job):
+    """Builds one package inside a worker process
+
+    Returns the package path, everything printed while building it, the
+    error if the build failed, how many seconds it took and the timings of
+    the commands it ran, for the parent's runner to add to its own.
+
+    """
+    (global_config, path, package_conf) = job
+    package_format = global_config['package_format']
+    packer = get_dynamic_class_instance(
+        'suitcase.packing.%s' % package_format,
+        package_format.capitalize(),
+        config = global_config
+    )
+
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    error = None
+    start = time.time()
+    # a worker's runner is kept from one package to the next
+    commands_run = len(get_runner().timings)
+    try:
+        packer.build(path, package_conf)
+    except SuitcaseException, exception:
+        error = str(exception)
+    except Exception:
+        # anything else would otherwise leave the parent waiting forever
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+
+    return (
+        path,
+        output.getvalue(),
+        error,
+        time.time() - start,
+        get_runner().timings[commands_run:]
+    )
+
+class PackageBase(object):
     
-    """Packaging base class"""
+    """Packaging base class
+
+    A packer only ever holds the config of the package it's building, so
+    each builder gets an instance of its own.
+
+    """
     
     def __init__(self, config = None, package_config = None):
         self.global_config = config
@@ -54,6 +121,14 @@ class PackageBase(Singleton):
         """make package conf files placeholder"""
         raise NotImplementedError
 
+    def fetch_cached_package(self):
+        """build cache placeholder, nothing is ever found"""
+        return False
+
+    def store_cached_package(self):
+        """build cache placeholder"""
+        pass
+
     def pre_build(self, package_config):
         """pre build placeholder"""
         raise NotImplementedError
@@ -73,19 +148,24 @@ class PackageBase(Singleton):
         If you don't got a VCS then you probably don't need a packaging system.
 
         """
-        vcs = self.global_config.get('version_control')
-        if vcs:
-            # dynamically import the vcs code
-            vcs_module = 'suitcase.vcs.%s' % vcs
-            vcs = get_dynamic_class_instance(vcs_module, vcs.capitalize())
-
-            path = package_config.get('path')
-            if path:
-                return vcs.get_directory_revision(path)
-            else:
-                SuitcasePackagingError("Package path is not defined")
+        path = package_config.get('path')
+        if path:
+            return self.get_package_versions([path])[path]
         else:
-            raise SuitcasePackagingError("No version control system defined")
+            raise SuitcasePackagingError("Package path is not defined")
+
+    def get_package_versions(self, paths):
+        """Gets the version numbers for many package paths in one go
+
+        Returns a dictionary keyed by path and raises if any path has no
+        version.
+
+        """
+        versions = get_vcs_instance(self.global_config).get_revisions(paths)
+        for path in paths:
+            if versions.get(path) is None:
+                raise SuitcaseVcsError("Can't find version for %s" % path)
+        return versions
 
 
     def get_package_name(self, config):
@@ -133,10 +213,13 @@ class PackageBase(Singleton):
                     collection_path
                 )
 
-                if collection and \
-                    self.global_config["collections"].get(collection):
-                    collection = self.global_config["collections"]\
-                        [collection]
+        return self.get_collection_conf(collection)
+
+    def get_collection_conf(self, collection):
+        """Returns the config of a collection from its name"""
+        if collection and self.global_config.get("collections") and \
+            self.global_config["collections"].get(collection):
+            collection = self.global_config["collections"][collection]
 
         if collection is None:
             collection = {}
@@ -164,28 +247,39 @@ class PackageBase(Singleton):
             print "GLOBAL_CONFIG:" ,
             pprint.pprint(self.global_config)
 
-        build_dict = {}
-        for root, dirs, files in os.walk(start_path):
-
-            exclusions = self.global_config.get('path_exclusions', []) \
-                + self.global_config.get("default_path_exclusions", [])
-
-            # Remove exclusions from the walking path
-            for exclusion in exclusions:
-                if exclusion in dirs:
-                    dirs.remove(exclusion)
+        # Find every package first so that they can all be versioned with a
+        # single bulk lookup against the VCS
+        package_dirs = None
+        changed_since = self.global_config.get('changed_since')
+        if changed_since:
+            package_dirs = self.find_changed_dirs(start_path, changed_since)
+        if package_dirs is None:
+            package_dirs = self.walk_package_dirs(
+                start_path,
+                package_conf_name
+            )
+        else:
+            package_dirs = [(
+                root,
+                os.path.isfile(os.path.join(root, package_conf_name)),
+                self.find_collection_conf(root)
+            ) for root in package_dirs]
 
-            # update this key with the collection data
-            collection = self.find_collection_conf(root)
+        config_cache = get_config_cache(self.global_config)
+        found_packages = []
+        for root, has_conf, collection in package_dirs:
 
             # if foo.yml exists or there's a collection above us...
-            if package_conf_name in files or collection:
+            file_path = os.path.join(root, package_conf_name)
+            if has_conf or collection:
                 package_config = {}
 
                 # get the package_conf file and load the conf
-                file_path = os.path.join(root, package_conf_name)
-                if os.path.exists(file_path):
-                    package_config = yaml.load(open(file_path).read())
+                if has_conf:
+                    if config_cache is None:
+                        package_config = load_yaml(file_path)
+                    else:
+                        package_config = config_cache.load(file_path)
                     if package_config is None:
                         raise SuitcaseConfigurationError(
                             "Config file %s is invalid" % file_path
@@ -194,86 +288,194 @@ class PackageBase(Singleton):
                 # get package name
                 package_config['path'] = root
 
-                package_name = self.get_package_name(package_config)
-                if DEBUG:
-                    print "PACKAGE_NAME: %s" % package_name
+                found_packages.append(
+                    (root, file_path, collection, package_config)
+                )
 
-                # Check for package dupes
-                if build_dict.get(package_name):
-                    raise SuitcasePackagingError(
-                        "A duplicate package name exists."\
-                        " Please check %s" % file_path
+        if config_cache is not None:
+            config_cache.save()
+
+        versions = self.get_package_versions(
+            [root for root, _, _, _ in found_packages]
+        )
+
+        build_dict = {}
+        for root, file_path, collection, package_config in found_packages:
+
+            package_name = self.get_package_name(package_config)
+            if DEBUG:
+                print "PACKAGE_NAME: %s" % package_name
+
+            # Check for package dupes
+            if build_dict.get(package_name):
+                raise SuitcasePackagingError(
+                    "A duplicate package name exists."\
+                    " Please check %s" % file_path
+                )
+
+            else:
+
+                build_dict[root] = {}
+
+                if collection:
+                    build_dict[root]=deepcopy(collection)
+
+                package_config["architecture"] = package_config.get(
+                    "architecture", 
+                    build_dict[root].get(
+                        'architecture',
+                        "all"
                     )
-            
-                else:
+                )
+
+                package_config['version'] = versions[root]
 
-                    build_dict[root] = {}
+                package_config['package'] = package_name
 
-                    if collection:
-                        build_dict[root]=deepcopy(collection)
+                package_config['package_filename'] = \
+                    self.make_package_filename(package_config)
 
-                    package_config["architecture"] = package_config.get(
-                        "architecture", 
-                        build_dict[root].get(
-                            'architecture',
-                            "all"
+                package_preexists = \
+                    self.check_package_file(package_config)[0]
+
+                if not self.global_config['force_build'] and \
+                    package_preexists:
+                    if not self.global_config['quiet']:
+                        display_warning(
+                            "Suitcase Warning: Package %s already "\
+                            "exists; skipping build..." \
+                            % package_config['package_filename']
                         )
-                    )
-                    
-                    package_config['version'] = self.get_package_version(
-                        package_config
-                    )
-                    
-                    package_config['package'] = package_name
-
-                    package_config['package_filename'] = \
-                        self.make_package_filename(package_config)
-
-                    package_preexists = \
-                        self.check_package_file(package_config)[0]
-
-                    if not self.global_config['force_build'] and \
-                        package_preexists:
-                        if not self.global_config['quiet']:
-                            display_warning(
-                                "Suitcase Warning: Package %s already "\
-                                "exists; skipping build..." \
-                                % package_config['package_filename']
-                            )
-                        del build_dict[root]
-                        # update this key with the rest of the data from 
-                        # package_config
-                    elif package_config['version'] < ("0.%s" % \
-                        self.global_config['limit_from']):
-                        if not self.global_config['quiet']:
-                            display_warning("Suitcase Warning: Package "\
-                                "version %s below limit; skipping build..." \
-                                % package_config['version']
-                            )
-                        del build_dict[root]
-                    else:
-                        build_dict[root].update(deepcopy(package_config))
+                    del build_dict[root]
+                    # update this key with the rest of the data from 
+                    # package_config
+                elif self.is_below_limit(
+                    package_config['version'],
+                    self.global_config.get('limit_from')
+                ):
+                    if not self.global_config['quiet']:
+                        display_warning("Suitcase Warning: Package "\
+                            "version %s below limit; skipping build..." \
+                            % package_config['version']
+                        )
+                    del build_dict[root]
+                else:
+                    build_dict[root].update(deepcopy(package_config))
 
 
         if build_dict != {}:
             return build_dict
+        elif changed_since:
+            raise SuitcasePackagingError(
+                "No packages below %s have changed since %s" % (
+                    start_path,
+                    changed_since
+                )
+            )
         else:
             raise SuitcasePackagingError(
                 "No packages to build from walking %s" % start_path
             )
 
+    def get_path_exclusions(self):
+        """Returns the dir names that are never walked into"""
+        return self.global_config.get('path_exclusions', []) \
+            + self.global_config.get("default_path_exclusions", [])
+
+    def walk_dirs(self, start_path):
+        """Yields every dir below start_path that isn't excluded"""
+        for root, _, _ in walk_package_dirs(
+            start_path,
+            None,
+            self.get_path_exclusions()
+        ):
+            yield root
+
+    def walk_package_dirs(self, start_path, package_conf_name):
+        """Walks start_path for dirs that could hold a package
+
+        Returns every dir that isn't excluded along with whether the
+        package conf is in it and the config of its collection. The walk
+        is split between discovery_threads threads.
+
+        """
+        collection_mapping = None
+        if self.global_config.get("collections"):
+            collection_mapping = self.global_config.get('collection_mapping')
+
+        return [(root, has_conf, self.get_collection_conf(collection))
+            for root, has_conf, collection in walk_package_dirs(
+                start_path,
+                package_conf_name,
+                self.get_path_exclusions(),
+                self.global_config.get("base_path"),
+                collection_mapping,
+                int(self.global_config.get("discovery_threads") or 1)
+            )]
+
+    def find_changed_dirs(self, start_path, since):
+        """Returns the dirs below start_path with changes after since
+
+        These are the only dirs whose packages can have a new version, so
+        they're all that needs looking at rather than the whole tree. The
+        changes come from a single VCS query. Returns None if the global
+        config has changed, as that affects every package.
+
+        """
+        base_path = os.path.abspath(start_path)
+        config_file = self.global_config.get('config_file')
+        is_excluded = compile_exclusions(self.get_path_exclusions())
+
+        changed_dirs = {}
+        for path in get_vcs_instance(self.global_config)\
+            .get_changed_paths(base_path, since):
+
+            if config_file and path == os.path.abspath(config_file):
+                return None
+            if path != base_path and \
+                not path.startswith(base_path + os.sep):
+                continue
+
+            # every dir from start_path down to the change, as os.walk
+            # would name it, stopping at any excluded dir
+            parts = [part for part in path[len(base_path):].split(os.sep)
+                if part]
+            for depth in range(len(parts) + 1):
+                if depth and is_excluded(parts[depth - 1]):
+                    break
+                changed_dir = os.path.join(start_path, *parts[:depth])
+                if os.path.isdir(changed_dir):
+                    changed_dirs[changed_dir] = True
+
+        return sorted(changed_dirs.keys())
+
+    @staticmethod
+    def is_below_limit(version, limit_from):
+        """Checks whether a "0.<rev>" version is older than limit_from
+
+        Revisions are compared as numbers. Revisions that aren't numbers,
+        like git commit ids, have no order so are never below the limit.
+
+        """
+        revision = str(version).split(".", 1)[-1]
+        limit_from = str(limit_from or 0)
+        if not revision.isdigit() or not limit_from.isdigit():
+            return False
+        return int(revision) < int(limit_from)
+
 
     def pack(self, filepath):
 
         """Wraps the entire packaging process
 
-        Gets all of the config from the path and then loops round the
-        config building the packages
+        Gets all of the config from the path and then builds the packages
+        in dependency order, several at once if jobs is set
 
         """
 
         # Calls the base classes find_build_dirs if none is
         build_dict = self.find_build_dirs(filepath)
+        self.run_discovery_hooks(build_dict)
 
         # pretty print out the config
         if DEBUG:
@@ -281,25 +483,192 @@ class PackageBase(Singleton):
             print "BUILD DICT:",
             pprint.pprint(build_dict)
 
-        for path,package_conf in build_dict.items():
+        scheduler = BuildScheduler(
+            build_dict,
+            read_timings(self.global_config)
+        )
+        timings = {}
+        try:
+            if int(self.global_config.get("jobs") or 1) > 1 and \
+                len(build_dict) > 1:
+                self.build_in_parallel(build_dict, scheduler, timings)
+            else:
+                self.build_in_order(build_dict, scheduler, timings)
+        finally:
+            if timings:
+                save_timings(self.global_config, timings)
 
-            if not self.global_config["quiet"]:
-                print "---------------"
-                print "Building %s" % path
+    def run_discovery_hooks(self, build_dict):
+        """Runs the post_discovery hook for every package found
 
-            # actually call the builder's build method
-            builder_class_name = package_conf.get('builder', 'packages')
-            builder = 'suitcase.builders.%s' % builder_class_name
+        This is the place for hooks that work out depends, so that the
+        order packages are built in can take them into account. pre_conf
+        hooks marked with a discovery attribute run here rather than when
+        the package is built, so the depends they add are known too. When
+        packages are built at once, other pre_conf hooks are warned about
+        as depends they add come too late to order builds by.
 
-            builder_instance = get_dynamic_class_instance(
-                builder,
-                builder_class_name.capitalize(),
-                self.global_config
+        """
+        parallel = int(self.global_config.get("jobs") or 1) > 1 and \
+            len(build_dict) > 1
+        unordered = {}
+        for path in build_dict.keys():
+            self.package_config = build_dict[path]
+            self.run_hook('post_discovery')
+            for method in self.get_hook('pre_conf'):
+                if getattr(self.find_hook('pre_conf', method), 'discovery',
+                    False):
+                    self.call_hook('pre_conf', method)
+                elif parallel:
+                    unordered[method] = unordered.get(method, 0) + 1
+            build_dict[path] = self.package_config
+        self.package_config = {}
+
+        for method, count in sorted(unordered.items()):
+            display_warning(
+                "Suitcase Warning: %s package(s) run the pre_conf hook %s, "\
+                "packages it makes them depend on may not be built first "\
+                "with jobs set. Run it as a post_discovery hook or mark it "\
+                "with a discovery attribute." % (count, method)
             )
 
+    def build(self, path, package_conf):
+        """Hands a single package over to its builder"""
+
+        if not self.global_config["quiet"]:
+            print "---------------"
+            print "Building %s" % path
+
+        # actually call the builder's build method
+        builder_class_name = package_conf.get('builder', 'packages')
+        builder = 'suitcase.builders.%s' % builder_class_name
+
+        builder_instance = get_dynamic_class_instance(
+            builder,
+            builder_class_name.capitalize(),
+            self.global_config
+        )
+
+        try:
             builder_instance.pre_build(package_conf)
             builder_instance.build(package_conf)
+        finally:
+            # the next package starts with a fakeroot session of its own
+            clean_fakeroot()
+
+    def build_in_order(self, build_dict, scheduler, timings):
+        """Builds packages one after the other as the scheduler orders them"""
+        while True:
+            path = scheduler.next_ready()
+            if path is None:
+                break
+            start = time.time()
+            self.build(path, build_dict[path])
+            timings[build_dict[path].get("package")] = time.time() - start
             self.package_config = {}
+            scheduler.finished(path)
+
+    def build_in_parallel(self, build_dict, scheduler, timings):
+        """Builds packages in a pool of jobs worker processes
+
+        Packages are started as soon as everything they depend on is built
+        and there's a free worker. Each worker has its own packer, builder
+        and fakeroot cache so builds don't share any state. Anything a build
+        prints is held back and shown in one piece once that package is
+        done. Working dirs that are in the way are confirmed once up front
+        as workers can't prompt.
+
+        """
+        global_config = dict(self.global_config)
+        global_config["assume_yes"] = self.confirm_working_dirs(build_dict)
+        jobs = int(global_config["jobs"])
+
+        pool = Pool(jobs, ignore_interrupts)
+        results = Queue.Queue()
+        running = 0
+        errors = []
+        try:
+            while True:
+                while running < jobs:
+                    path = scheduler.next_ready()
+                    if path is None:
+                        break
+                    pool.apply_async(
+                        build_in_worker,
+                        [(global_config, path, build_dict[path])],
+                        callback=results.put
+                    )
+                    running += 1
+
+                if not running:
+                    break
+
+                try:
+                    (path, output, error, seconds, command_timings) = \
+                        results.get(True, BUILD_TIMEOUT)
+                except Queue.Empty:
+                    raise SuitcasePackagingError(
+                        "Timed out waiting for packages to build"
+                    )
+                running -= 1
+                get_runner().add_timings(command_timings)
+
+                sys.stdout.write(output)
+                timings[build_dict[path].get("package")] = seconds
+                if error is not None:
+                    print error
+                    errors.append(path)
+
+                for dropped_path in scheduler.finished(path, error is None):
+                    display_warning(
+                        "Suitcase Warning: Not building %s as %s failed" % (
+                            dropped_path,
+                            path
+                        )
+                    )
+                    errors.append(dropped_path)
+            pool.close()
+        except:
+            # stop the workers on ctrl-c or anything else going wrong
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if errors:
+            raise SuitcasePackagingError(
+                "%s package(s) failed to build:\n%s" % (
+                    len(errors),
+                    "\n".join(sorted(errors))
+                )
+            )
+
+    def confirm_working_dirs(self, build_dict):
+        """Asks once about every existing working dir that will be deleted
+
+        Returns whether builds can go ahead and delete them without asking.
+
+        """
+        if self.global_config["assume_yes"]:
+            return True
+
+        working_dirs = [
+            get_working_dir(self.global_config, package_conf["package"])
+            for package_conf in build_dict.values()
+            if package_conf.get("package") and
+                not is_incremental(self.global_config, package_conf)
+        ]
+        working_dirs = [working_dir for working_dir in sorted(working_dirs)
+            if os.path.exists(working_dir)]
+        if working_dirs:
+            result = get_user_input(
+                'Suitcase Warning: %s will be deleted. Are you sure?' \
+                    % ", ".join(working_dirs), ['yes','no'], 'yes',
+            )
+            if result == 'no':
+                sys.exit(1)
+
+        return True
 
     def get_hook(self, method_label):
         """fetches <label> key from configs
@@ -332,24 +701,44 @@ class PackageBase(Singleton):
         
         return conf_methods
 
-    def run_hook(self, method_label):
-        """dynamically call pre/post conf methods as defined in package_conf"""
+    @staticmethod
+    def find_hook(method_label, method):
+        """Imports a hook given its fully namespaced name"""
+        conf_module = dynamic_import(".".join(method.split(".")[:-1]))
+        try:
+            return getattr(conf_module, method.split(".")[-1])
+        except AttributeError, error:
+            raise SuitcaseImportError(
+                "%s hook %s not found:\n%s" % (method_label, method, error)
+            )
 
-        for method in self.get_hook(method_label):
+    def call_hook(self, method_label, method):
+        """Runs one hook on the package config"""
+        hook = self.find_hook(method_label, method)
+        try:
+            return_val = hook(self.global_config,self.package_config)
             
-            conf_module = dynamic_import(".".join(method.split(".")[:-1]))
-            try:
-                return_val = getattr(
-                    conf_module,method.split(".")[-1]
-                )(self.global_config,self.package_config)
+            if return_val:
+                self.package_config = return_val
                 
-                if return_val:
-                    self.package_config = return_val
-                    
-            except AttributeError, error:
-                raise SuitcaseImportError(
-                    "%s hook %s not found:\n%s" % (method_label, method, error)
-                )
+        except AttributeError, error:
+            raise SuitcaseImportError(
+                "%s hook %s not found:\n%s" % (method_label, method, error)
+            )
+
+    def run_hook(self, method_label):
+        """dynamically call pre/post conf methods as defined in package_conf
+
+        pre_conf hooks marked with a discovery attribute are left out, they
+        ran when the package was found, see run_discovery_hooks.
+
+        """
+
+        for method in self.get_hook(method_label):
+            if method_label == 'pre_conf' and getattr(
+                self.find_hook(method_label, method), 'discovery', False):
+                continue
+            self.call_hook(method_label, method)
                 
         return self.package_config
 
@@ -393,4 +782,11 @@ class PackageBase(Singleton):
                     % self.package_config['package_filename']
                 )
             else:
-                copy_files(source, destination)
+                # linked where it can be, the build cache may hold it too
+                copy_file_list(
+                    [(source, os.path.join(
+                        destination,
+                        self.package_config['package_filename']
+                    ))],
+                    copy=link_file
+                )
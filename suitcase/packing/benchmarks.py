@@ -0,0 +1,98 @@
+"""Times the python deb writer against fakeroot and dpkg -b
+
+Lays out a throwaway package dir with a lot of files, then builds it both
+ways and checks dpkg-deb sees the same contents in each. Run it directly:
+
+    python suitcase/packing/benchmarks.py --dirs 50 --files 40
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import commands
+from optparse import OptionParser
+from tempfile import mkdtemp
+
+from suitcase.packing.debfile import DebFile
+
+CONTROL = """Package: suitcase-benchmark
+Version: 0.1
+Architecture: all
+Maintainer: Suitcase <suitcase@example.com>
+Description: suitcase benchmark package
+"""
+
+def run_command(command):
+    """Runs a command, exiting if it fails"""
+    result = commands.getstatusoutput(command)
+    if result[0] > 0:
+        sys.exit("%s failed: %s" % (command, result[1]))
+    return result[1]
+
+def create_package_dir(directory, dir_count, file_count):
+    """Lays out dir_count dirs of file_count files under usr/share"""
+    os.makedirs(os.path.join(directory, "DEBIAN"))
+    open(os.path.join(directory, "DEBIAN", "control"), "w").write(CONTROL)
+    for dir_index in range(dir_count):
+        package_dir = os.path.join(
+            directory,
+            "usr/share/suitcase-benchmark/dir%04d" % dir_index
+        )
+        os.makedirs(package_dir)
+        for file_index in range(file_count):
+            open(os.path.join(package_dir, "file%04d.py" % file_index), "w")\
+                .write("# %s %s\n" % (dir_index, file_index) * 50)
+
+def build_with_dpkg(source_dir, filename):
+    """The old way, three passes under fakeroot"""
+    cache_filename = filename + ".fakeroot"
+    open(cache_filename, "w").close()
+    fakeroot = "fakeroot -i %s -s %s" % (cache_filename, cache_filename)
+    run_command("%s chown -R root.root %s" % (fakeroot, source_dir))
+    run_command("%s chmod -R a-s %s" % (fakeroot, source_dir))
+    run_command("%s dpkg -b %s %s" % (fakeroot, source_dir, filename))
+    os.remove(cache_filename)
+
+def build_with_python(source_dir, filename):
+    """Writes the package in-process"""
+    DebFile(source_dir).write(filename)
+
+def main():
+    """Builds the package both ways and compares them"""
+    parser = OptionParser()
+    parser.add_option("--dirs", type="int", default=50,
+        help="number of dirs to put in the package")
+    parser.add_option("--files", type="int", default=40,
+        help="number of files in each dir")
+    (options, args) = parser.parse_args()
+
+    directory = mkdtemp()
+    try:
+        source_dir = os.path.join(directory, "package")
+        create_package_dir(source_dir, options.dirs, options.files)
+
+        listings = []
+        for name, build in [
+            ("fakeroot and dpkg -b", build_with_dpkg),
+            ("python deb writer", build_with_python),
+        ]:
+            filename = os.path.join(directory, "%s.deb" % build.__name__)
+            start = time.time()
+            build(source_dir, filename)
+            print "%-28s %8.3fs" % (name, time.time() - start)
+            listings.append((
+                run_command("dpkg-deb -c %s" % filename),
+                run_command("dpkg-deb -I %s control" % filename),
+            ))
+
+        if listings[0] == listings[1]:
+            print "contents ok"
+        else:
+            print "contents DIFFERENT"
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Cache of built packages keyed by a hash of everything that went into them
+
+A package whose files, control data, hooks and config hash the same as one
+built before is the same package, so the one built before is linked into
+place rather than building it again. The cache directory can be shared by
+several builds on one machine: entries are renamed into place, changes to
+the directory are made under a lock and the least recently used entries
+are thrown away once it grows past its size.
+
+"""
+
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import cPickle as pickle
+from tempfile import mkstemp
+
+from suitcase.exceptions import SuitcasePackagingError
+
+# bump when what goes into a key changes
+KEY_VERSION = "2"
+
+def get_build_cache_directory(global_config):
+    """Returns where built packages are cached, None if they aren't"""
+    directory = global_config.get("build_cache")
+    if not directory:
+        return None
+    return os.path.expanduser(directory)
+
+def get_digests_filename(global_config, package_name):
+    """Returns where the content hashes of a package's files are kept"""
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "digests",
+        package_name
+    )
+
+def read_pickle(filename):
+    """Loads a pickled dict, anything unreadable counts as empty"""
+    try:
+        pickle_file = open(filename, "rb")
+        try:
+            data = pickle.load(pickle_file)
+        finally:
+            pickle_file.close()
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+        AttributeError, ImportError, IndexError):
+        return {}
+
+    if not isinstance(data, dict):
+        return {}
+    return data
+
+def write_pickle(filename, data):
+    """Writes a pickle out atomically, it's only a cache so errors pass"""
+    directory = os.path.dirname(filename)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (handle, temp_filename) = mkstemp(dir=directory)
+        temp_file = os.fdopen(handle, "wb")
+        try:
+            pickle.dump(data, temp_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            temp_file.close()
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        pass
+
+def get_module_digest(module):
+    """Returns the sha1 of a module's source, so editing a hook changes keys"""
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        return None
+    if filename.endswith((".pyc", ".pyo")):
+        filename = filename[:-1]
+    try:
+        return hashlib.sha1(open(filename, "rb").read()).hexdigest()
+    except IOError:
+        return None
+
+class FileDigests(object):
+
+    """Content hashes of files, remembered by size, mtime and inode
+
+    Hashing is the slow part of working out a key, and most files don't
+    change between builds.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.known = read_pickle(filename)
+        self.seen = {}
+
+    def get(self, path, info):
+        """Returns the sha1 of a file, info is its stat"""
+        signature = (info.st_size, int(info.st_mtime), info.st_ino)
+        known = self.known.get(path)
+        if known and known[0] == signature:
+            digest = known[1]
+        else:
+            digest = hashlib.sha1()
+            data_file = open(path, "rb")
+            try:
+                while True:
+                    data = data_file.read(1024 * 1024)
+                    if not data:
+                        break
+                    digest.update(data)
+            finally:
+                data_file.close()
+            digest = digest.hexdigest()
+        self.seen[path] = (signature, digest)
+        return digest
+
+    def save(self):
+        """Keeps the hashes of the files looked at this time"""
+        write_pickle(self.filename, self.seen)
+
+class BuildCache(object):
+
+    """On-disk store of built packages keyed by a hash of their inputs"""
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+
+    def get_filename(self, key):
+        """Works out where the package for a key is kept"""
+        return os.path.join(self.directory, key[:2], "%s.deb" % key)
+
+    def lock(self):
+        """Takes the lock on the cache directory, returns it to unlock"""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, error:
+                if not os.path.isdir(self.directory):
+                    raise SuitcasePackagingError(error)
+        lock_file = open(os.path.join(self.directory, "lock"), "a")
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    @staticmethod
+    def unlock(lock_file):
+        """Lets the next build at the cache directory"""
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+    @staticmethod
+    def place(source, destination):
+        """Links source to destination, copying if it can't be linked
+
+        Whatever is at destination is replaced, never written over, and
+        destination only appears once it's complete.
+
+        """
+        directory = os.path.dirname(destination)
+        (handle, temp_filename) = mkstemp(dir=directory)
+        os.close(handle)
+        try:
+            os.remove(temp_filename)
+            try:
+                os.link(source, temp_filename)
+            except OSError:
+                shutil.copyfile(source, temp_filename)
+                os.chmod(temp_filename, 0644)
+            os.rename(temp_filename, destination)
+        except (IOError, OSError), error:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise SuitcasePackagingError(
+                "Can't put %s at %s: %s" % (source, destination, error)
+            )
+
+    def fetch(self, key, destination):
+        """Puts the package cached for key at destination
+
+        Returns False if there isn't one. The entry is marked as used so
+        it's the last to be thrown away.
+
+        """
+        filename = self.get_filename(key)
+        if not os.path.exists(filename):
+            return False
+
+        try:
+            self.place(filename, destination)
+        except SuitcasePackagingError:
+            # thrown away by another build just now
+            if os.path.exists(filename):
+                raise
+            return False
+
+        try:
+            # the access time is when it was last used, mtime is left be
+            # as the package in the repo may be the same file
+            os.utime(filename, (time.time(), os.stat(filename).st_mtime))
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, filename):
+        """Adds a built package to the cache, then trims the cache"""
+        lock_file = self.lock()
+        try:
+            destination = self.get_filename(key)
+            if not os.path.isdir(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            self.place(filename, destination)
+            self.evict()
+        finally:
+            self.unlock(lock_file)
+
+    def evict(self):
+        """Throws away the least recently used packages over max_size
+
+        Needs the lock.
+
+        """
+        if not self.max_size:
+            return
+
+        entries = []
+        total = 0
+        for path, dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".deb"):
+                    continue
+                filename = os.path.join(path, name)
+                try:
+                    info = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((info.st_atime, info.st_size, filename))
+                total += info.st_size
+
+        for (used, size, filename) in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,443 @@
+"""Writes .deb files directly, without fakeroot passes or dpkg -b
+
+A .deb is an ar archive holding a debian-binary version file, a tar of the
+DEBIAN control dir and a tar of everything else. A field of the control
+file can be changed in a package that's already built, see
+set_control_field. Both tars are written
+here with everything owned by root and the setuid and setgid bits taken
+off, just as chown -R root.root and chmod -R a-s under fakeroot would
+leave them.
+
+Hooks that change permissions still run under fakeroot. The fakeroot state
+file is seeded with what those two commands would have recorded before the
+hooks run, and whatever it holds afterwards goes into the tar headers.
+
+"""
+
+import os
+import re
+import grp
+import pwd
+import stat
+import time
+import shutil
+import tarfile
+from StringIO import StringIO
+from tempfile import mkdtemp, mkstemp
+
+from suitcase.exceptions import SuitcasePackagingError, SuitcaseCommandError
+from suitcase.utils.common import run_command
+from suitcase.utils.copy import get_umask, SET_ID_BITS
+
+AR_MAGIC = "!<arch>\n"
+DEB_FORMAT_VERSION = "2.0\n"
+CONTROL_DIR = "DEBIAN"
+AR_HEADER_SIZE = 60
+
+# Format of a line in the state files fakeroot saves and loads
+FAKEROOT_STATE_LINE = "dev=%x,ino=%d,mode=%o,uid=%d,gid=%d,nlink=%d,rdev=%d\n"
+
+def walk_tree(directory, exclude=None):
+    """Yields every path below directory depth first, sorted by name
+
+    This is the order dpkg -b puts files in. exclude is a name at the top
+    of directory that's left out.
+
+    """
+    for name in sorted(os.listdir(directory)):
+        if name == exclude:
+            continue
+        path = os.path.join(directory, name)
+        yield path
+        if os.path.isdir(path) and not os.path.islink(path):
+            for child_path in walk_tree(path):
+                yield child_path
+
+def write_fakeroot_state(filename, directory):
+    """Seeds a fakeroot state file with directory owned by root
+
+    Modes have the setuid and setgid bits taken off, so hooks run under
+    fakeroot afterwards see what chown -R root.root and chmod -R a-s would
+    have left.
+
+    """
+    state_file = open(filename, "w")
+    try:
+        for path in [directory] + list(walk_tree(directory)):
+            info = os.lstat(path)
+            mode = info.st_mode
+            if not stat.S_ISLNK(mode):
+                mode = mode & ~SET_ID_BITS
+            state_file.write(FAKEROOT_STATE_LINE % (
+                info.st_dev,
+                info.st_ino,
+                mode,
+                0,
+                0,
+                info.st_nlink,
+                info.st_rdev,
+            ))
+    finally:
+        state_file.close()
+
+def read_fakeroot_state(filename):
+    """Returns the modes and owners fakeroot recorded, keyed by dev and inode"""
+    permissions = {}
+    if not os.path.exists(filename):
+        return permissions
+
+    for line in open(filename):
+        try:
+            fields = dict([field.split("=", 1)
+                for field in line.strip().split(",")])
+            permissions[(int(fields["dev"], 16), int(fields["ino"]))] = (
+                int(fields["mode"], 8),
+                int(fields["uid"]),
+                int(fields["gid"]),
+            )
+        except (KeyError, ValueError):
+            continue
+    return permissions
+
+def get_user_name(uid):
+    """Looks up the name tar records for uid, as GNU tar does"""
+    try:
+        return pwd.getpwuid(uid)[0]
+    except KeyError:
+        return ""
+
+def get_group_name(gid):
+    """Looks up the name tar records for gid, as GNU tar does"""
+    try:
+        return grp.getgrgid(gid)[0]
+    except KeyError:
+        return ""
+
+def write_ar_member(archive, name, size, fileobj, mtime):
+    """Writes one member of an ar archive, copying size bytes from fileobj"""
+    archive.write("%-16s%-12d%-6d%-6d%-8o%-10d`\n" % (
+        name,
+        mtime,
+        0,
+        0,
+        0100644,
+        size,
+    ))
+    remaining = size
+    while remaining:
+        data = fileobj.read(min(remaining, 65536))
+        if not data:
+            raise SuitcasePackagingError("Short read writing %s" % name)
+        archive.write(data)
+        remaining -= len(data)
+    # members start on even offsets
+    if size % 2:
+        archive.write("\n")
+
+def read_ar_header(archive):
+    """Returns the name, mtime and size of the next member, None at the end"""
+    header = archive.read(AR_HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) != AR_HEADER_SIZE or header[58:] != "`\n":
+        raise SuitcasePackagingError("Bad ar member header %r" % header)
+    # GNU ar ends names with a slash
+    return (
+        header[:16].rstrip().rstrip("/"),
+        int(header[16:28]),
+        int(header[48:58])
+    )
+
+def set_field(control, field, value):
+    """Returns the text of a control file with field set to value"""
+    pattern = re.compile(r"^%s:.*$" % re.escape(field), re.M)
+    if pattern.search(control) is None:
+        raise SuitcasePackagingError("No %s in control file" % field)
+    return pattern.sub(lambda match: "%s: %s" % (field, value), control, 1)
+
+def set_tar_control_field(contents, field, value):
+    """Sets field in a gzipped or plain control tar
+
+    Returns the tar gzipped, None if field was set to value already.
+
+    """
+    source = tarfile.open(fileobj=StringIO(contents))
+    output = StringIO()
+    tar = tarfile.open(
+        mode="w:gz",
+        fileobj=output,
+        format=tarfile.GNU_FORMAT
+    )
+    changed = False
+    try:
+        for tarinfo in source.getmembers():
+            fileobj = None
+            if tarinfo.isreg():
+                fileobj = source.extractfile(tarinfo)
+            if tarinfo.name in ("./control", "control"):
+                control = fileobj.read()
+                new_control = set_field(control, field, value)
+                changed = new_control != control
+                tarinfo.size = len(new_control)
+                fileobj = StringIO(new_control)
+            tar.addfile(tarinfo, fileobj)
+    finally:
+        tar.close()
+        source.close()
+    return changed and output.getvalue() or None
+
+def set_dpkg_control_field(filename, field, value):
+    """Sets field in the control tar of a package dpkg -b built
+
+    Those can be compressed in ways tarfile can't read, so dpkg-deb
+    unpacks it. Returns the tar gzipped, None if field was set to value
+    already.
+
+    """
+    control_dir = mkdtemp()
+    try:
+        try:
+            run_command(["dpkg-deb", "-e", filename, control_dir])
+        except SuitcaseCommandError, error:
+            raise SuitcasePackagingError(error)
+        control_filename = os.path.join(control_dir, "control")
+        control = open(control_filename).read()
+        new_control = set_field(control, field, value)
+        if new_control == control:
+            return None
+        open(control_filename, "w").write(new_control)
+
+        output = StringIO()
+        DebFile(control_dir).write_tar(output, control_dir)
+        return output.getvalue()
+    finally:
+        shutil.rmtree(control_dir)
+
+def set_control_field(filename, field, value):
+    """Sets field in the control file of the package at filename
+
+    The package is written out again next to it and renamed into place,
+    so a cache it's linked to is left alone, with the data tar copied
+    across as it is. Nothing is written if field was set to value.
+
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    (handle, temp_filename) = mkstemp(dir=directory)
+    changed = False
+    try:
+        source = open(filename, "rb")
+        archive = os.fdopen(handle, "wb")
+        try:
+            if source.read(len(AR_MAGIC)) != AR_MAGIC:
+                raise SuitcasePackagingError("%s isn't a package" % filename)
+            archive.write(AR_MAGIC)
+            while True:
+                header = read_ar_header(source)
+                if header is None:
+                    break
+                (name, mtime, size) = header
+                if name.startswith("control.tar"):
+                    contents = source.read(size)
+                    if name in ("control.tar.gz", "control.tar"):
+                        contents = set_tar_control_field(
+                            contents,
+                            field,
+                            value
+                        )
+                    else:
+                        contents = set_dpkg_control_field(
+                            filename,
+                            field,
+                            value
+                        )
+                    if contents is None:
+                        break
+                    changed = True
+                    write_ar_member(
+                        archive,
+                        "control.tar.gz",
+                        len(contents),
+                        StringIO(contents),
+                        mtime
+                    )
+                else:
+                    write_ar_member(archive, name, size, source, mtime)
+                # members start on even offsets
+                if size % 2:
+                    source.read(1)
+        finally:
+            archive.close()
+            source.close()
+
+        if changed:
+            os.chmod(temp_filename, 0666 & ~get_umask())
+            os.rename(temp_filename, filename)
+    except (IOError, OSError, tarfile.TarError), error:
+        raise SuitcasePackagingError(
+            "Can't set %s in %s: %s" % (field, filename, error)
+        )
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+class DebFile(object):
+
+    """A .deb built from a directory laid out like the installed files
+
+    permissions is what read_fakeroot_state returned after any hooks ran,
+    paths it doesn't mention are owned by root. streamed_files maps paths
+    relative to source_dir onto files elsewhere (in the branch) that are
+    packaged as if they'd been copied there, with the umask applied as a
+    copy would have.
+
+    """
+
+    def __init__(self, source_dir, permissions=None, streamed_files=None):
+        self.source_dir = os.path.abspath(source_dir)
+        self.permissions = permissions or {}
+        self.streamed_files = streamed_files or {}
+
+    def get_tarinfo(self, tar, path, arcname, umask=0):
+        """Returns the tar header for path with ownership set as dpkg would"""
+        info = os.lstat(path)
+        tarinfo = tar.gettarinfo(path, arcname)
+
+        (mode, uid, gid) = self.permissions.get(
+            (info.st_dev, info.st_ino),
+            (info.st_mode & ~SET_ID_BITS & ~umask, 0, 0)
+        )
+        if not stat.S_ISLNK(info.st_mode):
+            tarinfo.mode = stat.S_IMODE(mode)
+        tarinfo.uid = uid
+        tarinfo.gid = gid
+        tarinfo.uname = get_user_name(uid)
+        tarinfo.gname = get_group_name(gid)
+        if tarinfo.isdir() and not tarinfo.name.endswith("/"):
+            tarinfo.name += "/"
+        return tarinfo
+
+    def add_tree(self, tar, directory, exclude=None, streamed_files=None):
+        """Adds directory and everything below it to tar as ./ paths
+
+        Anything in streamed_files that isn't in directory is added too, in
+        the same depth first name order.
+
+        """
+        entries = {}
+        for path in walk_tree(directory, exclude):
+            key = tuple(path[len(directory):].strip("/").split("/"))
+            entries[key] = (path, 0)
+
+        if streamed_files:
+            umask = get_umask()
+            for relative_path, path in streamed_files.items():
+                key = tuple(relative_path.split("/"))
+                if key[0] != exclude:
+                    entries.setdefault(key, (path, umask))
+
+        tar.addfile(self.get_tarinfo(tar, directory, "./"))
+        for key in sorted(entries.keys()):
+            (path, umask) = entries[key]
+            tarinfo = self.get_tarinfo(
+                tar,
+                path,
+                "./%s" % "/".join(key),
+                umask
+            )
+            if tarinfo.isreg():
+                fileobj = open(path, "rb")
+                try:
+                    tar.addfile(tarinfo, fileobj)
+                finally:
+                    fileobj.close()
+            else:
+                tar.addfile(tarinfo)
+
+    def write_tar(self, fileobj, directory, exclude=None,
+        streamed_files=None):
+        """Writes a gzipped tar of directory to fileobj"""
+        tar = tarfile.open(
+            mode="w:gz",
+            fileobj=fileobj,
+            format=tarfile.GNU_FORMAT
+        )
+        try:
+            self.add_tree(tar, directory, exclude, streamed_files)
+        finally:
+            tar.close()
+
+    def write(self, filename):
+        """Writes the package out to filename
+
+        The data tar goes to a temp file next to filename, as only once it's
+        written is its size known for the ar header, and the package is
+        renamed into place once it's complete.
+
+        """
+        control_dir = os.path.join(self.source_dir, CONTROL_DIR)
+        if not os.path.isfile(os.path.join(control_dir, "control")):
+            raise SuitcasePackagingError(
+                "No control file in %s" % control_dir
+            )
+
+        control_tar = StringIO()
+        self.write_tar(control_tar, control_dir)
+        control_tar.seek(0)
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        (data_handle, data_filename) = mkstemp(dir=directory)
+        (deb_handle, deb_filename) = mkstemp(dir=directory)
+        try:
+            data_tar = os.fdopen(data_handle, "w+b")
+            try:
+                self.write_tar(
+                    data_tar,
+                    self.source_dir,
+                    CONTROL_DIR,
+                    self.streamed_files
+                )
+                data_size = data_tar.tell()
+                data_tar.seek(0)
+
+                mtime = int(time.time())
+                archive = os.fdopen(deb_handle, "wb")
+                try:
+                    archive.write(AR_MAGIC)
+                    write_ar_member(
+                        archive,
+                        "debian-binary",
+                        len(DEB_FORMAT_VERSION),
+                        StringIO(DEB_FORMAT_VERSION),
+                        mtime
+                    )
+                    write_ar_member(
+                        archive,
+                        "control.tar.gz",
+                        len(control_tar.getvalue()),
+                        control_tar,
+                        mtime
+                    )
+                    write_ar_member(
+                        archive,
+                        "data.tar.gz",
+                        data_size,
+                        data_tar,
+                        mtime
+                    )
+                finally:
+                    archive.close()
+            finally:
+                data_tar.close()
+
+            # mkstemp makes files only the owner can read
+            os.chmod(deb_filename, 0666 & ~get_umask())
+            os.rename(deb_filename, filename)
+        except (IOError, OSError), error:
+            if os.path.exists(deb_filename):
+                os.remove(deb_filename)
+            raise SuitcasePackagingError(
+                "Can't write package %s: %s" % (filename, error)
+            )
+        finally:
+            if os.path.exists(data_filename):
+                os.remove(data_filename)
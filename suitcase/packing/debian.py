@@ -13,6 +13,8 @@ Description
 
 import os
 import re
+import pprint
+import hashlib
 
 from suitcase.utils.common import (
     run_command, 
@@ -22,17 +24,97 @@ from suitcase.utils.common import (
     run_fakeroot, 
     clean_fakeroot, 
     merge_and_de_dupe,
+    display_warning,
 )
 from suitcase.packing.base import PackageBase 
-from suitcase.utils.copy import copy_files
-from suitcase.exceptions import SuitcasePackagingError
+from suitcase.builders.base import is_incremental, get_manifest_filename
+from suitcase.packing.cache import (
+    BuildCache,
+    FileDigests,
+    get_build_cache_directory,
+    get_digests_filename,
+    get_module_digest,
+    KEY_VERSION,
+)
+from suitcase.packing.debfile import (
+    DebFile,
+    set_control_field,
+    read_fakeroot_state,
+    write_fakeroot_state,
+)
+from suitcase.utils.fakeroot import get_session
+from suitcase.utils.copy import (
+    CopyStats,
+    copy_file_list,
+    link_file,
+    plan_copies,
+    make_dirs,
+    read_manifest,
+    write_manifest,
+    remove_stale,
+    compile_patterns,
+    matches_path,
+    get_umask,
+)
+from suitcase.exceptions import (
+    SuitcasePackagingError,
+    SuitcaseConfigurationError,
+    SuitcaseCopyError,
+)
 
 DEBUG = False
 CONTROL_FILE_NAME = "debian.yml"
 
+COPYRIGHT_TEMPLATE = os.path.join(
+    os.path.dirname(__file__),
+    "../templates/debian/copyright_minimum.template",
+)
+
+# Hooks run while building a package, rather than while finding them
+BUILD_HOOKS = [
+    'pre_copy',
+    'post_copy',
+    'pre_conf',
+    'post_conf',
+    'post_permissions',
+]
+
+# Global settings that change what goes into a package
+BUILD_KEY_SETTINGS = [
+    'default_build_exclusions',
+    'build_exclusions',
+    'destination_mapping',
+    'control_template',
+    'maintainer',
+    'prefix',
+    'package_name_filters',
+    'deb_writer',
+]
+
+# Package settings that don't, the version is set in a cached package as
+# it's used
+BUILD_KEY_IGNORED = ['path', 'working_dir', 'version', 'package_filename']
+
+STAGING_MODES = ['copy', 'link', 'stream']
+
+# Hooks that can run while files are linked or streamed from the branch
+STAGING_HOOKS = ['post_copy', 'pre_conf', 'post_conf', 'post_permissions']
+
 class Debian(PackageBase):
     """Debian specific packaging class for building .deb packages"""
 
+    # how files get into the working dir
+    staging = 'copy'
+    # paths in the working dir that are packaged straight from the branch
+    streamed_files = None
+    # what was in the working dir when it was last packaged
+    manifest = None
+    # what's copied from the branch, see get_transfers
+    transfers = None
+    # the hash of everything that goes into the package, see get_build_key
+    build_key = None
+    materialize_rules = None
+
     @staticmethod
     def is_valid_description_length(description):
         """Checks package name description length"""
@@ -118,34 +200,219 @@ class Debian(PackageBase):
         """Builds a debian package
 
         Actually does the call outs to dpkg so that we can actually build
-        a package
+        a package, unless deb_writer is set to python in which case the
+        package is written out directly without dpkg or fakeroot passes
         
         """
         source_dir = "%s" % self.package_config['working_dir']
+        native = self.global_config.get('deb_writer') == 'python'
 
-        # makes sure root owns the files
-        run_fakeroot("chown -R root.root %s" % source_dir)
-        # remove all sticky bits - a deb requirement.
-        run_fakeroot("chmod -R a-s %s" % source_dir)
+        if native:
+            permissions = self.run_permissions_hook(source_dir)
+        else:
+            # makes sure root owns the files
+            run_fakeroot(["chown", "-R", "root.root", source_dir])
+            # remove all sticky bits - a deb requirement.
+            run_fakeroot(["chmod", "-R", "a-s", source_dir])
 
-        self.run_hook('post_permissions')
+            self.run_hook('post_permissions')
 
         if not self.global_config['quiet']:
             print "Building package %s" % self.package_config['package']
             print "From %s" % self.package_config['path']
 
-
-        run_fakeroot("dpkg -b %s %s/temp/%s" % (
-            source_dir,
-            self.global_config['build_directory'],
-            self.package_config['package_filename'])
-        )
+        package_file = self.clear_package_file()
+        if native:
+            DebFile(source_dir, permissions, self.streamed_files).write(
+                package_file
+            )
+        else:
+            run_fakeroot(["dpkg", "-b", source_dir, package_file])
         
         clean_fakeroot()
 
+        if is_incremental(self.global_config, self.package_config):
+            # kept for the next build, which only has to bring it up to date
+            write_manifest(
+                get_manifest_filename(
+                    self.global_config,
+                    self.package_config['package']
+                ),
+                os.path.expanduser(source_dir)
+            )
         # Cleans up assuming the no-clean flag isn't set
-        if not self.global_config["no_clean"]:
-            run_command("rm -rf %s" % source_dir)
+        elif not self.global_config["no_clean"]:
+            run_command(["rm", "-rf", source_dir])
+
+    def get_package_file(self):
+        """Returns where the package is built"""
+        return os.path.expanduser("%s/temp/%s" % (
+            self.global_config['build_directory'],
+            self.package_config['package_filename']
+        ))
+
+    def clear_package_file(self):
+        """Returns where the package is built, ready to write to
+
+        Anything there is removed first as it may be linked to the package
+        repo or the build cache.
+
+        """
+        package_file = self.get_package_file()
+        try:
+            # working dirs kept between builds aren't in temp, so it may not
+            # be there
+            if not os.path.isdir(os.path.dirname(package_file)):
+                os.makedirs(os.path.dirname(package_file))
+            if os.path.lexists(package_file):
+                os.remove(package_file)
+        except OSError, error:
+            raise SuitcasePackagingError(error)
+        return package_file
+
+    def get_build_key(self):
+        """Hashes everything that goes into the package
+
+        That's the path, mode and contents of every file copied from the
+        branch, the control data, the hooks and the config, bar the
+        version. A package that's only been given a new version since it
+        was last built is taken from the cache with the new one set in it.
+        Returns None if any hook isn't marked cacheable, as its output
+        might depend on anything.
+
+        """
+        hooks = []
+        for method_label in BUILD_HOOKS:
+            for method in self.get_hook(method_label):
+                conf_module = dynamic_import(".".join(method.split(".")[:-1]))
+                hook = getattr(conf_module, method.split(".")[-1], None)
+                if not getattr(hook, 'cacheable', False):
+                    return None
+                hooks.append(
+                    (method_label, method, get_module_digest(conf_module))
+                )
+
+        key = hashlib.sha1(KEY_VERSION)
+        key.update(pprint.pformat(hooks))
+        settings = dict([
+            (setting, self.global_config.get(setting))
+            for setting in BUILD_KEY_SETTINGS
+        ])
+        if settings["destination_mapping"]:
+            settings["destination_mapping"] = self.get_global_mapping()
+        key.update(pprint.pformat(settings))
+        key.update(pprint.pformat(dict([
+            (setting, value)
+            for setting, value in self.package_config.items()
+            if setting not in BUILD_KEY_IGNORED
+        ])))
+        key.update(self.render_control(dict(self.package_config,
+            version="")))
+        key.update(open(COPYRIGHT_TEMPLATE).read())
+
+        to_dir = os.path.abspath(self.package_config['working_dir'])
+        umask = get_umask()
+        digests = FileDigests(get_digests_filename(
+            self.global_config,
+            self.package_config['package']
+        ))
+        (dirs, files) = plan_copies(self.get_transfers())
+        try:
+            for (path, target) in dirs:
+                key.update("d %s %o\n" % (
+                    os.path.abspath(target)[len(to_dir):],
+                    os.stat(path).st_mode & 07777 & ~umask,
+                ))
+            for (path, target) in files:
+                info = os.stat(path)
+                key.update("f %s %o %s\n" % (
+                    os.path.abspath(target)[len(to_dir):],
+                    info.st_mode & 07777 & ~umask,
+                    digests.get(path, info),
+                ))
+        except (IOError, OSError), error:
+            raise SuitcaseCopyError(error)
+        digests.save()
+
+        return key.hexdigest()
+
+    def fetch_cached_package(self):
+        """Uses a package built before from the same inputs, if there is one
+
+        It's put where the package would have been built. Returns whether
+        there was one.
+
+        """
+        directory = get_build_cache_directory(self.global_config)
+        if directory is None:
+            return False
+
+        self.build_key = self.get_build_key()
+        if self.build_key is None:
+            if not self.global_config['quiet']:
+                print "Not caching %s, not all of its hooks are cacheable" % \
+                    self.package_config['package']
+            return False
+
+        package_file = self.clear_package_file()
+        if not BuildCache(directory).fetch(self.build_key, package_file):
+            return False
+
+        try:
+            set_control_field(
+                package_file,
+                "Version",
+                self.package_config["version"]
+            )
+        except SuitcasePackagingError, error:
+            display_warning(
+                "Suitcase Warning: Not using cached package %s, %s" % (
+                    self.package_config['package_filename'],
+                    error
+                )
+            )
+            return False
+
+        if not self.global_config['quiet']:
+            print "Using cached package %s" % \
+                self.package_config['package_filename']
+
+        # nothing was copied into the working dir
+        if not is_incremental(self.global_config, self.package_config) and \
+            not self.global_config["no_clean"]:
+            run_command(["rm", "-rf", self.package_config['working_dir']])
+        return True
+
+    def store_cached_package(self):
+        """Adds the package just built to the build cache"""
+        directory = get_build_cache_directory(self.global_config)
+        if directory is None or self.build_key is None:
+            return
+
+        max_size = self.global_config.get('build_cache_size')
+        BuildCache(
+            directory,
+            max_size and int(max_size) * 1024 * 1024
+        ).store(self.build_key, self.get_package_file())
+
+    def run_permissions_hook(self, source_dir):
+        """Runs post_permissions hooks for the python deb writer
+
+        Returns the permissions the hooks set under fakeroot, starting from
+        everything owned by root as dpkg -b would have it. Without any
+        hooks fakeroot isn't run at all.
+
+        """
+        if not self.get_hook('post_permissions'):
+            return {}
+
+        # faked loads the seeded state when the hooks run their first command
+        session = get_session()
+        session.stop()
+        write_fakeroot_state(session.state_filename, source_dir)
+        self.run_hook('post_permissions')
+        session.stop()
+        return read_fakeroot_state(session.state_filename)
 
 
     def copy_files_to_package_dir(self, extra_excludes=None):
@@ -154,6 +421,34 @@ class Debian(PackageBase):
         ready for packaging
 
         """
+        self.setup_staging()
+
+        # everything is copied from a single walk of the branch
+        self.stage_files(self.get_transfers(extra_excludes))
+
+    def get_global_mapping(self):
+        """Returns the global destination mapping with its root filled in
+
+        It's a copy, so the global config stays as it was read and every
+        package's build key sees the same mapping.
+
+        """
+        global_mapping = dict(self.global_config.get("destination_mapping")
+            or {})
+        global_mapping["root"] = global_mapping.get("root","")
+        return global_mapping
+
+    def get_transfers(self, extra_excludes=None):
+        """Works out where in the working dir files in the branch go
+
+        Returns a list of source, destination and exclusions as taken by
+        copy_files. This sets up the destination mapping as it goes, so it's
+        only worked out once for a build.
+
+        """
+        if self.transfers is not None:
+            return self.transfers
+
         if extra_excludes is None:
             extra_excludes = []
 
@@ -169,6 +464,7 @@ class Debian(PackageBase):
             build_exclusions += package_config["build_exclusions"]
 
         mapped_files = []
+        transfers = []
 
 
         file_mapping = package_config.get('destination_mapping', {})
@@ -176,8 +472,7 @@ class Debian(PackageBase):
         # find which global_destination_map applies
         if self.global_config.get("destination_mapping"):
 
-            global_mapping = self.global_config["destination_mapping"]
-            global_mapping["root"] = global_mapping.get("root","")
+            global_mapping = self.get_global_mapping()
 
             # Create reverse destination mapping
             self.global_config["reverse_destination_mapping"] = {}
@@ -266,7 +561,9 @@ class Debian(PackageBase):
 
                 # do the magic
                 if os.path.exists(source):
-                    copy_files(source, destination, build_exclusions)
+                    transfers.append(
+                        (source, destination, list(build_exclusions))
+                    )
 
             file_mapping['root'] = file_mapping.get('root',"/")
             file_mapping["root"] = remove_leading_slash(file_mapping["root"])
@@ -278,11 +575,11 @@ class Debian(PackageBase):
                 build_exclusions += mapped_files
                 
 
-            copy_files(
+            transfers.append((
                 add_trailing_slash(from_dir),
                 os.path.join(to_dir, file_mapping['root']),
                 build_exclusions
-            )
+            ))
 
             self.package_config["destination_mapping"] = file_mapping
         else:
@@ -292,25 +589,161 @@ class Debian(PackageBase):
             if extra_excludes:
                 build_exclusions += extra_build_exclusions
 
-            copy_files(from_dir, to_dir, build_exclusions)
+            transfers.append((from_dir, to_dir, build_exclusions))
             self.package_config["destination_mapping"] = {"root":""}
 
+        self.transfers = transfers
+        return transfers
 
-    def make_package_conf_files(self):
-        """Write out the control file and the configfiles for the deb package"""
+    def setup_staging(self):
+        """Works out how files get from the branch into the working dir
 
-        if DEBUG:
-            import pprint
-            pprint.pprint(self.package_config)
+        staging is copy, link or stream. Link puts reflinks or hardlinks to
+        the branch's files in the working dir rather than copies. Stream
+        only creates the dirs and the rest is read from the branch as the
+        package is written, which needs the python deb writer. Either way
+        the files hooks need are copied, and if that isn't known everything
+        is.
 
-        # Write the control file
-        control_dir = "%s/DEBIAN" % self.package_config["working_dir"]
-        
-        if not os.path.exists(control_dir):
-            os.mkdir(control_dir)
-        
-        control_file = open("%s/control" % control_dir, "w")
-        
+        """
+        self.streamed_files = None
+        self.materialize_rules = None
+        self.manifest = None
+
+        if is_incremental(self.global_config, self.package_config):
+            manifest_filename = get_manifest_filename(
+                self.global_config,
+                self.package_config['package']
+            )
+            self.manifest = read_manifest(manifest_filename)
+            # until this build finishes the working dir won't match it
+            if os.path.exists(manifest_filename):
+                os.remove(manifest_filename)
+
+        staging = self.package_config.get(
+            'staging',
+            self.global_config.get('staging', 'copy')
+        )
+        if staging not in STAGING_MODES:
+            raise SuitcaseConfigurationError(
+                "Unknown staging %s, use one of %s" % (
+                    staging,
+                    ", ".join(STAGING_MODES)
+                )
+            )
+        if staging == 'stream' and \
+            self.global_config.get('deb_writer') != 'python':
+            raise SuitcaseConfigurationError(
+                "Streaming package files needs deb_writer: python"
+            )
+
+        self.staging = 'copy'
+        if staging == 'copy':
+            return
+
+        patterns = self.get_materialize_patterns()
+        if patterns is None:
+            # a hook might look at anything so copy everything as before
+            return
+
+        self.staging = staging
+        self.materialize_rules = compile_patterns(patterns)
+        if staging == 'stream':
+            self.streamed_files = {}
+
+    def get_materialize_patterns(self):
+        """Returns the paths that have to be in the working dir
+
+        These are exclude style patterns relative to the working dir. Hooks
+        list what they read or change in a materialize attribute, a hook
+        without one means everything is needed and None is returned.
+
+        """
+        patterns = [
+            "/DEBIAN",
+            "/usr/share/doc/%s/copyright" % self.package_config.get('package'),
+        ]
+        patterns += self.global_config.get('stream_materialize', [])
+        patterns += self.package_config.get('stream_materialize', [])
+
+        for config_item in self.package_config.get('conffiles') or []:
+            patterns.append("/%s" % remove_leading_slash(config_item))
+
+        for method_label in STAGING_HOOKS:
+            for method in self.get_hook(method_label):
+                conf_module = dynamic_import(".".join(method.split(".")[:-1]))
+                hook = getattr(conf_module, method.split(".")[-1], None)
+                materialize = getattr(hook, 'materialize', None)
+                if materialize is None:
+                    return None
+                patterns += materialize
+
+        return patterns
+
+    def stage_files(self, transfers):
+        """Puts files from the branch into the working dir
+
+        transfers is a list of source, destination and exclusions, as taken
+        by copy_files. Unless everything is copied, only the files that
+        match the materialize patterns are. The rest are linked, or are
+        recorded in streamed_files for the deb writer to read. A working
+        dir kept from the last build only has what's changed copied and
+        anything it shouldn't have removed.
+
+        """
+        to_dir = os.path.abspath(self.package_config['working_dir'])
+        (dirs, files) = plan_copies(transfers)
+        stats = CopyStats()
+        if self.manifest is not None:
+            stats.update(remove_stale(to_dir, self.manifest, dirs, files))
+        make_dirs(transfers, dirs)
+
+        if self.staging == 'copy':
+            stats.update(copy_file_list(files))
+            if not self.global_config.get('quiet'):
+                print "Staged %s" % stats
+            return stats
+
+        materialized = []
+        staged = []
+        for (path, target) in files:
+            relative_path = os.path.abspath(target)[len(to_dir):].strip("/")
+            if matches_path(relative_path, self.materialize_rules):
+                materialized.append((path, target))
+                if self.streamed_files is not None:
+                    self.streamed_files.pop(relative_path, None)
+            else:
+                staged.append((path, target, relative_path))
+
+        stats.update(copy_file_list(materialized))
+        if self.staging == 'link':
+            stats.update(copy_file_list(
+                [(path, target) for (path, target, _) in staged],
+                copy=link_file
+            ))
+            if not self.global_config.get('quiet'):
+                print "Staged %s" % stats
+            return stats
+
+        try:
+            for (path, target, relative_path) in staged:
+                self.streamed_files[relative_path] = path
+                if os.path.lexists(target):
+                    os.remove(target)
+        except OSError, error:
+            raise SuitcaseCopyError(error)
+
+        if not self.global_config.get('quiet'):
+            print "Staged %s, streaming %d" % (stats, len(staged))
+        return stats
+
+    def render_control(self, package_config):
+        """Fills in the control file template from package_config
+
+        The maintainer, description and depends are set in package_config
+        as they're worked out.
+
+        """
         control_template = self.global_config.get(
             "control_template", 
             os.path.join(
@@ -327,37 +760,55 @@ class Debian(PackageBase):
             
         template = open( "%s" % control_template ).read()
 
-        self.package_config["maintainer"] = self.package_config.get(
+        package_config["maintainer"] = package_config.get(
             "maintainer",
             self.global_config.get("maintainer")
         )
-        self.package_config["description"] = self.package_config.get(
+        package_config["description"] = package_config.get(
             "description",
-            "%s package" % (self.package_config["package"])
+            "%s package" % (package_config["package"])
         )
 
 
         # deal with depends - make a deduped, comma separated list, without 
         # the package itself in
         depends = merge_and_de_dupe(
-            self.package_config.get('depends',[])
+            package_config.get('depends',[])
         )
 
-        if self.package_config["package"] in depends:
-            depends.remove(self.package_config["package"])
+        if package_config["package"] in depends:
+            depends.remove(package_config["package"])
 
         if depends is None:
             depends = []
 
-        self.package_config['depends'] = ", ".join(depends)
-        if not self.package_config['depends']:
+        package_config['depends'] = ", ".join(depends)
+        if not package_config['depends']:
             template=template.replace("Depends: %(depends)s\n","")
 
         try:
-            control_file.write(template % self.package_config)
+            return template % package_config
         except KeyError, error:
             raise SuitcasePackagingError("%s missing from config" % error)
 
+    def make_package_conf_files(self):
+        """Write out the control file and the configfiles for the deb package"""
+
+        if DEBUG:
+            pprint.pprint(self.package_config)
+
+        # Write the control file
+        control_dir = "%s/DEBIAN" % self.package_config["working_dir"]
+        
+        if not os.path.exists(control_dir):
+            os.mkdir(control_dir)
+        
+        control_file = open("%s/control" % control_dir, "w")
+        try:
+            control_file.write(self.render_control(self.package_config))
+        finally:
+            control_file.close()
+
         # do config files
         config_items = {}
         config_files = self.package_config.get("conffiles")
@@ -413,10 +864,8 @@ class Debian(PackageBase):
         except OSError, error:
             raise SuitcasePackagingError(error)
         
-        run_command("cp %s %s/copyright" % (
-            os.path.join(
-                os.path.dirname(__file__), 
-                "../templates/debian/copyright_minimum.template",
-            ),
-            copyright_dir)
-        )
+        run_command([
+            "cp",
+            COPYRIGHT_TEMPLATE,
+            os.path.join(copyright_dir, "copyright")
+        ])
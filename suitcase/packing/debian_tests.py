@@ -2,8 +2,14 @@
 
 
 import os
+import shutil
 import unittest
+import commands
+from tempfile import mkdtemp
+
 from suitcase.packing.debian import Debian
+from suitcase.packing.debfile import DebFile, set_control_field
+from suitcase.packing.cache import BuildCache
 
 class DebianTestCase(unittest.TestCase):
 
@@ -98,6 +104,168 @@ class DebianTestCase(unittest.TestCase):
         expected = "gcap-apps-awesome-test"
         self.assert_equal(package_name, expected)
 
+    def test_version_below_limit(self):
+        """Test versions are compared with the limit as numbers"""
+        self.assertTrue(self.deb.is_below_limit("0.9", "10"))
+        self.assertFalse(self.deb.is_below_limit("0.10", "9"))
+        self.assertFalse(self.deb.is_below_limit("0.10", 0))
+
+    def test_commit_id_never_below_limit(self):
+        """Test versions that aren't numbers ignore the limit"""
+        self.assertFalse(self.deb.is_below_limit("0.0a1b2c", "10"))
+
+class DebFileTestCase(unittest.TestCase):
+
+    """Tests packages written without dpkg -b are read back by dpkg-deb"""
+
+    def setUp(self):
+        """Lays out a package dir with a setgid dir in it"""
+        self.temp_dir = mkdtemp()
+        self.source_dir = os.path.join(self.temp_dir, "package")
+        os.makedirs(os.path.join(self.source_dir, "DEBIAN"))
+        os.makedirs(os.path.join(self.source_dir, "usr/share/test"))
+        open(os.path.join(self.source_dir, "DEBIAN/control"), "w").write(
+            "Package: suitcase-test\nVersion: 0.1\nArchitecture: all\n"\
+            "Maintainer: Test <test@example.com>\nDescription: test\n"
+        )
+        open(os.path.join(self.source_dir, "usr/share/test/file"), "w")\
+            .write("test\n")
+        os.chmod(os.path.join(self.source_dir, "usr/share/test"), 02755)
+        self.filename = os.path.join(self.temp_dir, "test.deb")
+        DebFile(self.source_dir).write(self.filename)
+
+    def tearDown(self):
+        """Removes the package dir"""
+        shutil.rmtree(self.temp_dir)
+
+    def test_control(self):
+        """Test the control file can be read back"""
+        result = commands.getstatusoutput(
+            "dpkg-deb -f %s Package" % self.filename
+        )
+        self.assertEqual(result, (0, "suitcase-test"))
+
+    def test_contents(self):
+        """Test files are owned by root without setgid bits"""
+        result = commands.getstatusoutput("dpkg-deb -c %s" % self.filename)
+        self.assertEqual(result[0], 0)
+        entries = [line.split() for line in result[1].splitlines()]
+        self.assertEqual(
+            [entry[5] for entry in entries],
+            ["./", "./usr/", "./usr/share/", "./usr/share/test/",
+                "./usr/share/test/file"]
+        )
+        self.assertEqual(entries[3][:2], ["drwxr-xr-x", "root/root"])
+        self.assertFalse("DEBIAN" in result[1])
+
+    def test_set_control_field(self):
+        """Test the version is changed in a built package, and only that"""
+        contents = commands.getoutput("dpkg-deb -c %s" % self.filename)
+        inode = os.stat(self.filename).st_ino
+        set_control_field(self.filename, "Version", "0.1")
+        self.assertEqual(os.stat(self.filename).st_ino, inode)
+
+        # dpkg -b compresses the control tar in ways tarfile can't read
+        dpkg_filename = os.path.join(self.temp_dir, "dpkg.deb")
+        commands.getoutput("dpkg-deb -b %s %s" % (
+            self.source_dir,
+            dpkg_filename
+        ))
+        for filename in (self.filename, dpkg_filename):
+            set_control_field(filename, "Version", "0.2")
+            self.assertEqual(
+                commands.getstatusoutput(
+                    "dpkg-deb -f %s Version Package" % filename
+                ),
+                (0, "Version: 0.2\nPackage: suitcase-test")
+            )
+        self.assertEqual(
+            commands.getoutput("dpkg-deb -c %s" % self.filename),
+            contents
+        )
+
+class BuildCacheTestCase(unittest.TestCase):
+
+    """Tests packages are kept and thrown away by the build cache"""
+
+    def setUp(self):
+        """Makes a cache dir with room for two small packages"""
+        self.temp_dir = mkdtemp()
+        self.cache = BuildCache(os.path.join(self.temp_dir, "cache"), 12)
+
+    def tearDown(self):
+        """Removes the cache dir"""
+        shutil.rmtree(self.temp_dir)
+
+    def store(self, key, contents):
+        """Stores a package holding contents under key"""
+        filename = os.path.join(self.temp_dir, "%s.deb" % key)
+        open(filename, "w").write(contents)
+        self.cache.store(key, filename)
+
+    def test_fetch(self):
+        """Test a stored package is fetched and a missing one isn't"""
+        self.store("aa11", "first")
+        destination = os.path.join(self.temp_dir, "fetched.deb")
+        self.assertTrue(self.cache.fetch("aa11", destination))
+        self.assertEqual(open(destination).read(), "first")
+        self.assertFalse(self.cache.fetch("bb22", destination))
+
+    def test_evict(self):
+        """Test the least recently used package is thrown away first"""
+        self.store("aa11", "first")
+        self.store("bb22", "second")
+        os.utime(self.cache.get_filename("aa11"), (0, 0))
+        self.store("cc33", "third")
+        self.assertFalse(os.path.exists(self.cache.get_filename("aa11")))
+        self.assertTrue(os.path.exists(self.cache.get_filename("cc33")))
+
+    def get_build_keys(self, names):
+        """Returns the build key of each package, worked out in order
+
+        Every package's packer shares the global config, as in a build.
+
+        """
+        branch = os.path.join(self.temp_dir, "branch")
+        global_config = {
+            "base_path": branch,
+            "build_directory": os.path.join(self.temp_dir, "build"),
+            "default_build_exclusions": [],
+            "destination_mapping": {"assets": "/assets"},
+            "quiet": True,
+        }
+        keys = {}
+        for name in names:
+            path = os.path.join(branch, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+                open(os.path.join(path, "file"), "w").write(name)
+            deb = Debian(global_config)
+            deb.package_config = {
+                "package": name,
+                "version": "0.1",
+                "architecture": "all",
+                "maintainer": "Test <test@example.com>",
+                "path": path,
+                "working_dir": os.path.join(self.temp_dir, "working", name),
+            }
+            keys[name] = deb.get_build_key()
+        self.assertEqual(global_config["destination_mapping"],
+            {"assets": "/assets"})
+        return keys
+
+    def test_build_key_order(self):
+        """Test a package's key doesn't depend on what was built before it"""
+        self.assertEqual(
+            self.get_build_keys(["alpha", "beta"]),
+            self.get_build_keys(["beta", "alpha"])
+        )
+
 suite = unittest.TestLoader().loadTestsFromTestCase(DebianTestCase)
+suite.addTests(unittest.TestLoader().loadTestsFromTestCase(BuildCacheTestCase))
+if commands.getstatusoutput("dpkg-deb --version")[0] == 0:
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(DebFileTestCase)
+    )
 unittest.TextTestRunner(verbosity=2).run(suite)
 
@@ -0,0 +1,159 @@
+"""Times the JavaScript minifier against jsmin, and the CSS minifier
+
+Minifies the JavaScript files given, or a generated script if there are
+none, with bin/jsmin.py and with minify_javascript and checks both give
+exactly the same output. Then minifies the CSS files given, or a
+generated stylesheet, with minify_css and shows how much smaller they get.
+Run it directly:
+
+    python suitcase/plugins/assets/benchmarks.py --size 2 path/to/assets
+
+"""
+
+import os
+import time
+from optparse import OptionParser
+
+from suitcase.plugins.assets.bin.jsmin import jsmin
+from suitcase.plugins.assets.javascript import minify_javascript
+from suitcase.plugins.assets.stylesheet import minify_css
+
+SAMPLE = r"""/*
+ * Sample module %(index)s
+ */
+var module%(index)s = (function ($, undefined) {
+    // settings for the widget
+    var settings = {
+        "name": 'widget %(index)s',
+        pattern: /^[a-z]+\/\d+$/i,
+        limit: %(index)s * 2 + 1,
+        escaped: "a \"quoted\" string"
+    };
+
+    function find(items, value) {
+        for (var i = 0; i < items.length; i++) {
+            if (items[i] === value || items[i] / 2 == value) {
+                return i;
+            }
+        }
+        return -1;
+    }
+
+    return {
+        find: find,
+        matches: function (text) { return settings.pattern.test(text); },
+        total: settings.limit - -1 + +2
+    };
+}(jQuery));
+"""
+
+CSS_SAMPLE = r"""/* Sample stylesheet %(index)s */
+.widget-%(index)s, .widget-%(index)s > .title {
+    background: #fff url( "../img/widget-%(index)s.png" ) no-repeat 0 0;
+    font: 12px/1.5 "Helvetica Neue", Arial, sans-serif;
+    margin : 0 auto ;
+}
+
+.widget-%(index)s:hover .title + .body {
+    color: red;
+    color: rgba( 255, 0, 0, 0.5 );
+    width: calc( 100%% - 10px ) !important;
+}
+
+@media screen and (max-width: 600px) {
+    .widget-%(index)s { display: none; display: none; }
+}
+"""
+
+def read_corpus(paths, extension):
+    """Returns the contents of every file with extension under paths"""
+    contents = []
+    for path in paths:
+        if os.path.isfile(path):
+            if path.endswith(extension):
+                contents.append(open(path).read())
+            continue
+        for root, dirs, files in os.walk(path):
+            for filename in files:
+                if filename.endswith(extension):
+                    contents.append(open(os.path.join(root, filename)).read())
+    return contents
+
+def generate(sample, size):
+    """Returns sample repeated to about size megabytes"""
+    generated = []
+    length = 0
+    index = 0
+    while length < size * 1024 * 1024:
+        generated.append(sample % {"index": index})
+        length += len(generated[-1])
+        index += 1
+    return "".join(generated)
+
+def minify_all(minify, scripts):
+    """Minifies every script, returns how long it took and the results
+
+    Scripts jsmin can't read come out as the error they raised.
+
+    """
+    results = []
+    start = time.time()
+    for script in scripts:
+        try:
+            results.append(minify(script))
+        except Exception, error:
+            results.append(error.__class__.__name__)
+    return time.time() - start, results
+
+def time_javascript(scripts):
+    """Minifies the scripts both ways and compares them"""
+    size = sum([len(script) for script in scripts]) / 1024.0 / 1024.0
+    print "%s scripts, %.1fMB" % (len(scripts), size)
+
+    (old_seconds, expected) = minify_all(jsmin, scripts)
+    print "%-28s %8.3fs %8.2fMB/s" % ("jsmin", old_seconds,
+        size / old_seconds)
+    (seconds, results) = minify_all(minify_javascript, scripts)
+    print "%-28s %8.3fs %8.2fMB/s %5.1fx %s" % (
+        "minify_javascript",
+        seconds,
+        size / seconds,
+        old_seconds / seconds,
+        results == expected and "ok" or "DIFFERENT",
+    )
+
+def time_css(stylesheets):
+    """Minifies the stylesheets and shows how much was saved"""
+    size = sum([len(stylesheet) for stylesheet in stylesheets])
+    print "%s stylesheets, %.1fMB" % (len(stylesheets), size / 1024.0 / 1024.0)
+
+    (seconds, results) = minify_all(minify_css, stylesheets)
+    minified_size = sum([len(result) for result in results])
+    print "%-28s %8.3fs %8.2fMB/s %5.1f%% smaller" % (
+        "minify_css",
+        seconds,
+        size / 1024.0 / 1024.0 / seconds,
+        100.0 * (size - minified_size) / size,
+    )
+
+def main():
+    """Times the minifiers on the corpus"""
+    parser = OptionParser(usage="%prog [options] [path ...]")
+    parser.add_option("--size", type="float", default=2,
+        help="megabytes of script and CSS to generate if no paths are given")
+    (options, args) = parser.parse_args()
+
+    if args:
+        scripts = read_corpus(args, ".js")
+        stylesheets = read_corpus(args, ".css")
+    else:
+        scripts = [generate(SAMPLE, options.size)]
+        stylesheets = [generate(CSS_SAMPLE, options.size)]
+
+    if scripts:
+        time_javascript(scripts)
+    if stylesheets:
+        time_css(stylesheets)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,85 @@
-"""Provides ways to concatenate files"""
+"""Provides ways to concatenate files
+
+Files are copied into a bundle a chunk at a time rather than read whole.
+Every bundle has a manifest of the files that went into it and their
+sha1s, and the bundle is kept in the build directory keyed by a hash of
+it, so a bundle none of whose files have changed is copied from there.
+The sha1s are remembered by size and mtime so unchanged files aren't read
+at all. The manifests are left in the package config for minify's hooks,
+which minify a bundle a file at a time.
+
+"""
 
 import os
+import shutil
+import hashlib
+from tempfile import mkstemp
+
 from suitcase.exceptions import SuitcasePackagingError
+from suitcase.packing.cache import FileDigests, get_digests_filename
+from suitcase.utils.copy import break_link
+
+# bytes copied at a time
+CHUNK_SIZE = 1024 * 1024
+
+def get_bundle_cache_directory(global_config):
+    """Returns where bundles are kept, None if they aren't"""
+    if not global_config.get("bundle_cache", True) or \
+        not global_config.get("build_directory"):
+        return None
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "bundles"
+    )
+
+def get_bundle_key(manifest):
+    """Returns the key of a bundle from its manifest"""
+    key = hashlib.sha1()
+    for path, digest in manifest:
+        key.update("%s\0%s\0" % (path, digest))
+    return key.hexdigest()
+
+def write_bundle(target_file, manifest):
+    """Copies the files in manifest into target_file a chunk at a time"""
+    bundle_file = open(target_file, "wb")
+    try:
+        for path, digest in manifest:
+            source_file = open(path, "rb")
+            try:
+                shutil.copyfileobj(source_file, bundle_file, CHUNK_SIZE)
+            finally:
+                source_file.close()
+    finally:
+        bundle_file.close()
+
+def cache_bundle(target_file, cache_file):
+    """Keeps a copy of a bundle, it's only a cache so errors pass"""
+    directory = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (handle, temp_filename) = mkstemp(dir=directory)
+        os.close(handle)
+        shutil.copyfile(target_file, temp_filename)
+        os.rename(temp_filename, cache_file)
+    except (IOError, OSError):
+        pass
 
 def js(global_config, package_config):
     """Concatenates JavaScript files"""
-    
+
     files_to_generate = package_config.get("concat_js")
-    
+
     if files_to_generate:
-        
+
+        digests = FileDigests(get_digests_filename(
+            global_config,
+            "%s-concat" % package_config.get("package")
+        ))
+        cache_directory = get_bundle_cache_directory(global_config)
+        bundles = package_config.setdefault("concat_bundles", {})
+
         for (target_file, files_to_concatenate) in files_to_generate.items():
 
             target_file = os.path.join(
@@ -17,7 +87,7 @@ def js(global_config, package_config):
                 package_config["destination_mapping"]["root"],
                 target_file
             )
-            
+
             target_dir = os.path.split(target_file)[0]
 
             if not os.path.exists(target_dir):
@@ -26,17 +96,36 @@ def js(global_config, package_config):
                 except OSError, error:
                     raise SuitcasePackagingError(error)
 
-            concatenated_file = open(target_file,"w")
-            
+            manifest = []
             for js_file in files_to_concatenate:
                 js_file_path = os.path.join(global_config["base_path"], js_file)
                 if not os.path.exists(js_file_path):
-                    
+
                     raise SuitcasePackagingError(
                         "Js file for concatenation %s is missing" % js_file_path
                     )
-                    
-                else:
-                    concatenated_file.write(open(js_file_path).read())
-                    
-            concatenated_file.close()
+
+                manifest.append((
+                    js_file_path,
+                    digests.get(js_file_path, os.stat(js_file_path))
+                ))
+            bundles[target_file] = manifest
+
+            break_link(target_file)
+            cache_file = None
+            if cache_directory is not None:
+                key = get_bundle_key(manifest)
+                cache_file = os.path.join(cache_directory, key[:2], key)
+                if os.path.exists(cache_file):
+                    shutil.copyfile(cache_file, target_file)
+                    continue
+
+            write_bundle(target_file, manifest)
+            if cache_file is not None:
+                cache_bundle(target_file, cache_file)
+
+        digests.save()
+        return package_config
+
+# reads from the branch, so nothing has to be in the working dir
+js.materialize = []
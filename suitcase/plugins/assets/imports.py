@@ -0,0 +1,251 @@
+"""Flattens CSS @imports so a page loads one stylesheet rather than a chain
+
+The @imports at the top of a stylesheet are replaced by the stylesheets
+they import, themselves flattened, with their relative url()s changed to
+point at the same files from the importing stylesheet's dir. That's also
+where add_versions_to_css looks them up from, so the flattened
+stylesheets get the same versions; flatten_css has to run first as
+versioned @imports aren't relative anymore.
+
+Only what can all be inlined is: an @import with media queries, of a url
+that isn't relative or of a stylesheet that isn't there is left alone,
+and so is every other @import in the same stylesheet as they'd stop
+working once they weren't at the top. Stylesheets that import each other
+are left alone with a warning.
+
+What each stylesheet flattens to is kept in the build directory along
+with the sha1s of every stylesheet that went into it, and used again as
+long as none of them has changed.
+
+"""
+
+import os
+import re
+import hashlib
+
+from suitcase.packing.cache import read_pickle, write_pickle
+from suitcase.utils.common import display_warning
+from suitcase.utils.copy import break_link
+
+# bump when what flatten_css makes or keeps changes
+CACHE_VERSION = 1
+
+CHARSET = re.compile(r"""@charset\s*"[^"]*"\s*;""", re.I)
+COMMENTS = re.compile(r"(?:\s|/\*.*?\*/)*", re.S)
+IMPORT = re.compile(r"""@import\s*(?:url\(\s*(["']?)([^"')\s]*)\1\s*\)|"""
+    r"""(["'])([^"'\n]*)\3)\s*([^;]*);""", re.I)
+URL = re.compile(r"""(url\(\s*(["']?))([^"')\s]*)(\2\s*\))""", re.I)
+# urls with a scheme, data: included
+SCHEME = re.compile(r"^[a-z][a-z0-9+.-]*:", re.I)
+
+def is_relative(url):
+    """Checks url is a path relative to the stylesheet it's in"""
+    return bool(url) and not url.startswith(("/", "#")) and \
+        SCHEME.match(url) is None
+
+def read_imports(css):
+    """Splits the @imports off the top of css
+
+    Returns where the top ends, what's at the top bar the @imports (the
+    @charset and comments) and the url and media queries of each @import.
+
+    """
+    head = []
+    imports = []
+    match = CHARSET.match(css)
+    position = match and match.end() or 0
+    if match:
+        head.append(match.group())
+    while True:
+        match = COMMENTS.match(css, position)
+        head.append(match.group())
+        match = IMPORT.match(css, match.end())
+        if match is None:
+            break
+        (quote, url, other_quote, string, media) = match.groups()
+        if url is None:
+            url = string
+        imports.append((url, media.strip()))
+        position = match.end()
+    return position, "".join(head).strip(), imports
+
+def move_urls(css, from_dir, to_dir):
+    """Changes the relative url()s in css from from_dir to to_dir"""
+    if from_dir == to_dir:
+        return css
+
+    def move_url(match):
+        """Points one url at the same file from to_dir"""
+        url = match.group(3)
+        if not is_relative(url):
+            return match.group()
+        return "%s%s%s" % (
+            match.group(1),
+            os.path.relpath(os.path.join(from_dir, url), to_dir),
+            match.group(4)
+        )
+    return URL.sub(move_url, css)
+
+class Flattener(object):
+
+    """Flattens the stylesheets below a dir, reading each once"""
+
+    def __init__(self):
+        self.contents = {}
+
+    def read(self, path):
+        """Returns what's in a stylesheet"""
+        if path not in self.contents:
+            self.contents[path] = open(path).read()
+        return self.contents[path]
+
+    def flatten(self, path, inputs, importing=()):
+        """Returns the stylesheet at path flattened
+
+        None if its @imports can't all be inlined. The stylesheets read
+        are added to inputs.
+
+        """
+        css = self.read(path)
+        inputs.add(path)
+        (position, head, imports) = read_imports(css)
+        if not imports:
+            return css
+
+        directory = os.path.dirname(path)
+        flattened = []
+        for url, media in imports:
+            if media or not is_relative(url):
+                return None
+            imported = os.path.normpath(os.path.join(directory, url))
+            if imported == path or imported in importing:
+                display_warning(
+                    "Suitcase Warning: Not flattening %s, it imports "\
+                    "itself through %s" % (path, imported)
+                )
+                return None
+            if not os.path.isfile(imported):
+                display_warning(
+                    "Suitcase Warning: Not flattening %s, %s is missing" % \
+                    (path, imported)
+                )
+                return None
+
+            imported_css = self.flatten(
+                imported,
+                inputs,
+                importing + (path,)
+            )
+            if imported_css is None:
+                return None
+            imported_css = CHARSET.sub("", imported_css, 1).strip()
+            flattened.append(move_urls(
+                imported_css,
+                os.path.dirname(imported),
+                directory
+            ))
+
+        if head:
+            flattened.insert(0, head)
+        flattened.append(css[position:].lstrip())
+        return "\n".join(flattened)
+
+def get_flatten_cache_filename(global_config, package_config):
+    """Returns where the package's flattened stylesheets are kept"""
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "flattened",
+        package_config.get("package") or "package"
+    )
+
+def flatten_css(global_config, package_config):
+    """Inlines the @imports in every stylesheet in the css dir"""
+
+    target_dir = os.path.normpath(os.path.join(
+        package_config["working_dir"],
+        package_config["destination_mapping"]["root"],
+        "css",
+    ))
+    if not os.path.exists(target_dir):
+        return
+
+    stylesheets = []
+    for path, dirs, files in os.walk(target_dir):
+        for file_path in files:
+            if file_path.endswith(".css"):
+                stylesheets.append(os.path.join(path, file_path))
+
+    # what each stylesheet flattened to last time by its path in the css
+    # dir, with the sha1s of the stylesheets that went into it
+    cache_filename = None
+    cache = {}
+    if global_config.get("flatten_cache", True) and \
+        global_config.get("build_directory"):
+        cache_filename = get_flatten_cache_filename(
+            global_config,
+            package_config
+        )
+        snapshot = read_pickle(cache_filename)
+        if snapshot.get("version") == CACHE_VERSION:
+            cache = snapshot["stylesheets"]
+
+    flattener = Flattener()
+    digests = {}
+    def get_digest(path):
+        """Returns the sha1 of a stylesheet"""
+        if path not in digests:
+            digests[path] = hashlib.sha1(flattener.read(path)).hexdigest()
+        return digests[path]
+
+    def is_current(inputs):
+        """Checks none of the stylesheets that went into one has changed"""
+        try:
+            for path, digest in inputs:
+                path = os.path.normpath(os.path.join(target_dir, path))
+                if get_digest(path) != digest:
+                    return False
+        except IOError:
+            return False
+        return True
+
+    flattened = {}
+    for stylesheet in stylesheets:
+        name = os.path.relpath(stylesheet, target_dir)
+        entry = cache.get(name)
+        if entry is not None and is_current(entry[0]):
+            flattened[stylesheet] = entry[1]
+            continue
+
+        inputs = set()
+        css = flattener.flatten(stylesheet, inputs)
+        flattened[stylesheet] = css
+        if css is None:
+            # it may be flattened once what's missing turns up
+            cache.pop(name, None)
+            continue
+        cache[name] = (
+            sorted([(os.path.relpath(path, target_dir), get_digest(path))
+                for path in inputs]),
+            css
+        )
+
+    # written once everything's read, so each is flattened from what's in
+    # the branch
+    for stylesheet, css in flattened.items():
+        if css is not None and css != flattener.read(stylesheet):
+            break_link(stylesheet)
+            open(stylesheet, "w").write(css)
+
+    if cache_filename is not None:
+        write_pickle(cache_filename, {
+            "version": CACHE_VERSION,
+            "stylesheets": dict([(kept_name, kept_entry)
+                for kept_name, kept_entry in cache.items()
+                if os.path.join(target_dir, kept_name) in flattened]),
+        })
+
+# only the stylesheets have to be in the working dir when files are streamed
+flatten_css.materialize = ["*.css"]
+# the output only depends on the stylesheets, so packages can be cached
+flatten_css.cacheable = True
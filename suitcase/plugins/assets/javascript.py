@@ -0,0 +1,279 @@
+"""Minifies JavaScript exactly as jsmin does, a run of characters at a time
+
+bin/jsmin.py makes a decision for every character it reads. Most of them
+need none: a run of characters that aren't whitespace, quotes or slashes
+is just copied, and so is a string. A run of whitespace and comments acts
+like a single space or newline, and whether that's kept only depends on
+the characters either side of it. So everything up to the next slash
+that isn't in a comment or string is matched with one precompiled regex
+and copied with its separators squeezed out. Slashes, and the few places
+where jsmin's decisions depend on what came before, go through jsmin's
+own state machine. The output is the same byte for byte, errors included.
+
+"""
+
+import re
+
+from suitcase.plugins.assets.bin.jsmin import (
+    UnterminatedComment,
+    UnterminatedStringLiteral,
+    UnterminatedRegularExpression,
+)
+
+# what jsmin reads once the input runs out
+EOF = "\000"
+
+# jsmin reads carriage returns as newlines and other control characters
+# as spaces wherever they are
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x09\x0b\x0c\x0e-\x1f]")
+
+ALPHANUMS = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$\\"
+)
+
+# a slash after one of these starts a regular expression
+REGEX_PRECEDERS = frozenset("(,=:[?!&|;{}\n")
+
+# a newline is kept between alphanums and these
+NEWLINE_BEFORE = "}])+-\"'"
+NEWLINE_AFTER = "{[(+-"
+
+def get_character_class(characters, leave_out="", negate=False):
+    """Returns a regex character class for the characters
+
+    Negated it matches everything but them.
+
+    """
+    return "[%s%s]" % (negate and "^" or "", "".join(["\\x%02x" % ord(
+        character) for character in characters if character not in leave_out]))
+
+# everything from ASCII that isn't an alphanum, anything else counts as one
+NOT_ALPHANUMS = "".join([chr(code) for code in range(127)
+    if chr(code) not in ALPHANUMS])
+
+BLOCK_COMMENT = r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/"
+
+STRING = r"""(?:"[^"\\\n]*(?:\\.[^"\\\n]*)*"|'[^'\\\n]*(?:\\.[^'\\\n]*)*')"""
+
+STRINGS = {
+    "'": re.compile(r"([^'\\\n]*(?:\\.[^'\\\n]*)*)'", re.S),
+    '"': re.compile(r'([^"\\\n]*(?:\\.[^"\\\n]*)*)"', re.S),
+}
+
+REGEX = re.compile(r"([^/\\\n]*(?:\\.[^/\\\n]*)*)/", re.S)
+
+# a run of whitespace and comments, which can end with a // comment
+# running to the end
+SEPARATORS = r"(?:[ \n]+|%s|//[^\n]*\n?)+" % BLOCK_COMMENT
+
+# characters that can't start a string, regex, comment or separator, and
+# whole strings
+SEGMENT = r"""(?:[^ \n'"/]+|%s)+""" % STRING
+
+# segments with the separators between them. Written so there's only one
+# way to match a separator, or one followed by a slash would take
+# exponential time to give up on.
+PLAIN = re.compile(r"%s(?:[ \n]*(?:(?:%s|//[^\n]*\n)[ \n]*)*%s)*" % (
+    SEGMENT,
+    BLOCK_COMMENT,
+    SEGMENT
+), re.S)
+
+SEPARATOR = re.compile(r"[ \n]+|%s|//[^\n]*\n?" % BLOCK_COMMENT)
+LEADING_SEPARATORS = re.compile(SEPARATORS)
+
+# strings are swapped for this while separators are squeezed out around
+# them and the separators that are kept are marked with the others, as
+# jsmin never sees a control character
+PLACEHOLDER = "\x01"
+SPACE_MARK = "\x02"
+NEWLINE_MARK = "\x03"
+
+STRING_OR_COMMENT = re.compile(
+    r"%s|%s|//[^\n]*\n" % (STRING, BLOCK_COMMENT),
+    re.S
+)
+QUOTED = re.compile(STRING, re.S)
+
+# these all start with a space or newline so they're quick to search for
+TRAILING_SPACES = re.compile(r" +\n")
+KEPT_NEWLINES = re.compile(r"\n(?<=%s\n)[ \n]*(?=%s)" % (
+    get_character_class(NOT_ALPHANUMS, NEWLINE_BEFORE + PLACEHOLDER, True),
+    get_character_class(NOT_ALPHANUMS, NEWLINE_AFTER, True)
+))
+KEPT_SPACES = re.compile(r" (?<=%s ) *(?=%s)" % (
+    get_character_class(NOT_ALPHANUMS, negate=True),
+    get_character_class(NOT_ALPHANUMS, negate=True)
+))
+
+def is_alphanum(char):
+    """Checks char is a letter, digit, _, $, \\ or not ASCII, as jsmin does"""
+    return char in ALPHANUMS or char > "~"
+
+def collapse_separators(separators):
+    """Returns the space or newline jsmin treats a run of separators as
+
+    jsmin sees a comment as a space, or a newline for a // comment, and a
+    run of them and whitespace as a newline if there's one in it outside
+    a block comment. None if the run is only a // comment running to the
+    end.
+
+    """
+    if "/" not in separators:
+        return "\n" in separators and "\n" or " "
+
+    collapsed = None
+    for separator in SEPARATOR.findall(separators):
+        if separator[0] != "/":
+            if "\n" in separator:
+                collapsed = "\n"
+            elif collapsed is None:
+                collapsed = " "
+        elif separator[1] == "*":
+            collapsed = collapsed or " "
+        elif separator[-1] == "\n":
+            collapsed = "\n"
+    return collapsed
+
+def squeeze_separators(run):
+    """Drops the separators jsmin would from a run matched by PLAIN
+
+    What's left of each is a space kept between two alphanums or a
+    newline kept between the characters jsmin keeps newlines between.
+    Comments become the space or newline they act as first, and strings
+    are set aside as what's either side of them is all that matters.
+
+    """
+    strings = []
+    if "/" in run:
+        def set_aside(match):
+            """Sets strings aside and swaps comments for whitespace"""
+            token = match.group()
+            if token[0] != "/":
+                strings.append(token)
+                return PLACEHOLDER
+            return token[1] == "*" and " " or "\n"
+        run = STRING_OR_COMMENT.sub(set_aside, run)
+    elif "'" in run or '"' in run:
+        strings = QUOTED.findall(run)
+        run = QUOTED.sub(PLACEHOLDER, run)
+
+    if "\n" in run:
+        if " \n" in run:
+            run = TRAILING_SPACES.sub("\n", run)
+        run = KEPT_NEWLINES.sub(NEWLINE_MARK, run).replace("\n", "")
+    if " " in run:
+        run = KEPT_SPACES.sub(SPACE_MARK, run).replace(" ", "")\
+            .replace(SPACE_MARK, " ")
+    if NEWLINE_MARK in run:
+        run = run.replace(NEWLINE_MARK, "\n")
+
+    if strings:
+        pieces = run.split(PLACEHOLDER)
+        squeezed = [None] * (len(pieces) + len(strings))
+        squeezed[::2] = pieces
+        squeezed[1::2] = strings
+        run = "".join(squeezed)
+    return run
+
+def read_next(text, pos):
+    """Returns the next character jsmin would see at pos and where it ends
+
+    A run of separators comes out as the single space or newline jsmin
+    ends up treating it as.
+
+    """
+    char = text[pos:pos + 1]
+    if not char:
+        return EOF, pos
+    if char != " " and char != "\n" and \
+        (char != "/" or text[pos + 1:pos + 2] not in ("/", "*")):
+        return char, pos + 1
+
+    match = LEADING_SEPARATORS.match(text, pos)
+    if match is not None:
+        pos = match.end()
+    if text.startswith("/*", pos):
+        raise UnterminatedComment()
+
+    collapsed = collapse_separators(match.group())
+    if collapsed is None:
+        return EOF, pos
+    return collapsed, pos
+
+def minify_javascript(javascript):
+    """Returns javascript minified, the same as jsmin.jsmin"""
+    text = CONTROL_CHARACTERS.sub(" ", javascript.replace("\r", "\n"))
+    output = []
+    append = output.append
+
+    # a and b are jsmin's theA and theB and action is what it does next:
+    # 1 outputs a, 2 drops a and 3 drops b
+    a = "\n"
+    b = None
+    pos = 0
+    action = 3
+    while True:
+        if action <= 1:
+            append(a)
+        if action <= 2:
+            a = b
+            if a == "'" or a == '"':
+                match = STRINGS[a].match(text, pos)
+                if match is None:
+                    raise UnterminatedStringLiteral()
+                append(a)
+                append(match.group(1))
+                pos = match.end()
+
+        (b, pos) = read_next(text, pos)
+        if b == "/" and a in REGEX_PRECEDERS:
+            match = REGEX.match(text, pos)
+            if match is None:
+                raise UnterminatedRegularExpression()
+            append(a)
+            append("/")
+            append(match.group(1))
+            a = "/"
+            pos = match.end()
+            (b, pos) = read_next(text, pos)
+
+        if a == EOF:
+            break
+
+        if a == " ":
+            action = is_alphanum(b) and 1 or 2
+        elif a == "\n":
+            if b in NEWLINE_AFTER:
+                action = 1
+            elif b == " ":
+                action = 3
+            else:
+                action = is_alphanum(b) and 1 or 2
+        elif b == " ":
+            action = is_alphanum(a) and 1 or 3
+        elif b == "\n":
+            action = (a in NEWLINE_BEFORE or is_alphanum(a)) and 1 or 3
+        elif b == EOF or b == "/":
+            action = 1
+        else:
+            # a is copied and so is everything from b up to the next slash
+            # that needs a decision, the last character becoming a
+            match = PLAIN.match(text, pos - 1)
+            if match is None:
+                # a string that doesn't end
+                action = 1
+                continue
+            append(a)
+            run = match.group()
+            if " " in run or "\n" in run or "/" in run:
+                run = squeeze_separators(run)
+            append(run[:-1])
+            a = run[-1]
+            pos = match.end()
+            action = 3
+
+    minified = "".join(output)
+    if minified[:1] == "\n":
+        minified = minified[1:]
+    return minified
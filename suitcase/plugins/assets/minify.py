@@ -1,37 +1,333 @@
-"""Class to handle the minification of JS/CSS"""
+"""Class to handle the minification of JS/CSS
+
+Scripts and stylesheets are minified by a pool of worker processes and
+what comes out is kept in the build directory keyed by a hash of the file
+and of the minifier, so a file that hasn't changed since it was last
+minified is just copied from there. Files that are already minified are
+passed through as they are.
+
+"""
 
 import os
-from suitcase.plugins.assets.bin.jsmin import jsmin
+import time
+import hashlib
+import multiprocessing
+from tempfile import mkstemp
+
+from suitcase.plugins.assets import javascript as javascript_module
+from suitcase.plugins.assets import stylesheet as stylesheet_module
+from suitcase.plugins.assets.javascript import minify_javascript
+from suitcase.plugins.assets.stylesheet import minify_css
+from suitcase.packing.cache import get_module_digest
+from suitcase.utils.copy import break_link
+
+# bump when the way files are minified changes
+MINIFIER_VERSION = "1"
+
+# lines at least this long on average mean a file is already minified
+MINIFIED_LINE_LENGTH = 200
+
+def get_minify_cache_directory(global_config):
+    """Returns where minified files are kept, None if they aren't"""
+    if not global_config.get("minify_cache", True) or \
+        not global_config.get("build_directory"):
+        return None
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "minified"
+    )
+
+def get_minify_jobs(global_config):
+    """Returns how many processes minify files at once
+
+    Builds running in a worker process can't start processes of their
+    own, so they minify one file at a time.
+
+    """
+    if multiprocessing.current_process().daemon:
+        return 1
+    jobs = global_config.get("minify_jobs")
+    if jobs:
+        return int(jobs)
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def is_minified(filename, contents, extension=".js"):
+    """Checks for a file that's been minified already
+
+    Either it's named like one or none of its lines are indented and they
+    are long on average.
+
+    """
+    if filename.endswith((".min" + extension, "-minified" + extension)):
+        return True
+    lines = contents.splitlines()
+    if not lines:
+        return False
+    for line in lines:
+        if line[:1] in (" ", "\t"):
+            return False
+    return len(contents) / len(lines) >= MINIFIED_LINE_LENGTH
+
+def write_file(filename, contents):
+    """Writes contents out to filename atomically"""
+    (handle, temp_filename) = mkstemp(dir=os.path.dirname(filename))
+    temp_file = os.fdopen(handle, "w")
+    try:
+        temp_file.write(contents)
+    finally:
+        temp_file.close()
+    os.chmod(temp_filename, 0644)
+    os.rename(temp_filename, filename)
+
+def minify_file(job):
+    """Minifies one file, keeping what comes out in the cache
+
+    Runs in a worker process. Writes it to new_file and returns how many
+    seconds it took, or without a new_file returns that and what came
+    out, which is the file as it is if it's minified already.
+
+    """
+    (minify, source_file, new_file, cache_file) = job
+    start = time.time()
+    original_contents = open(source_file).read()
+    if new_file is None and is_minified(source_file, original_contents,
+        os.path.splitext(source_file)[1]):
+        return time.time() - start, original_contents
+
+    minified_contents = minify(original_contents)
+    if not minified_contents:
+        minified_contents = original_contents
+
+    if new_file is not None:
+        break_link(new_file)
+        open(new_file, "w").write(minified_contents)
+
+    if cache_file is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            write_file(cache_file, minified_contents)
+        except (IOError, OSError):
+            # it's only a cache
+            pass
+
+    if new_file is not None:
+        return time.time() - start, None
+    return time.time() - start, minified_contents
+
+def find_files(target_dir, extension):
+    """Returns every file with extension below target_dir, bar tiny_mce"""
+    found = []
+    for path, dirs, files in os.walk(target_dir):
+
+        if 'tiny_mce' in dirs:
+            dirs.remove('tiny_mce')
+
+        for filename in files:
+            source_file = os.path.join(path, filename)
+            if source_file.endswith(extension):
+                found.append(source_file)
+    return found
+
+def run_jobs(global_config, jobs):
+    """Runs minify_file for each job in a pool of processes, in order"""
+    processes = min(get_minify_jobs(global_config), len(jobs))
+    if processes < 2:
+        return [minify_file(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(minify_file, jobs)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def minify_files(global_config, target_dir, extension, minify, module,
+    bundles=None):
+    """Minifies every file with extension below target_dir
+
+    Each is written alongside as name-minified.ext, by minify in a pool
+    of processes or from the cache. Files are cached by the sha1 of what's
+    in them along with one of MINIFIER_VERSION, the extension and the
+    source of module, where minify lives.
+
+    bundles maps bundles concat made to the files in them and their
+    sha1s. A bundle is minified a file at a time, each through the cache,
+    and what comes out joined up a line apart. That's what ends most
+    files anyway, so the bundle runs as it would minified whole, though a
+    newline may be kept where jsmin would have dropped it, and a file that
+    doesn't end in one no longer runs on into the next.
+
+    """
+    cache_directory = get_minify_cache_directory(global_config)
+    minifier = hashlib.sha1(MINIFIER_VERSION + extension)
+    minifier.update(get_module_digest(module) or "")
+    bundles = dict([(os.path.abspath(bundle), files)
+        for bundle, files in (bundles or {}).items()])
+
+    def get_cache_file(digest):
+        """Returns where the minified file with digest is cached"""
+        if cache_directory is None:
+            return None
+        key = minifier.copy()
+        key.update(digest)
+        key = key.hexdigest()
+        return os.path.join(cache_directory, key[:2], key)
+
+    # what happened to each file: how, how long it took and its sizes
+    results = []
+    jobs = []
+    # what the files in bundles minify to by sha1, the jobs minifying
+    # those that aren't cached and how long each took
+    pieces = {}
+    piece_jobs = []
+    piece_digests = []
+    piece_seconds = {}
+    joined = []
+    for source_file in find_files(target_dir, extension):
+        new_file = source_file.replace(extension, "-minified" + extension)
+        start = time.time()
+
+        files = bundles.get(os.path.abspath(source_file))
+        if files is not None:
+            for path, digest in files:
+                if digest in pieces:
+                    continue
+                cache_file = get_cache_file(digest)
+                if cache_file is not None and os.path.exists(cache_file):
+                    pieces[digest] = open(cache_file).read()
+                else:
+                    pieces[digest] = None
+                    piece_jobs.append((minify, path, None, cache_file))
+                    piece_digests.append(digest)
+            joined.append((source_file, new_file, files))
+            continue
+
+        original_contents = open(source_file).read()
+        if is_minified(source_file, original_contents, extension):
+            break_link(new_file)
+            open(new_file, "w").write(original_contents)
+            results.append((source_file, "passed through",
+                time.time() - start, len(original_contents), new_file))
+            continue
+
+        cache_file = get_cache_file(
+            hashlib.sha1(original_contents).hexdigest()
+        )
+        if cache_file is not None and os.path.exists(cache_file):
+            break_link(new_file)
+            open(new_file, "w").write(open(cache_file).read())
+            results.append((source_file, "cached",
+                time.time() - start, len(original_contents), new_file))
+            continue
+
+        jobs.append((minify, source_file, new_file, cache_file))
+
+    ran = run_jobs(global_config, jobs + piece_jobs)
+    for (minify, source_file, new_file, cache_file), (seconds, contents) in \
+        zip(jobs, ran):
+        results.append((source_file, "minified", seconds,
+            os.path.getsize(source_file), new_file))
+
+    for digest, (seconds, contents) in zip(piece_digests, ran[len(jobs):]):
+        pieces[digest] = contents
+        piece_seconds[digest] = seconds
+
+    for source_file, new_file, files in joined:
+        break_link(new_file)
+        open(new_file, "w").write(
+            "\n".join([pieces[digest] for path, digest in files])
+        )
+        results.append((
+            source_file,
+            "joined from %s files" % len(files),
+            sum([piece_seconds.get(digest, 0) for path, digest in files]),
+            os.path.getsize(source_file),
+            new_file
+        ))
+
+    if global_config["quiet"]:
+        return
+    saved = 0
+    for source_file, how, seconds, size, new_file in sorted(results):
+        minified_size = os.path.getsize(new_file)
+        saved += size - minified_size
+        print "MINIFYING %s %s in %.3fs, %s -> %s bytes" % (
+            source_file,
+            how,
+            seconds,
+            size,
+            minified_size
+        )
+    print "Minified %s files, %s from the cache, saving %s bytes" % (
+        len(results),
+        len([result for result in results if result[1] == "cached"]),
+        saved
+    )
 
 def javascript(global_config, package_config):
-    """Minifies JavaScript"""
-    
+    """Minifies JavaScript
+
+    Bundles made by concat.js are minified a file at a time.
+
+    """
+
     target_dir = os.path.join(
-        package_config["working_dir"], 
+        package_config["working_dir"],
         package_config["destination_mapping"]["root"],
         "js",
     )
 
     if os.path.exists(target_dir):
-        for path, dirs, files in os.walk(target_dir):
+        minify_files(
+            global_config,
+            target_dir,
+            ".js",
+            minify_javascript,
+            javascript_module,
+            package_config.get("concat_bundles")
+        )
+    else:
+        print "No Javascript dir - no minification "
 
-            if 'tiny_mce' in dirs:
-                dirs.remove('tiny_mce')
+# only the scripts have to be in the working dir when files are streamed
+javascript.materialize = ["*.js"]
+# the output only depends on the scripts, so packages can be cached
+javascript.cacheable = True
 
-            for filename in files:
-                js_file = os.path.join(path, filename)
-                if not js_file.endswith(".js"):
-                    continue
+def css(global_config, package_config):
+    """Minifies CSS
 
-                if not global_config["quiet"]:
-                    print "MINIFYING " + js_file
+    Can run before or after add_versions_to_css.
 
-                new_file = js_file.replace(".js","-minified.js")
-                original_contents = open(js_file).read()
-                minified_contents = jsmin(original_contents)
-                if not minified_contents:
-                    minified_contents = original_contents
+    """
 
-                open(new_file,"w").write(minified_contents)
+    target_dir = os.path.join(
+        package_config["working_dir"],
+        package_config["destination_mapping"]["root"],
+        "css",
+    )
+
+    if os.path.exists(target_dir):
+        minify_files(
+            global_config,
+            target_dir,
+            ".css",
+            minify_css,
+            stylesheet_module
+        )
     else:
-        print "No Javascript dir - no minification "
+        print "No CSS dir - no minification "
+
+# only the stylesheets have to be in the working dir when files are streamed
+css.materialize = ["*.css"]
+# the output only depends on the stylesheets, so packages can be cached
+css.cacheable = True
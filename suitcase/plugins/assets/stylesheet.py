@@ -0,0 +1,102 @@
+"""Minifies CSS, leaving it readable by the asset versioning hooks
+
+Strings and url()s are set aside first so nothing inside them is touched.
+Comments are dropped, bar /*! ones which are usually licences, and
+whitespace is squeezed out where CSS doesn't need it: only around the
+punctuation that can't be part of a name, and around the combinators in
+selectors. A declaration repeated word for word later in the same rule
+does nothing, so the earlier one is dropped. Declarations that only
+differ in their value are left alone as they're usually fallbacks for
+older browsers.
+
+version.ASSET_REGEX only finds one asset on a line and takes everything
+up to the last thing that looks like one, so a line is ended after every
+string and url(). That way add_versions_to_css can version the output,
+and versioned CSS can be minified, whichever hook runs first.
+
+"""
+
+import re
+
+# strings and url()s are swapped for this while the rest is squeezed
+PLACEHOLDER = "\x01"
+
+STRING = r""""(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'"""
+
+# an unterminated comment runs to the end, as it does in a browser
+PROTECTED = re.compile(
+    r"""(/\*.*?(?:\*/|$))|(%s)|url\(\s*(%s|[^)\s]*)\s*\)""" % (STRING, STRING),
+    re.S | re.I
+)
+
+WHITESPACE = re.compile(r"\s+")
+# nothing needs a space next to these anywhere
+PUNCTUATION_SPACES = re.compile(r" (?=[{};,>])|(?<=[{};,>]) ")
+
+# text with a space in it up to the next brace or semicolon and what it's
+# up to, the rest have nothing left to squeeze
+SEGMENT = re.compile(r"(?:^|(?<=[{};]))([^{}; ]* [^{};]*)([{};]|$)")
+COMBINATOR_SPACES = re.compile(r" (?=[+~])|(?<=[^\\][+~]) ")
+VALUE_SPACES = re.compile(r"(?<=\() | (?=[)!])")
+# the declarations of a rule with no rules inside it
+DECLARATIONS = re.compile(r"\{([^{}]*)\}")
+EMPTY_RULES = re.compile(r"(?:^|(?<=[{};]))[^{};]+\{\}")
+
+def squeeze_segment(match):
+    """Squeezes the spaces out of a selector or declaration"""
+    (segment, delimiter) = match.groups()
+    if segment[:1] == "@":
+        return match.group()
+    if delimiter == "{":
+        return COMBINATOR_SPACES.sub("", segment) + delimiter
+    if ":" not in segment:
+        return match.group()
+    (name, value) = segment.split(":", 1)
+    return "%s:%s%s" % (
+        name.strip(),
+        VALUE_SPACES.sub("", value.strip()),
+        delimiter
+    )
+
+def drop_repeated_declarations(match):
+    """Drops declarations repeated later on in a rule, and empty ones"""
+    kept = []
+    seen = set()
+    for declaration in reversed(match.group(1).split(";")):
+        if declaration and declaration not in seen:
+            kept.append(declaration)
+            seen.add(declaration)
+    kept.reverse()
+    return "{%s}" % ";".join(kept)
+
+def minify_css(css):
+    """Returns css minified"""
+    protected = []
+    def set_aside(match):
+        """Sets strings and url()s aside and drops comments"""
+        (comment, string, url) = match.groups()
+        if comment is not None:
+            if not comment.startswith("/*!"):
+                return " "
+            protected.append(comment)
+        elif string is not None:
+            protected.append(string)
+        else:
+            protected.append("url(%s)" % url)
+        return PLACEHOLDER
+
+    css = PROTECTED.sub(set_aside, css.replace(PLACEHOLDER, ""))
+    css = PUNCTUATION_SPACES.sub("", WHITESPACE.sub(" ", css)).strip()
+    css = SEGMENT.sub(squeeze_segment, css)
+    css = DECLARATIONS.sub(drop_repeated_declarations, css)
+    if "{}" in css:
+        css = EMPTY_RULES.sub("", css)
+
+    pieces = css.split(PLACEHOLDER)
+    minified = [pieces[0]]
+    for index, piece in enumerate(pieces[1:]):
+        minified.append(protected[index])
+        if piece or index < len(protected) - 1:
+            minified.append("\n")
+            minified.append(piece.lstrip(" "))
+    return "".join(minified)
@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""Tests for the asset plugins"""
+
+import os
+import random
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from suitcase.plugins.assets import concat, imports, minify, version
+from suitcase.plugins.assets.bin.jsmin import jsmin
+from suitcase.plugins.assets.javascript import minify_javascript
+from suitcase.plugins.assets.stylesheet import minify_css
+from suitcase.plugins.assets.version import ASSET_REGEX
+from suitcase.packing.cache import read_pickle, write_pickle
+
+SNIPPETS = [
+    "",
+    "\n\n",
+    "var a = 1;",
+    "var  a\n=\n1 ;\n",
+    "a = b\n+ c\n- d\n",
+    "a++\n+b; a--\n-b; a + +b; a - -b;",
+    "return\n/re+/g.test(x)",
+    "x = (/[/]\\/ab/).exec(y) / 2 / z;",
+    "if (a) { b() }\n else { c() }\n",
+    "f(\"it's\", 'a \"quote\"', \"\\\"\", '\\\\');",
+    "s = 'a /* not */ b // nor\\' this';",
+    "a /* comment */ b /* another\n one */ c",
+    "a /*\n*/ b\n/* x */\nc",
+    "a // line comment\nb // at the end",
+    "a = 1 /**/ + /***/ 2 /* * / */;",
+    "var été = café\r\n+ 1;\t\x0b// tabs",
+    "}\n]\n)\n'a'\n\"b\"\n{\n[\n(\n",
+    "a\n \n b  \n  c",
+]
+
+# pieces of script the fuzz test strings together
+PIECES = [
+    "a", "b1", "$", "_x", "\\", "é", "0", " ", "  ", "\n", "\t", "\r",
+    "\n  \n", "/", "//c\n", "/* c */", "/*\n*/", "'s'", "\"d\"", "'\\''",
+    "\"a/b\"", "/re/g", "(", ")", "{", "}", "[", "]", "+", "-", "=", ";",
+    ",", ":", "?", "!", "&", "|", ".", "*", "'", "\"", "/*", "//",
+]
+
+
+class JavascriptTestCase(unittest.TestCase):
+
+    """Tests minify_javascript gives exactly what jsmin does"""
+
+    def assert_minifies_same(self, script):
+        """Checks both give the same output or raise the same error"""
+        try:
+            expected = jsmin(script)
+        except Exception, error:
+            self.assertRaises(error.__class__, minify_javascript, script)
+        else:
+            self.assertEqual(minify_javascript(script), expected,
+                "%r should minify to %r" % (script, expected))
+
+    def test_snippets(self):
+        """Test the corners of jsmin's rules"""
+        for snippet in SNIPPETS:
+            self.assert_minifies_same(snippet)
+
+    def test_unterminated(self):
+        """Test unterminated strings, comments and regexes raise the same"""
+        for script in ["a = 'b", "a = \"b\nc\"", "a /* b", "x = /a\n/",
+            "f(/a\\", "'\\"]:
+            self.assert_minifies_same(script)
+
+    def test_random_scripts(self):
+        """Test scripts put together at random"""
+        generator = random.Random(20)
+        for count in range(3000):
+            self.assert_minifies_same("".join([generator.choice(PIECES)
+                for piece in range(generator.randint(1, 30))]))
+
+class StylesheetTestCase(unittest.TestCase):
+
+    """Tests CSS is minified without changing what it means"""
+
+    def test_minify_css(self):
+        """Test comments and whitespace go and repeats are dropped"""
+        for css, expected in [
+            ("a  >  b ,\n c + d ~ e {\n  color : red ;\n}\n",
+                "a>b,c+d~e{color:red}"),
+            ("/* gone */ a:hover, a :first-child { margin: 0 }",
+                "a:hover,a :first-child{margin:0}"),
+            ("/*! licence */\na { width: calc( 1px + 2px ) !important; }",
+                "/*! licence */\na{width:calc(1px + 2px)!important}"),
+            ("@media screen and (max-width : 10px) { a { b: c; } }",
+                "@media screen and (max-width : 10px){a{b:c}}"),
+            ("a { color: red; color: blue; color: red; } b {} c{;}",
+                "a{color:blue;color:red}"),
+            ("a { content: ' { ; } ' }", "a{content:' { ; } '\n}"),
+        ]:
+            self.assertEqual(minify_css(css), expected)
+
+    def test_asset_lines(self):
+        """Test every asset is on a line of its own for the versioning"""
+        css = """@import "other.css" screen;
+            a { background: url( 'a.png' ) no-repeat, url(b.gif) }
+            html:not(.js) { content: "x" }
+            @font-face { src: url(c.ttf) format("truetype") }"""
+        minified = minify_css(css)
+        self.assertEqual(
+            [match.group("path") for match in ASSET_REGEX.finditer(minified)],
+            ["other.css", "a.png", "b.gif"]
+        )
+        versioned = ASSET_REGEX.sub(r"\1/1\g<path>\3", minified)
+        self.assertEqual(minify_css(versioned), versioned)
+
+class MinifyTestCase(unittest.TestCase):
+
+    """Tests the minify hook and the cache it keeps"""
+
+    def setUp(self):
+        """Makes a package with a few scripts in it"""
+        self.temp_dir = mkdtemp()
+        self.js_dir = os.path.join(self.temp_dir, "working/assets/js")
+        os.makedirs(os.path.join(self.js_dir, "lib"))
+        self.scripts = {
+            "app.js": "var a = 1;\n\nfunction b(c) {\n    return c;\n}\n",
+            "lib/other.js": "/* other */\nvar d = 'e' ;\n",
+            "lib/jquery.min.js": "var  f=1;\n",
+        }
+        for name, contents in self.scripts.items():
+            open(os.path.join(self.js_dir, name), "w").write(contents)
+        self.global_config = {
+            "quiet": True,
+            "build_directory": os.path.join(self.temp_dir, "build"),
+            # the suite runs as it's imported, and pool workers would
+            # wait on the import lock for good
+            "minify_jobs": 1,
+        }
+        self.package_config = {
+            "working_dir": os.path.join(self.temp_dir, "working"),
+            "destination_mapping": {"root": "assets"},
+        }
+
+    def tearDown(self):
+        """Removes the package"""
+        shutil.rmtree(self.temp_dir)
+
+    def read_minified(self):
+        """Returns what each script was minified to"""
+        return dict([(name, open(os.path.join(self.js_dir,
+            name.replace(".js", "-minified.js"))).read())
+            for name in self.scripts])
+
+    def test_minify_and_cache(self):
+        """Test scripts are minified once and copied from the cache after"""
+        expected = {
+            "app.js": jsmin(self.scripts["app.js"]),
+            "lib/other.js": jsmin(self.scripts["lib/other.js"]),
+            "lib/jquery.min.js": self.scripts["lib/jquery.min.js"],
+        }
+        minify.javascript(self.global_config, self.package_config)
+        self.assertEqual(self.read_minified(), expected)
+
+        cache_directory = minify.get_minify_cache_directory(
+            self.global_config
+        )
+        cached = []
+        for path, dirs, files in os.walk(cache_directory):
+            cached += [open(os.path.join(path, name)).read()
+                for name in files]
+        self.assertEqual(
+            sorted(cached),
+            sorted([expected["app.js"], expected["lib/other.js"]])
+        )
+
+        # a cached script is copied rather than minified again
+        for path, dirs, files in os.walk(cache_directory):
+            for name in files:
+                open(os.path.join(path, name), "w").write("cached")
+        minify.javascript(self.global_config, self.package_config)
+        self.assertEqual(self.read_minified()["app.js"], "cached")
+
+    def test_minify_css_hook(self):
+        """Test stylesheets go through the same machinery"""
+        css_dir = os.path.join(self.temp_dir, "working/assets/css")
+        os.makedirs(css_dir)
+        contents = "a {\n    background: url(a.png) ;\n}\n"
+        open(os.path.join(css_dir, "site.css"), "w").write(contents)
+        minify.css(self.global_config, self.package_config)
+        self.assertEqual(
+            open(os.path.join(css_dir, "site-minified.css")).read(),
+            minify_css(contents)
+        )
+
+    def test_concat_bundle(self):
+        """Test bundles are cached and minified a file at a time"""
+        branch = os.path.join(self.temp_dir, "branch")
+        os.makedirs(branch)
+        for name, contents in [("one.js", "var one = 1 ;\n"),
+            ("two.js", "var two = 2 ;\n")]:
+            open(os.path.join(branch, name), "w").write(contents)
+        self.global_config["base_path"] = branch
+        self.package_config["package"] = "package"
+        self.package_config["concat_js"] = {
+            "js/bundle.js": ["one.js", "two.js"]
+        }
+        bundle = os.path.join(self.js_dir, "bundle.js")
+
+        concat.js(self.global_config, self.package_config)
+        self.assertEqual(
+            open(bundle).read(),
+            "var one = 1 ;\nvar two = 2 ;\n"
+        )
+
+        # an unchanged bundle is copied from the cache
+        cache_directory = concat.get_bundle_cache_directory(
+            self.global_config
+        )
+        for path, dirs, files in os.walk(cache_directory):
+            for name in files:
+                open(os.path.join(path, name), "w").write("cached")
+        concat.js(self.global_config, self.package_config)
+        self.assertEqual(open(bundle).read(), "cached")
+
+        minify.javascript(self.global_config, self.package_config)
+        self.assertEqual(
+            open(os.path.join(self.js_dir, "bundle-minified.js")).read(),
+            "var one=1;\nvar two=2;"
+        )
+
+    def test_bundle_boundaries(self):
+        """Test files joined a line apart run as they did concatenated
+
+        A file ending without a semicolon is followed by one starting with
+        a bracket, and one ending without a newline by one starting with
+        an operator, which only works as a line of its own.
+
+        """
+        branch = os.path.join(self.temp_dir, "branch")
+        os.makedirs(branch)
+        scripts = [
+            ("one.js", "var one = 1\n"),
+            ("two.js", "(function () {\n    two = 2\n})()\n"),
+            ("three.js", "var three = 3"),
+            ("four.js", "++four\n"),
+        ]
+        for name, contents in scripts:
+            open(os.path.join(branch, name), "w").write(contents)
+        self.global_config["base_path"] = branch
+        self.package_config["package"] = "package"
+        self.package_config["concat_js"] = {
+            "js/bundle.js": [name for name, contents in scripts]
+        }
+        concat.js(self.global_config, self.package_config)
+        minify.javascript(self.global_config, self.package_config)
+
+        minified = open(
+            os.path.join(self.js_dir, "bundle-minified.js")
+        ).read()
+        self.assertEqual(
+            minified,
+            "var one=1\n(function(){two=2})()\nvar three=3\n++four"
+        )
+        # the same as minifying the whole bundle up to three.js, where the
+        # bundle itself runs on into four.js
+        self.assertEqual(
+            minified.split("\nvar three")[0],
+            jsmin("".join([contents for name, contents in scripts[:2]]))
+        )
+
+    def test_run_jobs(self):
+        """Test jobs are spread over a pool and come back in order"""
+        pools = []
+        class Pool(object):
+            """Records what it's asked to do and does it in process"""
+            def __init__(self, processes):
+                self.processes = processes
+                self.calls = []
+                pools.append(self)
+            def map(self, function, jobs):
+                self.calls.append("map")
+                return map(function, jobs)
+            def close(self):
+                self.calls.append("close")
+            def terminate(self):
+                self.calls.append("terminate")
+            def join(self):
+                self.calls.append("join")
+
+        jobs = [(minify_javascript, os.path.join(self.js_dir, name), None,
+            None) for name in ("app.js", "lib/other.js")]
+        self.global_config["minify_jobs"] = 4
+        pool = minify.multiprocessing.Pool
+        minify.multiprocessing.Pool = Pool
+        try:
+            results = minify.run_jobs(self.global_config, jobs)
+            self.assertEqual(
+                [contents for seconds, contents in results],
+                [jsmin(self.scripts["app.js"]),
+                    jsmin(self.scripts["lib/other.js"])]
+            )
+            self.assertEqual(pools[0].processes, 2)
+            self.assertEqual(pools[0].calls, ["map", "close", "join"])
+
+            self.assertRaises(IOError, minify.run_jobs, self.global_config,
+                jobs + [(minify_javascript, "missing.js", None, None)])
+            self.assertEqual(pools[1].calls, ["map", "terminate", "join"])
+        finally:
+            minify.multiprocessing.Pool = pool
+
+    def test_is_minified(self):
+        """Test minified scripts are told apart by name or long lines"""
+        self.assertTrue(minify.is_minified("a.min.js", "var a = 1;\n"))
+        self.assertTrue(minify.is_minified("a.js", "var a=1;" * 100))
+        self.assertFalse(minify.is_minified("a.js", "  var a=1;" * 100))
+        self.assertFalse(minify.is_minified("a.js", "var a = 1;\n"))
+
+class ImportsTestCase(unittest.TestCase):
+
+    """Tests @imports are flattened"""
+
+    def setUp(self):
+        """Makes a package with some stylesheets importing others"""
+        self.temp_dir = mkdtemp()
+        self.css_dir = os.path.join(self.temp_dir, "working/assets/css")
+        os.makedirs(os.path.join(self.css_dir, "lib"))
+        self.write("main.css", '@charset "utf-8";\n'
+            '/* main */\n@import "lib/base.css";\n'
+            '@import url(reset.css);\nbody { color: red }\n')
+        self.write("lib/base.css", '@charset "utf-8";\n'
+            'a { background: url("../../img/a.png") }\n'
+            'b { background: url(http://example.com/b.png) }\n')
+        self.write("reset.css", "* { margin: 0 }\n")
+        self.write("print.css", '@import "reset.css" print;\n')
+        self.write("loop.css", '@import "lib/loop.css";\n')
+        self.write("lib/loop.css", '@import "../loop.css";\n')
+        self.global_config = {
+            "quiet": True,
+            "build_directory": os.path.join(self.temp_dir, "build"),
+        }
+        self.package_config = {
+            "package": "package",
+            "working_dir": os.path.join(self.temp_dir, "working"),
+            "destination_mapping": {"root": "assets"},
+        }
+
+    def tearDown(self):
+        """Removes the package"""
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, contents):
+        """Writes a stylesheet"""
+        open(os.path.join(self.css_dir, name), "w").write(contents)
+
+    def read(self, name):
+        """Reads a stylesheet"""
+        return open(os.path.join(self.css_dir, name)).read()
+
+    def test_flatten_css(self):
+        """Test imports are inlined with their urls moved"""
+        imports.flatten_css(self.global_config, self.package_config)
+        self.assertEqual(self.read("main.css"), '@charset "utf-8";\n'
+            '/* main */\n'
+            'a { background: url("../img/a.png") }\n'
+            'b { background: url(http://example.com/b.png) }\n'
+            '* { margin: 0 }\n'
+            'body { color: red }\n')
+        self.assertEqual(
+            self.read("print.css"),
+            '@import "reset.css" print;\n'
+        )
+        self.assertEqual(self.read("loop.css"), '@import "lib/loop.css";\n')
+
+    def test_flatten_cache(self):
+        """Test what's flattened is kept until a stylesheet in it changes"""
+        main = self.read("main.css")
+        imports.flatten_css(self.global_config, self.package_config)
+        filename = imports.get_flatten_cache_filename(
+            self.global_config,
+            self.package_config
+        )
+        snapshot = read_pickle(filename)
+        self.assertEqual(
+            [name for name, digest in snapshot["stylesheets"]["main.css"][0]],
+            ["lib/base.css", "main.css", "reset.css"]
+        )
+
+        # the next build starts from what's in the branch again
+        self.write("main.css", main)
+        snapshot["stylesheets"]["main.css"] = (
+            snapshot["stylesheets"]["main.css"][0],
+            "cached"
+        )
+        write_pickle(filename, snapshot)
+        imports.flatten_css(self.global_config, self.package_config)
+        self.assertEqual(self.read("main.css"), "cached")
+
+        self.write("main.css", main)
+        self.write("reset.css", "* { padding: 0 }\n")
+        imports.flatten_css(self.global_config, self.package_config)
+        self.assertTrue("* { padding: 0 }\n" in self.read("main.css"))
+
+class FingerprintTestCase(unittest.TestCase):
+
+    """Tests assets are versioned by what's in them"""
+
+    def setUp(self):
+        """Makes a package with a stylesheet using an image and another"""
+        self.temp_dir = mkdtemp()
+        self.asset_dir = os.path.join(self.temp_dir, "working/assets")
+        os.makedirs(os.path.join(self.asset_dir, "css"))
+        os.makedirs(os.path.join(self.asset_dir, "img"))
+        self.write("img/a.png", "PNG" * 100)
+        self.write("css/main.css", '@import "other.css";\n'
+            'body { background: url(../img/a.png) }\n')
+        self.write("css/other.css", 'a { background: url("../img/a.png") }\n')
+        self.global_config = {
+            "quiet": True,
+            "asset_versioning": "fingerprint",
+            "base_path": os.path.join(self.temp_dir, "branch"),
+            "destination_mapping": {"assets": ""},
+            "reverse_destination_mapping": {},
+        }
+        self.package_config = {
+            "package": "package",
+            "version": "1.0",
+            "working_dir": os.path.join(self.temp_dir, "working"),
+            "destination_mapping": {"root": "assets"},
+        }
+
+    def tearDown(self):
+        """Removes the package"""
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, name, contents):
+        """Writes an asset"""
+        open(os.path.join(self.asset_dir, name), "w").write(contents)
+
+    def read(self, name):
+        """Reads an asset"""
+        return open(os.path.join(self.asset_dir, name)).read()
+
+    def test_fingerprint_file(self):
+        """Test big files are hashed the same through mmap"""
+        path = os.path.join(self.asset_dir, "img/a.png")
+        mmap_size = version.MMAP_SIZE
+        try:
+            version.MMAP_SIZE = 1
+            self.assertEqual(
+                version.fingerprint_file(path),
+                version.fingerprint(self.read("img/a.png"))
+            )
+        finally:
+            version.MMAP_SIZE = mmap_size
+        self.assertEqual(version.fingerprint_file(path + ".missing"), None)
+
+    def test_fingerprint_css(self):
+        """Test stylesheets are versioned by what's in them once rewritten"""
+        version.assets(self.global_config, self.package_config)
+        asset_versions = self.package_config["asset_versions"]
+        image = version.fingerprint(self.read("img/a.png"))
+        self.assertEqual(asset_versions["/assets/img/a.png"], image)
+
+        version.add_versions_to_css(self.global_config, self.package_config)
+        other = self.read("css/other.css")
+        self.assertEqual(
+            other,
+            'a { background: url("/%s/assets/img/a.png") }\n' % image
+        )
+        asset_versions = self.package_config["asset_versions"]
+        self.assertEqual(
+            asset_versions["/assets/css/other.css"],
+            version.fingerprint(other)
+        )
+        self.assertEqual(self.read("css/main.css"),
+            '@import "/%s/assets/css/other.css";\n'
+            'body { background: url(/%s/assets/img/a.png) }\n' % (
+                version.fingerprint(other),
+                image
+            )
+        )
+        self.assertEqual(
+            asset_versions["/assets/css/main.css"],
+            version.fingerprint(self.read("css/main.css"))
+        )
+
+TEST_SUITE = unittest.TestLoader().loadTestsFromTestCase(JavascriptTestCase)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(StylesheetTestCase)
+)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(MinifyTestCase)
+)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(ImportsTestCase)
+)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(FingerprintTestCase)
+)
+unittest.TextTestRunner(verbosity=2).run(TEST_SUITE)
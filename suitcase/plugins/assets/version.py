@@ -1,28 +1,149 @@
-"""Versioning of assets"""
+"""Versioning of assets
+
+Assets are versioned by the revision the version control system has for
+them, or with asset_versioning set to fingerprint by a hash of what's in
+them, so nothing is asked of the version control system and an asset's
+version only changes when it does.
+
+"""
 
 import os
 import re
+import mmap
 import pprint
+import hashlib
+from multiprocessing.pool import ThreadPool
 
-from suitcase.exceptions import SuitcaseVcsError, SuitcasePackagingError
+from suitcase.exceptions import SuitcasePackagingError
+from suitcase.utils.copy import break_link
 
 from suitcase.utils.common import (
-    get_dynamic_class_instance, 
+    get_vcs_instance,
     remove_leading_slash, 
     display_warning
 )
 
 ASSET_REGEX = re.compile('^(.*?(?:url\\((?:[\'"])?|["\']))(?P<path>.*\\.(?:jpe?g|png|gif|js|css))((?:\\)|["\']{1}).*?)$', re.MULTILINE)
 
+# how many hex digits of a fingerprint make the version
+FINGERPRINT_LENGTH = 12
+# files at least this big are hashed through mmap rather than read in
+MMAP_SIZE = 1024 * 1024
+FINGERPRINT_THREADS = 4
+
+def is_fingerprinting(global_config):
+    """Checks for assets being versioned by what's in them"""
+    return global_config.get("asset_versioning", "vcs") == "fingerprint"
+
+def fingerprint(contents):
+    """Returns the version for an asset with contents"""
+    return hashlib.sha1(contents).hexdigest()[:FINGERPRINT_LENGTH]
+
+def fingerprint_file(path):
+    """Returns the version for the asset at path, None if it can't be read
+
+    Big files are mapped into memory rather than read, so they're hashed
+    straight from the page cache.
+
+    """
+    try:
+        asset_file = open(path, "rb")
+        try:
+            if os.fstat(asset_file.fileno()).st_size < MMAP_SIZE:
+                return fingerprint(asset_file.read())
+            mapped = mmap.mmap(
+                asset_file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+            try:
+                return fingerprint(mapped)
+            finally:
+                mapped.close()
+        finally:
+            asset_file.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+def fingerprint_files(global_config, paths):
+    """Returns the version of each asset in paths
+
+    hashlib lets go of the GIL while it hashes, so files are hashed by
+    fingerprint_threads threads at once.
+
+    """
+    paths = list(set(paths))
+    threads = min(
+        int(global_config.get("fingerprint_threads") or FINGERPRINT_THREADS),
+        len(paths)
+    )
+    if threads < 2:
+        return dict([(path, fingerprint_file(path)) for path in paths])
+
+    pool = ThreadPool(threads)
+    try:
+        return dict(zip(paths, pool.map(fingerprint_file, paths)))
+    finally:
+        pool.close()
+        pool.join()
+
+def find_branch_path(global_config, file_path):
+    """Maps a path in the working dir back to where it lives in the branch
+
+    Walks up file_path until a reverse destination mapping is found, returns
+    None if there isn't one.
+
+    """
+    branch_path = file_path
+    while len(branch_path) > 0:
+        if global_config["reverse_destination_mapping"].get(branch_path):
+
+            remainder = file_path.replace(branch_path, "")
+            remainder = remove_leading_slash(remainder)
+
+            return os.path.join(
+                global_config["base_path"],
+                global_config["reverse_destination_mapping"][branch_path],
+                remainder
+            )
+
+        branch_path = "/".join(branch_path.split("/")[:-1])
+
+    return None
+
+def write_asset_versions(package_config, asset_versions):
+    """Writes asset_versions out to the package's config, returns where"""
+
+    asset_version_file = os.path.join(
+        package_config["working_dir"], 
+        "etc/suitcase/asset_versions/",
+        "%s.py"%package_config["package"]
+    )
+    
+    asset_version_dir = os.path.split(asset_version_file)[0]
+    
+    if not os.path.exists(asset_version_dir):
+        try:
+            os.makedirs(asset_version_dir)
+        except OSError, error:
+            raise SuitcasePackagingError(error)
+        
+    break_link(asset_version_file)
+    open(asset_version_file,"w").write(
+        "asset_versions=%s" % pprint.pformat(asset_versions)
+    )
+    return asset_version_file
+
 def assets(global_config, package_config):
 
-    """Generates a dictionary of asset versions"""
+    """Generates a dictionary of asset versions
 
-    vcs = global_config.get('version_control')
-    if vcs:
-        # dynamically import the vcs code
-        vcs_module = 'suitcase.vcs.%s' % vcs
-        vcs_instance = get_dynamic_class_instance(vcs_module, vcs.capitalize())
+    Fingerprinted assets are each versioned by what's in them, minified
+    ones included.
+
+    """
+
+    fingerprinting = is_fingerprinting(global_config)
 
     asset_dir = os.path.abspath(
         os.path.join(package_config["working_dir"],
@@ -32,6 +153,11 @@ def assets(global_config, package_config):
     target_dir = os.path.abspath(os.path.join(asset_dir,"../"))
     if os.path.exists(target_dir):
         asset_versions = {}
+
+        # Map every asset back to its branch path first so that all of the
+        # versions can be fetched from the VCS in a single bulk lookup
+        branch_paths = {}
+        working_paths = {}
         for path, dirs, files in os.walk(target_dir):
             if 'tiny_mce' in dirs:
                 dirs.remove('tiny_mce')
@@ -40,26 +166,18 @@ def assets(global_config, package_config):
                 original_path = os.path.join(path, file_path)
                 original_path = original_path.replace(target_dir, "")
                 
-                file_path = os.path.join(path, file_path)\
-                    .replace(package_config["working_dir"], "")
-
-                branch_path = file_path
-                while len(branch_path) > 0:
-                    if global_config["reverse_destination_mapping"]\
-                        .get(branch_path):
-                        
-                        remainder = file_path.replace(branch_path, "")
-                        remainder = remove_leading_slash(remainder)
-
-                        file_path = os.path.join(
-                            global_config["base_path"],
-                            global_config["reverse_destination_mapping"]\
-                                [branch_path],
-                            remainder
-                        )
-                        
-                        break
-                    branch_path = "/".join(branch_path.split("/")[:-1])    
+                file_path = os.path.join(path, file_path)
+                if fingerprinting:
+                    working_paths[original_path] = file_path
+                    continue
+
+                file_path = file_path.replace(
+                    package_config["working_dir"],
+                    ""
+                )
+
+                file_path = find_branch_path(global_config, file_path) or \
+                    file_path
 
                 non_minified_file = file_path.replace('-minified.js', '.js')
                 if file_path.endswith("-minified.js") and \
@@ -67,38 +185,37 @@ def assets(global_config, package_config):
 
                     file_path = non_minified_file
 
-                try:
-                    version = vcs_instance.get_directory_revision(file_path)
-                    
-                except SuitcaseVcsError:
-                    display_warning(
-                        "Suitcase Warning: Can't find version "\
-                        "for %s setting to package version: %s" % \
-                        (original_path,package_config["version"])
-                    )
-                    version = package_config["version"]
+                branch_paths[original_path] = file_path
+
+        if fingerprinting:
+            versions = fingerprint_files(
+                global_config,
+                working_paths.values()
+            )
+            branch_paths = working_paths
+        else:
+            versions = get_vcs_instance(global_config).get_revisions(
+                branch_paths.values()
+            )
+
+        for original_path, file_path in branch_paths.items():
+            version = versions.get(file_path)
+            if version is None:
+                display_warning(
+                    "Suitcase Warning: Can't find version "\
+                    "for %s setting to package version: %s" % \
+                    (original_path,package_config["version"])
+                )
+                version = package_config["version"]
 
-                asset_versions[original_path] = version
+            asset_versions[original_path] = version
 
         asset_versions[asset_dir.replace(target_dir, "")] = \
             package_config["version"]
-        
-        asset_version_file = os.path.join(
-            package_config["working_dir"], 
-            "etc/suitcase/asset_versions/",
-            "%s.py"%package_config["package"]
-        )
-        
-        asset_version_dir = os.path.split(asset_version_file)[0]
-        
-        if not os.path.exists(asset_version_dir):
-            try:
-                os.makedirs(asset_version_dir)
-            except OSError, error:
-                raise SuitcasePackagingError(error)
-            
-        open(asset_version_file,"w").write(
-            "asset_versions=%s" % pprint.pformat(asset_versions)
+
+        asset_version_file = write_asset_versions(
+            package_config,
+            asset_versions
         )
          
         package_config["configs"] = package_config.get("configs", [])
@@ -112,60 +229,52 @@ def add_versions_to_css(global_config, package_config):
     """Changes the version of each asset
     
     found in the CSS file with the latest version out of the VCS
+
+    Fingerprinted stylesheets change when the versions in them do, so
+    they're fingerprinted again once rewritten and rewritten again until
+    the versions of those used by others stop changing.
     
     """
 
-    vcs = global_config.get('version_control')
-    if vcs:
-        # dynamically import the vcs code
-        vcs_module = 'suitcase.vcs.%s' % vcs
-        vcs_instance = get_dynamic_class_instance(vcs_module, vcs.capitalize())
-
+    fingerprinting = is_fingerprinting(global_config)
 
-    def add_asset_version_to_path(match):
-        
-        """Callback to make this a one-pass replace"""
-        
-        version_path = os.path.abspath(
-            os.path.join(
-                path, 
-                match.group("path")
-            )).replace(package_config["working_dir"], 
+    def get_version_path(asset_path):
+        """Returns the path of an asset in the working dir"""
+        return os.path.abspath(asset_path).replace(
+            package_config["working_dir"], 
             ""
         )
-        
-        branch_path = version_path
-        
-        while len(branch_path) > 0:
-            if global_config["reverse_destination_mapping"].\
-                get(branch_path):
-                
-                remainder = version_path.replace(branch_path,"")
-                remainder = remove_leading_slash(remainder)
-                branch_path = os.path.join(
-                    global_config["base_path"],
-                    global_config["reverse_destination_mapping"][branch_path],
-                    remainder
-                )
-                break
-                
-            branch_path = "/".join(branch_path.split("/")[:-1])    
 
-        new_path = version_path.replace(
+    def get_new_path(version_path):
+        """Returns the path an asset is versioned by"""
+        return version_path.replace(
             global_config["destination_mapping"]["assets"],
             "",
         )
-        version = None
 
-        if package_config.get("asset_versions"):
-            version = package_config["asset_versions"].get(new_path)
+    def find_asset_paths(path, match):
+        """Works out the packaged and branch paths of an asset"""
 
-        if version is None:
-            try:
-                version = vcs_instance.get_directory_revision(file_path)
-            except SuitcaseVcsError:
-                version = package_config["version"]
+        version_path = get_version_path(
+            os.path.join(
+                path, 
+                match.group("path")
+            )
+        )
 
+        # walk up version path to find which branch area its in
+        branch_path = find_branch_path(global_config, version_path)
+
+        return get_new_path(version_path), branch_path
+
+    def add_asset_version_to_path(path, match):
+        
+        """Callback to make this a one-pass replace"""
+
+        new_path, branch_path = find_asset_paths(path, match)
+        version = asset_versions.get(new_path) or \
+            branch_versions.get(branch_path) or \
+            package_config["version"]
 
         return "%s/%s%s%s" % (
             match.group(1), 
@@ -174,8 +283,6 @@ def add_versions_to_css(global_config, package_config):
             match.group(3)
         )
 
-        # walk up version path to find which svn area its in
-
     top_level = os.path.join(
         package_config["working_dir"],
         package_config["destination_mapping"]["root"]
@@ -183,15 +290,75 @@ def add_versions_to_css(global_config, package_config):
 
     target_dir = os.path.join(top_level,"css")
 
+    css_files = []
     for path, dirs, files in os.walk(target_dir):
         for file_path in files:
             full_path = os.path.join(path, file_path)
             if file_path.endswith(".css") and not "admin" in full_path:
+                css_files.append((path, full_path, open(full_path).read()))
+
+    # Look up every asset that the assets hook didn't version in one go
+    asset_versions = dict(package_config.get("asset_versions") or {})
+    branch_paths = []
+    # assets that aren't in the working dir are fingerprinted in the branch
+    asset_paths = {}
+    for path, css_file, contents in css_files:
+        for match in ASSET_REGEX.finditer(contents):
+            new_path, branch_path = find_asset_paths(path, match)
+            if asset_versions.get(new_path) is not None:
+                continue
+            asset_path = os.path.join(path, match.group("path"))
+            if fingerprinting and os.path.isfile(asset_path):
+                asset_paths[new_path] = asset_path
+            elif branch_path:
+                branch_paths.append(branch_path)
+                if fingerprinting:
+                    asset_paths[new_path] = branch_path
+
+    if fingerprinting:
+        branch_versions = {}
+        versions = fingerprint_files(global_config, asset_paths.values())
+        for new_path, asset_path in asset_paths.items():
+            if versions.get(asset_path):
+                asset_versions[new_path] = versions[asset_path]
+    else:
+        branch_versions = get_vcs_instance(global_config).get_revisions(
+            branch_paths
+        )
+
+    # a stylesheet used by another one only gets its version once it's
+    # rewritten, those using each other never settle so it's given up on
+    rounds = fingerprinting and len(css_files) + 1 or 1
+    for attempt in range(rounds):
+        rewritten = []
+        for path, css_file, contents in css_files:
+            rewritten.append((css_file, ASSET_REGEX.sub(
+                lambda match: add_asset_version_to_path(path, match),
+                contents
+            )))
+        if not fingerprinting:
+            break
+
+        changed = False
+        for css_file, contents in rewritten:
+            new_path = get_new_path(get_version_path(css_file))
+            version = fingerprint(contents)
+            if asset_versions.get(new_path) != version:
+                asset_versions[new_path] = version
+                changed = True
+        if not changed:
+            break
+
+    for css_file, contents in rewritten:
+        break_link(css_file)
+        css_file_handle = open(css_file,"w")
+        css_file_handle.write(contents)
+        css_file_handle.close()
+
+    if fingerprinting and package_config.get("asset_versions") is not None:
+        package_config["asset_versions"] = asset_versions
+        write_asset_versions(package_config, asset_versions)
 
-                css_file = full_path
-                css_file_handle = open(css_file)
-                contents = css_file_handle.read()
-                contents = ASSET_REGEX.sub(add_asset_version_to_path, contents)
-                css_file_handle = open(css_file,"w")
-                css_file_handle.write(contents)
-                css_file_handle.close()
+# only the stylesheets have to be in the working dir when files are streamed,
+# assets walks every file so it doesn't say
+add_versions_to_css.materialize = ["*.css"]
@@ -8,7 +8,7 @@ def create_directory(global_config, package_config):
     Set 'dir_to_create' in your package config
     """
     directory_to_create = package_config["directory_to_create"]
-    run_fakeroot("mkdir -p %s" % directory_to_create)
+    run_fakeroot(["mkdir", "-p", directory_to_create])
 
 def chown_directory(global_config, package_config):
     """
@@ -20,4 +20,11 @@ def chown_directory(global_config, package_config):
     chown_user = package_config["chown_user"]
     chown_directory = package_config["chown_directory"]
     
-    run_fakeroot("chown %s %s" % (chown_user, chown_directory))
\ No newline at end of file
+    run_fakeroot(["chown", chown_user, chown_directory])
+
+# neither hook needs any files in the working dir
+create_directory.materialize = []
+chown_directory.materialize = []
+# both only depend on the package config
+create_directory.cacheable = True
+chown_directory.cacheable = True
@@ -41,3 +41,9 @@ def generate_depends(global_config, package_config):
         )
     
     return package_config
+
+# only looks at the branch
+generate_depends.materialize = []
+# only checks for the app's assets and templates dirs alongside it, so runs
+# before builds are ordered
+generate_depends.discovery = True
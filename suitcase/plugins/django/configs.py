@@ -6,6 +6,7 @@ from suitcase.packing.debian import Debian
 from suitcase.utils.common import (
     relative_import, 
     dynamic_import,
+    get_vcs_instance,
     merge_and_de_dupe,
     display_warning
 )
@@ -49,14 +50,14 @@ def generate_depends(global_config, package_config):
                         global_config.get("package_name_filters")
                     )
                     
-                    # work out migration package
-                    migration_config = {
-                        "path":os.path.join(global_config["base_path"],"migrations")
-                    }
-                    
-                    migration_version = Debian(global_config).get_package_version(
-                        migration_config
+                    # work out migration package, the vcs memo means this
+                    # is only looked up once however many configs there are
+                    migration_path = os.path.join(
+                        global_config["base_path"],
+                        "migrations"
                     )
+                    migration_version = get_vcs_instance(global_config)\
+                        .get_directory_revision(migration_path)
                     
                     package_config["depends"] = merge_and_de_dupe(
                         package_config["depends"],
@@ -121,3 +122,8 @@ def generate_depends(global_config, package_config):
 
     return package_config
 
+# only looks at the branch
+generate_depends.materialize = []
+# the settings it imports and the migrations revision it looks up are in
+# the branch, so it runs before builds are ordered
+generate_depends.discovery = True
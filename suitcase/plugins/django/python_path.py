@@ -9,6 +9,9 @@ def chown(global_config, package_config):
     """Special chown for python path"""
     source_dir = package_config["working_dir"]
     uploaded_dir = os.path.join(source_dir, "uploaded")
-    run_fakeroot("chgrp -R www-data %s" % uploaded_dir)
-    run_fakeroot("chmod g+sw %s" % uploaded_dir)
+    run_fakeroot(["chgrp", "-R", "www-data", uploaded_dir])
+    run_fakeroot(["chmod", "g+sw", uploaded_dir])
 
+# fakeroot can only record the owners of files that are in the working dir
+chown.materialize = ["/uploaded"]
+chown.cacheable = True
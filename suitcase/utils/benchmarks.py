@@ -0,0 +1,117 @@
+"""Times the package dir walker against os.walk
+
+Lays out a throwaway tree laid out like a branch of packages, with a
+package conf in some dirs, collections mapped onto others and excluded dirs
+scattered through it, then finds the package dirs the way suitcase used to
+and with the walker. The default tree has 500,000 files in it. Run it
+directly:
+
+    python suitcase/utils/benchmarks.py --dirs 5000 --files 100
+
+"""
+
+import os
+import time
+import shutil
+from optparse import OptionParser
+from tempfile import mkdtemp
+
+from suitcase.utils.walker import walk_package_dirs, scandir
+
+CONF_NAME = "debian.yml"
+EXCLUSIONS = ["tests", ".svn", "*.egg-info"]
+
+def create_tree(directory, dir_count, file_count):
+    """Lays out dir_count package dirs of file_count files each
+
+    Returns the collection mapping, every tenth dir belongs to one.
+
+    """
+    collection_mapping = {}
+    for dir_index in range(dir_count):
+        path = "apps/group%03d/package%05d" % (dir_index / 100, dir_index)
+        package_dir = os.path.join(directory, path)
+        os.makedirs(os.path.join(package_dir, "tests"))
+        os.makedirs(os.path.join(package_dir, "package.egg-info"))
+        for file_index in range(file_count):
+            open(os.path.join(package_dir, "file%04d.py" % file_index), "w")\
+                .close()
+        if dir_index % 3 == 0:
+            open(os.path.join(package_dir, CONF_NAME), "w").close()
+        if dir_index % 10 == 0:
+            collection_mapping[path] = "collection"
+    return collection_mapping
+
+def walk_with_os_walk(directory, collection_mapping):
+    """The old way, os.walk and a stat and path lookup for each dir"""
+    exclusions = set(["tests", ".svn"])
+    found = []
+    for root, dirs, files in os.walk(directory):
+        for name in list(dirs):
+            if name in exclusions or name.endswith(".egg-info"):
+                dirs.remove(name)
+        collection = collection_mapping.get(
+            os.path.abspath(root).replace(directory, "")[1:]
+        )
+        has_conf = os.path.isfile(os.path.join(root, CONF_NAME))
+        found.append((root, has_conf, collection))
+    return found
+
+def walk_with_walker(directory, collection_mapping, threads):
+    """Walks with the walker"""
+    return walk_package_dirs(
+        directory,
+        CONF_NAME,
+        EXCLUSIONS,
+        directory,
+        collection_mapping,
+        threads
+    )
+
+def main():
+    """Builds the tree and times each way of walking it"""
+    parser = OptionParser()
+    parser.add_option("--dirs", type="int", default=5000,
+        help="number of package dirs to create")
+    parser.add_option("--files", type="int", default=100,
+        help="number of files in each package dir")
+    parser.add_option("--threads", type="int", default=4,
+        help="number of threads for the threaded walk")
+    (options, args) = parser.parse_args()
+
+    directory = os.path.realpath(mkdtemp())
+    try:
+        start = time.time()
+        collection_mapping = create_tree(
+            directory,
+            options.dirs,
+            options.files
+        )
+        print "Created %s files in %.1fs, scandir %s" % (
+            options.dirs * options.files,
+            time.time() - start,
+            scandir is None and "not available" or "available"
+        )
+
+        expected = None
+        for name, walk, args in [
+            ("os.walk", walk_with_os_walk, ()),
+            ("walker", walk_with_walker, (1,)),
+            ("walker, %s threads" % options.threads, walk_with_walker,
+                (options.threads,)),
+        ]:
+            start = time.time()
+            found = walk(directory, collection_mapping, *args)
+            seconds = time.time() - start
+            if expected is None:
+                expected = found
+            print "%-28s %8.3fs %s" % (
+                name,
+                seconds,
+                found == expected and "ok" or "DIFFERENT",
+            )
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
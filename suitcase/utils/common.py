@@ -2,11 +2,20 @@
 
 import os
 import sys
-import commands
 
-from suitcase.exceptions import SuitcaseImportError, SuitcaseCommandError
-from suitcase.utils.fakeroot import Fakeroot
+from suitcase.exceptions import (
+    SuitcaseImportError,
+    SuitcaseCommandError,
+    SuitcasePackagingError,
+)
+from suitcase.utils.fakeroot import get_session, end_session
+from suitcase.utils.runner import get_runner, get_command_name, NOT_FOUND
 from suitcase.utils.terminal import TerminalController
+from suitcase.vcs.cache import (
+    RevisionCache,
+    get_cache_directory,
+    is_cache_enabled,
+)
 
 def get_user_input(prompt, answers, default=None):
     """Wrapper to prompting for user input with optional default
@@ -53,21 +62,32 @@ def dynamic_import(module_string):
         )
 
 
-def run_command(command):
+def run_command(command, cwd=None, env=None, timeout=None):
     """Wraps running a command and raises an error if the cmd can't be found
 
-    Bash returns exit code of 127 if a command isn't found and > 0  if the
-    command has an error
+    command is a list of arguments, which is run without a shell, or a
+    string, which the shell parses. Returns the exit status and what was
+    printed, stderr included. Exit code 127 means the command wasn't
+    found and anything else above 0 is an error.
 
     """
-    result = commands.getstatusoutput(command)
-    if result[0] == 127:
-        command = command.split()[0]
-        raise SuitcaseCommandError(result, "%s not found" % command)
-    if result[0] > 0:
-        raise SuitcaseCommandError(result, "An error occurred: %s" % result[1])
+    result = get_runner().run(command, cwd, env, timeout, True)
+    output = (result.output or result.error_output).rstrip("\n")
+    status = (result.returncode, output)
+    if result.timed_out:
+        raise SuitcaseCommandError(status, "%s timed out after %ss" % (
+            get_command_name(command),
+            timeout or get_runner().timeout
+        ))
+    if result.returncode == NOT_FOUND:
+        raise SuitcaseCommandError(
+            status,
+            "%s not found" % get_command_name(command)
+        )
+    if result.returncode != 0:
+        raise SuitcaseCommandError(status, "An error occurred: %s" % output)
 
-    return result
+    return status
 
 
 def get_dynamic_class_instance(class_string, class_name,  *args, **kwargs):
@@ -81,6 +101,32 @@ def get_dynamic_class_instance(class_string, class_name,  *args, **kwargs):
             "in the '%s' module is '%s'" % (class_string, class_name))
 
 
+def get_vcs_instance(global_config):
+    """Returns the instance of the version control class in the config
+
+    The vcs classes are singletons so every caller shares one memo of the
+    revisions looked up in this run, and one persistent revision cache
+    unless it has been turned off.
+
+    """
+    vcs = global_config.get('version_control')
+    if not vcs:
+        raise SuitcasePackagingError("No version control system defined")
+
+    instance = get_dynamic_class_instance(
+        'suitcase.vcs.%s' % vcs,
+        vcs.capitalize()
+    )
+
+    if instance.cache is None and global_config.get("build_directory") and \
+        is_cache_enabled(global_config):
+        instance.set_cache(
+            RevisionCache(get_cache_directory(global_config))
+        )
+
+    return instance
+
+
 def relative_import(path, module_namespace):
     """Imports arbitrary paths as module_namespace
     
@@ -120,21 +166,17 @@ def add_trailing_slash(path):
     return (not path.endswith('/')) and "%s/" % path or path
 
 def run_fakeroot(args):
-    """run fakeroot"""
-    cache_filename = Fakeroot().cache_filename
-    fakeroot_command = ("fakeroot -i %s -s %s %s" % (
-        cache_filename,
-        cache_filename,
-        args
-    ))
-    run_command(fakeroot_command)
+    """Runs a command under fakeroot in the package's fakeroot session
+
+    args is a list of arguments or a string for the shell, as with
+    run_command.
+
+    """
+    return run_command(args, env=get_session().get_environment())
 
 def clean_fakeroot():
-    """Clean up fakeroot cache"""
-    filename = Fakeroot().cache_filename
-    if os.path.exists(filename):
-        run_command("rm %s" % filename)
-    del Fakeroot().cache_filename
+    """Ends the package's fakeroot session and throws its state away"""
+    end_session()
     
 def merge(*args):
     """Merges lists"""
@@ -0,0 +1,228 @@
+"""Loads yaml config files, keeping what was parsed between runs
+
+Configs are parsed with libyaml when pyyaml was built with it and kept in
+a snapshot in the build directory along with the size and mtime of the
+file they came from, so a file that hasn't changed since the last run
+isn't parsed again. The dirs collections' globs expand to are kept in the
+same snapshot along with the mtime of every directory that had to be
+listed to expand them, and are only expanded again once one changes.
+
+"""
+
+import os
+import glob
+import cPickle as pickle
+from tempfile import mkstemp
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from suitcase.exceptions import SuitcaseConfigurationError
+
+# bump when what's kept in the snapshot changes
+SNAPSHOT_VERSION = 1
+
+caches = {}
+
+def get_loader():
+    """Returns the libyaml loader if pyyaml has it, the python one if not"""
+    return getattr(yaml, "CLoader", yaml.Loader)
+
+def load_yaml(filename):
+    """Parses a yaml file"""
+    if yaml is None:
+        raise SuitcaseConfigurationError(
+            "pyyaml not installed, see http://pyyaml.org/wiki/PyYAML"
+        )
+    config_file = open(filename)
+    try:
+        return yaml.load(config_file, Loader=get_loader())
+    finally:
+        config_file.close()
+
+def expand_dirs(base_path, pattern):
+    """Expands a glob relative to base_path to the directories it matches
+
+    Returns the directories and what they were found from: the mtimes of
+    the directories that were listed for the wildcard parts of the glob
+    and whether the paths the plain parts led to were directories. The
+    result can only change if one of those does.
+
+    """
+    path = os.path.join(base_path, pattern)
+    parts = path.split("/")
+    if parts[0] == "":
+        candidates = ["/"]
+        parts = parts[1:]
+    else:
+        candidates = [""]
+
+    listed = {}
+    checked = {}
+    for part in parts:
+        if not part:
+            continue
+        matches = []
+        for directory in candidates:
+            if glob.has_magic(part):
+                try:
+                    listed[directory] = os.stat(directory or ".").st_mtime
+                except OSError:
+                    listed[directory] = None
+                    continue
+                matches += [os.path.join(directory, name)
+                    for name in glob.glob1(directory or ".", part)]
+            else:
+                candidate = os.path.join(directory, part)
+                checked[candidate] = os.path.isdir(candidate)
+                if checked[candidate]:
+                    matches.append(candidate)
+        candidates = matches
+
+    # glob leaves a trailing slash on
+    trailing = path.endswith("/") and "/" or ""
+    return ["%s%s" % (match, trailing) for match in sorted(candidates)
+        if os.path.isdir(match)], (listed, checked)
+
+def is_expansion_current(found_from):
+    """Checks nothing a glob was expanded from has changed since"""
+    (listed, checked) = found_from
+    for directory, mtime in listed.items():
+        try:
+            if os.stat(directory or ".").st_mtime != mtime:
+                return False
+        except OSError:
+            if mtime is not None:
+                return False
+    for candidate, is_dir in checked.items():
+        if os.path.isdir(candidate) != is_dir:
+            return False
+    return True
+
+def get_snapshot_filename(global_config):
+    """Returns where parsed configs are kept between runs"""
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "config"
+    )
+
+def is_config_cache_enabled(global_config):
+    """Checks the config for the config cache being turned off"""
+    return global_config.get("config_cache", True) and \
+        global_config.get("build_directory")
+
+def get_config_cache(global_config):
+    """Returns the config cache shared by everything in this run
+
+    None if it's turned off.
+
+    """
+    if not is_config_cache_enabled(global_config):
+        return None
+    filename = get_snapshot_filename(global_config)
+    if filename not in caches:
+        caches[filename] = ConfigCache(filename)
+    return caches[filename]
+
+class ConfigCache(object):
+
+    """Snapshot of parsed config files and expanded globs
+
+    Parsed configs are kept pickled so every caller gets a copy of its own
+    to change.
+
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.configs = {}
+        self.globs = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+        self.read()
+
+    def read(self):
+        """Loads the snapshot, anything unreadable counts as empty"""
+        try:
+            snapshot_file = open(self.filename, "rb")
+            try:
+                snapshot = pickle.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError, IndexError, TypeError):
+            return
+
+        if not isinstance(snapshot, dict) or \
+            snapshot.get("version") != SNAPSHOT_VERSION:
+            return
+        self.configs = snapshot["configs"]
+        self.globs = snapshot["globs"]
+
+    def load(self, filename):
+        """Returns the parsed config in filename"""
+        info = os.stat(filename)
+        signature = (info.st_size, info.st_mtime)
+        entry = self.configs.get(filename)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return pickle.loads(entry[1])
+
+        self.misses += 1
+        config = load_yaml(filename)
+        self.configs[filename] = (
+            signature,
+            pickle.dumps(config, pickle.HIGHEST_PROTOCOL)
+        )
+        self.changed = True
+        return config
+
+    def expand_dirs(self, base_path, pattern):
+        """Returns the directories a glob matches, see expand_dirs"""
+        key = (base_path, pattern)
+        entry = self.globs.get(key)
+        if entry is not None and is_expansion_current(entry[1]):
+            self.hits += 1
+            return list(entry[0])
+
+        self.misses += 1
+        self.globs[key] = expand_dirs(base_path, pattern)
+        self.changed = True
+        return list(self.globs[key][0])
+
+    def save(self):
+        """Writes the snapshot out atomically if anything was parsed
+
+        Files that have gone are dropped. It's only a cache so failing
+        to write it isn't an error.
+
+        """
+        if not self.changed:
+            return
+
+        for filename in self.configs.keys():
+            if not os.path.exists(filename):
+                del self.configs[filename]
+
+        directory = os.path.dirname(self.filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (handle, temp_filename) = mkstemp(dir=directory)
+            temp_file = os.fdopen(handle, "wb")
+            try:
+                pickle.dump({
+                    "version": SNAPSHOT_VERSION,
+                    "configs": self.configs,
+                    "globs": self.globs,
+                }, temp_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                temp_file.close()
+            os.rename(temp_filename, self.filename)
+        except (IOError, OSError):
+            return
+        self.changed = False
@@ -1,51 +1,647 @@
 """
-To start with I'm going to simply implement this as an rsync call.
+Copies files into the build directory the way rsync -r did
 
-Later this should be replaced by a recursive copy function using shutil.
+Exclusions are rsync style patterns and sources are copied with the same
+rules, but in-process, with a single walk for several sources and without
+copying files that are already there.
 
 """
 
 import os
+import re
+import stat
+import errno
+import fcntl
+import shutil
+import cPickle as pickle
+from tempfile import mkstemp
+from multiprocessing.pool import ThreadPool
 
-from suitcase.utils.common import run_command
 from suitcase.exceptions import SuitcaseCopyError
 
 DEBUG = False
 
-def copy_files(source, destination, exclusions=None):
+# files copied at once
+COPY_THREADS = 8
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# what happened to each file
+COPIED = "copied"
+LINKED = "linked"
+UNCHANGED = "unchanged"
+
+# Bits dpkg won't have set on anything in a package
+SET_ID_BITS = stat.S_ISUID | stat.S_ISGID
+
+# ioctl that clones a file's blocks into another (linux/fs.h)
+FICLONE = 0x40049409
+
+# devices that turned out not to support reflinks
+REFLINK_UNSUPPORTED = {}
+
+# what the ioctl fails with where it isn't supported
+REFLINK_ERRORS = (
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EBADF,
+)
+
+# what os.link fails with where files can't be hardlinked
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EACCES)
+
+def compile_patterns(patterns):
+    """Turns rsync style exclude patterns into regexes
+
+    A leading / anchors a pattern to the top of the transfer and a
+    trailing / means it only matches dirs. Patterns with a / in them are
+    matched against the end of the whole path, others just the name. *
+    doesn't match across a / but ** does.
+
+    """
+    rules = []
+    for pattern in patterns or []:
+        anchored = pattern.startswith("/")
+        dir_only = pattern.endswith("/")
+        pattern = pattern.strip("/")
+        whole_path = anchored or "/" in pattern or "**" in pattern
+
+        regex = ""
+        index = 0
+        while index < len(pattern):
+            if pattern.startswith("**", index):
+                regex += ".*"
+                index += 2
+                continue
+            char = pattern[index]
+            if char == "*":
+                regex += "[^/]*"
+            elif char == "?":
+                regex += "[^/]"
+            elif char == "[" and "]" in pattern[index + 1:]:
+                end = pattern.index("]", index + 1)
+                chars = pattern[index + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                regex += "[%s]" % chars
+                index = end
+            else:
+                regex += re.escape(char)
+            index += 1
+
+        if anchored:
+            regex = "^%s$" % regex
+        elif whole_path:
+            regex = "^(?:.*/)?%s$" % regex
+        else:
+            regex = "^%s$" % regex
+
+        rules.append((re.compile(regex), whole_path, dir_only))
+    return rules
+
+def is_excluded(relative_path, is_dir, rules):
+    """Checks a path relative to the top of a transfer against the rules"""
+    name = relative_path.split("/")[-1]
+    for (regex, whole_path, dir_only) in rules:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(whole_path and relative_path or name):
+            return True
+    return False
+
+def get_ancestors(path):
+    """Returns the dirs above path, nearest first"""
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent != path:
+        ancestors.append(parent)
+        path = parent
+        parent = os.path.dirname(path)
+    return ancestors
+
+def start_transfer(path, transfer):
+    """Begins a transfer at its source path
+
+    Returns what the source itself copies to, if anything, and where the
+    walk carries on below it, if it does.
+
+    """
+    (index, destination, rules, contents) = transfer
+    if contents and os.path.isdir(path):
+        return None, (index, rules, destination, "")
+
+    name = os.path.basename(path)
+    if os.path.islink(path):
+        return None, None
+    is_dir = os.path.isdir(path)
+    if is_excluded(name, is_dir, rules):
+        return None, None
+    target = os.path.join(destination, name)
+    if is_dir:
+        return (index, path, target, True), (index, rules, target, name)
+    if stat.S_ISREG(os.stat(path).st_mode):
+        return (index, path, target, False), None
+    return None, None
+
+def resolve_copies(transfers):
+    """Works out several copies with a single walk of their sources
+
+    transfers is a list of source, destination and exclusions as taken by
+    copy_files. Yields the index of the transfer along with the source
+    path, destination path and whether it's a dir for everything rsync -r
+    would transfer, parents before children. A source with a trailing
+    slash has its contents copied into destination, otherwise the source
+    itself is copied into it. Like rsync -r, symlinks and special files
+    are left out, as is anything excluded and everything below an excluded
+    dir. Sources inside another source are picked up as the walk reaches
+    them rather than walked again.
+
+    """
+    starts = {}
+    for index, (source, destination, exclusions) in enumerate(transfers):
+        if not os.path.exists(source):
+            raise SuitcaseCopyError('Source directory does not exist')
+        starts.setdefault(os.path.abspath(source), []).append((
+            index,
+            destination,
+            compile_patterns(exclusions),
+            source.endswith("/"),
+        ))
+
+    # only the outermost sources are walked, the dirs down to the others
+    # are walked through even if nothing in them is copied
+    roots = []
+    passages = {}
+    for top in sorted(starts):
+        ancestors = get_ancestors(top)
+        if not [parent for parent in ancestors if parent in starts]:
+            roots.append(top)
+            continue
+        for parent in ancestors:
+            if parent in starts:
+                break
+            passages[parent] = True
+
+    for root in roots:
+        active = []
+        for transfer in starts[root]:
+            (entry, state) = start_transfer(root, transfer)
+            if entry:
+                yield entry
+            if state:
+                active.append(state)
+
+        if not os.path.isdir(root):
+            continue
+
+        pending = [(root, active)]
+        while pending:
+            (directory, active) = pending.pop()
+            child_dirs = []
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                mode = os.lstat(path).st_mode
+                is_dir = stat.S_ISDIR(mode)
+                child_active = []
+                if is_dir or stat.S_ISREG(mode):
+                    for (index, rules, destination_dir, relative_dir) \
+                        in active:
+                        relative_path = relative_dir and \
+                            "%s/%s" % (relative_dir, name) or name
+                        if is_excluded(relative_path, is_dir, rules):
+                            continue
+                        target = os.path.join(destination_dir, name)
+                        yield index, path, target, is_dir
+                        if is_dir:
+                            child_active.append(
+                                (index, rules, target, relative_path)
+                            )
+
+                for transfer in starts.get(path, []):
+                    (entry, state) = start_transfer(path, transfer)
+                    if entry:
+                        yield entry
+                    if state:
+                        child_active.append(state)
+
+                if (is_dir or path in starts) and \
+                    (child_active or path in passages):
+                    child_dirs.append((path, child_active))
+            pending.extend(reversed(child_dirs))
+
+def resolve_copy(source, destination, exclusions=None):
+    """Works out what copy_files would copy without copying anything
+
+    Yields the source path, destination path and whether it's a dir, as
+    resolve_copies does for a single transfer.
+
+    """
+    for (index, path, target, is_dir) in resolve_copies(
+        [(source, destination, exclusions)]
+    ):
+        yield path, target, is_dir
+
+def plan_copies(transfers):
+    """Returns the dirs and files transfers copy, as source and destination
+
+    Where transfers overlap the last one wins, as it would copying them one
+    after the other. Dirs come parents first.
+
+    """
+    order = []
+    planned = {}
+    for (index, path, target, is_dir) in resolve_copies(transfers):
+        if target not in planned:
+            order.append(target)
+            planned[target] = (index, path, is_dir)
+        elif index >= planned[target][0]:
+            planned[target] = (index, path, is_dir)
+
+    dirs = []
+    files = []
+    for target in order:
+        (index, path, is_dir) = planned[target]
+        if is_dir:
+            dirs.append((path, target))
+        else:
+            files.append((path, target))
+    return dirs, files
+
+def matches_path(relative_path, rules):
+    """Checks whether a path or any dir above it matches the rules"""
+    parts = relative_path.strip("/").split("/")
+    for depth in range(1, len(parts) + 1):
+        if is_excluded("/".join(parts[:depth]), depth < len(parts), rules):
+            return True
+    return False
+
+def get_umask():
+    """Returns the process umask, which can only be read by setting it"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class CopyStats(object):
+
+    """What a copy did"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.linked = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def add(self, result):
+        """Counts a file from what copy_file or link_file returned"""
+        (how, size) = result
+        if how == COPIED:
+            self.files += 1
+            self.bytes += size
+        elif how == LINKED:
+            self.linked += 1
+        else:
+            self.unchanged += 1
+
+    def update(self, other):
+        """Adds in what another copy did"""
+        self.files += other.files
+        self.bytes += other.bytes
+        self.linked += other.linked
+        self.unchanged += other.unchanged
+        self.removed += other.removed
+
+    def __str__(self):
+        return "%d files (%d bytes) copied, %d linked, %d unchanged, "\
+            "%d removed" % (
+                self.files,
+                self.bytes,
+                self.linked,
+                self.unchanged,
+                self.removed,
+            )
+
+def make_dirs(transfers, dirs):
+    """Creates the destinations of transfers and the dirs copied into them
+
+    Copied dirs get their source's mode less the umask, including ones
+    that are already there.
+
+    """
+    umask = get_umask()
+    try:
+        for (source, destination, exclusions) in transfers:
+            if not os.path.isdir(destination):
+                os.makedirs(destination)
+        for (source, destination) in dirs:
+            mode = os.stat(source).st_mode & 07777 & ~umask
+            if not os.path.isdir(destination):
+                os.mkdir(destination)
+            elif stat.S_IMODE(os.stat(destination).st_mode) == mode:
+                continue
+            os.chmod(destination, mode)
+    except OSError, error:
+        raise SuitcaseCopyError(error)
 
-    """rsync copy of files from source to destination
+def is_unchanged(info, destination):
+    """Checks whether destination is already a copy of a file
 
-    This should be ideally replaced later with a recursive copy function
-    implemented in python.
+    info is the source's stat. Files the same size and age as the source
+    are taken to be copies of it, as rsync takes them to be, unless they're
+    hardlinked and so might be the branch's own files.
 
     """
+    try:
+        existing = os.lstat(destination)
+    except OSError:
+        return False
+    return stat.S_ISREG(existing.st_mode) and existing.st_nlink == 1 and \
+        existing.st_size == info.st_size and \
+        int(existing.st_mtime) == int(info.st_mtime)
 
-    if exclusions is None:
-        exclusions = []
+def copy_file(source, destination, umask):
+    """Copies a file's data, its mode less the umask, and its mtime
 
-    if not os.path.exists(source):
-        raise SuitcaseCopyError('Source directory does not exist')
+    Anything already at destination is replaced rather than written over,
+    in case it's linked to the branch. Returns COPIED or UNCHANGED and the
+    file's size.
 
-    if not os.path.isdir(destination):
+    """
+    info = os.stat(source)
+    mode = info.st_mode & 07777 & ~umask
+    if is_unchanged(info, destination):
+        # hooks may have changed the mode of a file kept from a last build
+        if stat.S_IMODE(os.lstat(destination).st_mode) != mode:
+            os.chmod(destination, mode)
+        return UNCHANGED, info.st_size
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    source_file = open(source, "rb")
+    try:
+        destination_file = open(destination, "wb")
+        try:
+            shutil.copyfileobj(source_file, destination_file, COPY_BUFFER_SIZE)
+        finally:
+            destination_file.close()
+    finally:
+        source_file.close()
+
+    os.chmod(destination, mode)
+    os.utime(destination, (info.st_atime, info.st_mtime))
+    return COPIED, info.st_size
+
+def reflink_file(source, destination):
+    """Clones source's data into a new file, returns False if it can't
+
+    The clone shares the source's blocks until either is written to, so it
+    costs next to nothing yet is a file of its own. Only some filesystems
+    (btrfs, xfs, ...) can do it, those that can't are remembered by device.
+
+    """
+    device = os.stat(source).st_dev
+    if device in REFLINK_UNSUPPORTED:
+        return False
+
+    source_file = open(source, "rb")
+    try:
+        destination_file = open(destination, "wb")
         try:
-            os.makedirs(destination)    
-        except OSError, error:
-            raise SuitcaseCopyError(error)
+            fcntl.ioctl(
+                destination_file.fileno(),
+                FICLONE,
+                source_file.fileno()
+            )
+            return True
+        except IOError, error:
+            if error.errno not in REFLINK_ERRORS:
+                raise
+            REFLINK_UNSUPPORTED[device] = True
+        finally:
+            destination_file.close()
+    finally:
+        source_file.close()
+
+    os.remove(destination)
+    return False
+
+def link_file(source, destination, umask):
+    """Puts source at destination without copying its data if it can
+
+    A reflink is used where the filesystem has them, otherwise a hardlink
+    as long as the source's mode is what a copy would get, as a hardlink
+    can't have a mode of its own. Files on another filesystem are copied.
+    Hardlinked files are the branch's files, anything changing them has to
+    call break_link first. Returns LINKED, COPIED or UNCHANGED and the
+    file's size.
+
+    """
+    info = os.stat(source)
+    existing = os.path.lexists(destination) and os.lstat(destination)
+    if existing and (existing.st_dev, existing.st_ino) == \
+        (info.st_dev, info.st_ino):
+        return UNCHANGED, info.st_size
+    if is_unchanged(info, destination):
+        return UNCHANGED, info.st_size
+    if existing:
+        os.remove(destination)
 
-    excludes_str = " ".join(
-        ["--exclude '%s'" % exclusion for exclusion in exclusions]
-    )
+    if info.st_dev == os.stat(os.path.dirname(destination)).st_dev:
+        if reflink_file(source, destination):
+            os.chmod(destination, info.st_mode & 07777 & ~umask)
+            os.utime(destination, (info.st_atime, info.st_mtime))
+            return LINKED, info.st_size
+
+        mode = stat.S_IMODE(info.st_mode)
+        # fakeroot's chmod really gives the owner read and write, and
+        # dpkg takes off setuid and setgid, so those must already be so
+        if mode == mode & ~umask & ~SET_ID_BITS | 0600:
+            try:
+                os.link(source, destination)
+                return LINKED, info.st_size
+            except OSError, error:
+                if error.errno not in LINK_ERRORS:
+                    raise
+
+    return copy_file(source, destination, umask)
+
+def break_link(path):
+    """Gives a file in the working dir an inode of its own
+
+    Hooks that change files in place call this first, so that a file
+    hardlinked from the branch by link staging isn't changed there too.
+
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return
+    if not stat.S_ISREG(info.st_mode) or info.st_nlink < 2:
+        return
+
+    directory = os.path.dirname(os.path.abspath(path))
+    (handle, temp_filename) = mkstemp(dir=directory)
+    try:
+        temp_file = os.fdopen(handle, "wb")
+        try:
+            source_file = open(path, "rb")
+            try:
+                shutil.copyfileobj(source_file, temp_file, COPY_BUFFER_SIZE)
+            finally:
+                source_file.close()
+        finally:
+            temp_file.close()
+        os.chmod(temp_filename, stat.S_IMODE(info.st_mode))
+        os.utime(temp_filename, (info.st_atime, info.st_mtime))
+        os.rename(temp_filename, path)
+    except (IOError, OSError), error:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise SuitcaseCopyError("Can't unlink %s: %s" % (path, error))
+
+def copy_file_list(files, threads=COPY_THREADS, copy=copy_file):
+    """Copies a list of source and destination files, returns a CopyStats
+
+    Small files are dominated by opening and closing them rather than by
+    moving data, so several are copied at once. copy is copy_file or
+    link_file.
+
+    """
+    umask = get_umask()
+
+    def copy_one(pair):
+        """Runs copy in a worker thread"""
+        (source, destination) = pair
+        try:
+            return copy(source, destination, umask)
+        except (IOError, OSError), error:
+            raise SuitcaseCopyError(
+                "Can't copy %s to %s: %s" % (source, destination, error)
+            )
+
+    if threads > 1 and len(files) > 1:
+        pool = ThreadPool(min(threads, len(files)))
+        try:
+            results = pool.map(copy_one, files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [copy_one(pair) for pair in files]
+
+    stats = CopyStats()
+    for result in results:
+        stats.add(result)
+    return stats
+
+def copy_transfers(transfers, threads=COPY_THREADS):
+    """Copies several sources with a single walk, returns a CopyStats
+
+    transfers is a list of source, destination and exclusions, each copied
+    as copy_files would.
+
+    """
+    (dirs, files) = plan_copies(transfers)
+    make_dirs(transfers, dirs)
 
     if DEBUG:
-        print "SOURCE: %s" % source
-        print "DEST: %s" % destination
+        for (source, destination, exclusions) in transfers:
+            print "SOURCE: %s" % source
+            print "DEST: %s" % destination
+
+    return copy_file_list(files, threads)
+
+def copy_files(source, destination, exclusions=None):
+    """Copies source into destination as rsync -r would
+
+    A trailing slash on source copies what's in it rather than the dir
+    itself. Returns a CopyStats.
+
+    """
+    return copy_transfers([(source, destination, exclusions)])
+
+def read_manifest(filename):
+    """Loads what write_manifest recorded, None if there's nothing usable"""
+    try:
+        manifest_file = open(filename, "rb")
+        try:
+            manifest = pickle.load(manifest_file)
+        finally:
+            manifest_file.close()
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+        AttributeError, ImportError, IndexError):
+        return None
+
+    if not isinstance(manifest, dict):
+        return None
+    return manifest
 
-    rsync_str = "/usr/bin/rsync -r %s '%s' '%s'" % (
-        excludes_str,
-        source,
-        destination
-    )
+def write_manifest(filename, directory):
+    """Records everything in directory, so it can be brought up to date
+
+    The manifest maps each path relative to directory to whether it's a
+    dir. It's written atomically.
+
+    """
+    manifest = {}
+    for path, dirs, files in os.walk(directory):
+        relative_dir = path[len(directory):].strip("/")
+        for name in dirs:
+            manifest[os.path.join(relative_dir, name)] = True
+        for name in files:
+            manifest[os.path.join(relative_dir, name)] = False
+
+    try:
+        (handle, temp_filename) = mkstemp(dir=os.path.dirname(filename))
+        manifest_file = os.fdopen(handle, "wb")
+        try:
+            pickle.dump(manifest, manifest_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            manifest_file.close()
+        os.rename(temp_filename, filename)
+    except (IOError, OSError), error:
+        raise SuitcaseCopyError(
+            "Can't write manifest %s: %s" % (filename, error)
+        )
+
+def remove_stale(directory, manifest, dirs, files):
+    """Removes what a manifest lists that the planned copies don't make
+
+    dirs and files are as plan_copies returns them. This takes out files
+    that have gone from the branch, as well as everything hooks and
+    packaging made last time so that they make it afresh. Returns a
+    CopyStats of what was removed.
+
+    """
+    directory = os.path.abspath(directory)
+    planned = {}
+    for (source, destination) in dirs:
+        planned[os.path.abspath(destination)[len(directory):].strip("/")] = \
+            True
+    for (source, destination) in files:
+        planned[os.path.abspath(destination)[len(directory):].strip("/")] = \
+            False
 
-    return run_command(rsync_str)
+    stats = CopyStats()
+    stale_dirs = []
+    try:
+        for relative_path, is_dir in manifest.items():
+            if planned.get(relative_path) == is_dir:
+                continue
+            path = os.path.join(directory, relative_path)
+            if is_dir:
+                stale_dirs.append(path)
+            elif os.path.lexists(path) and not os.path.isdir(path):
+                os.remove(path)
+                stats.removed += 1
 
+        # deepest first, so dirs are empty by the time they're reached
+        for path in sorted(stale_dirs, reverse=True):
+            if os.path.isdir(path) and not os.path.islink(path) and \
+                not os.listdir(path):
+                os.rmdir(path)
+    except OSError, error:
+        raise SuitcaseCopyError(error)
+    return stats
@@ -1,11 +1,157 @@
-"""Set's up a shared temp file cache for fakeroot"""
+"""Runs the fakeroot commands for a package under one faked daemon
 
-from suitcase.utils.singleton import Singleton
+fakeroot starts a new faked for every command, loading and saving the
+whole ownership database each time. A session starts faked once and runs
+every command in it with the fakeroot library preloaded, as the fakeroot
+script would, so the ownership database is only saved when the session
+stops.
+
+Each thread has its own current session, which is what
+suitcase.utils.common.run_fakeroot runs commands in, and it's ended once
+each package is built, so no two packages ever share one.
+
+"""
+
+import os
+import glob
+import signal
+import threading
+import subprocess
 from tempfile import mkstemp
 
-class Fakeroot(Singleton):
-    
-    """singleton for maintaining a cache for fakeroot"""
-    def __init__(self):
-        if not "cache_filename" in self.__dict__:
-            self.cache_filename = mkstemp()[1]
+from suitcase.exceptions import SuitcasePackagingError
+
+FAKED = "faked-sysv"
+FAKEROOT_LIBRARY = "libfakeroot-sysv.so"
+FAKEROOT_LIBRARY_DIRS = [
+    "/usr/lib/*/libfakeroot",
+    "/usr/lib64/libfakeroot",
+    "/usr/lib32/libfakeroot",
+    "/usr/lib/libfakeroot",
+]
+FAKED_MODE = "unknown-is-root"
+
+current = threading.local()
+
+def get_library_path():
+    """Returns the LD_LIBRARY_PATH the fakeroot library is found on"""
+    directories = []
+    for pattern in FAKEROOT_LIBRARY_DIRS:
+        for directory in sorted(glob.glob(pattern)):
+            if os.path.exists(os.path.join(directory, FAKEROOT_LIBRARY)):
+                directories.append(directory)
+    library_path = os.environ.get("LD_LIBRARY_PATH")
+    if library_path:
+        directories.append(library_path)
+    return ":".join(directories)
+
+class FakerootSession(object):
+
+    """A faked daemon holding the ownership database for one package
+
+    The daemon is started by the first command run in the session, loading
+    state_filename if it has anything in it, and saves the database back
+    there when it's stopped. A stopped session starts again from what it
+    saved.
+
+    """
+
+    def __init__(self, state_filename=None):
+        self.owns_state = state_filename is None
+        if self.owns_state:
+            (handle, state_filename) = mkstemp()
+            os.close(handle)
+        self.state_filename = state_filename
+        self.process = None
+        self.key = None
+
+    def is_running(self):
+        """Whether faked is running for this session"""
+        return self.process is not None
+
+    def start(self):
+        """Starts faked, loading the state saved before"""
+        if self.is_running():
+            return
+
+        command = [FAKED, "--foreground", "--save-file", self.state_filename]
+        state_file = None
+        if os.path.exists(self.state_filename) and \
+            os.path.getsize(self.state_filename):
+            command.append("--load")
+            state_file = open(self.state_filename)
+        try:
+            try:
+                self.process = subprocess.Popen(
+                    command,
+                    stdin=state_file,
+                    stdout=subprocess.PIPE,
+                    close_fds=True
+                )
+            except OSError, error:
+                raise SuitcasePackagingError(
+                    "Can't start %s: %s" % (FAKED, error)
+                )
+        finally:
+            if state_file is not None:
+                state_file.close()
+
+        # faked says what its key is once it's ready for commands
+        line = self.process.stdout.readline()
+        if ":" not in line:
+            self.process.wait()
+            self.process = None
+            raise SuitcasePackagingError(
+                "%s didn't start: %s" % (FAKED, line.strip())
+            )
+        self.key = line.split(":")[0]
+
+    def get_environment(self):
+        """Returns the environment commands run under faked with
+
+        faked is started if it isn't running.
+
+        """
+        self.start()
+        library_path = get_library_path()
+        environment = dict(os.environ)
+        environment.update({
+            "FAKEROOTKEY": self.key,
+            "LD_LIBRARY_PATH": library_path,
+            "LD_PRELOAD": FAKEROOT_LIBRARY,
+            "FAKED_MODE": FAKED_MODE,
+        })
+        return environment
+
+    def stop(self):
+        """Stops faked, which saves the ownership database to state_filename"""
+        if not self.is_running():
+            return
+        try:
+            os.kill(self.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+        self.key = None
+
+    def close(self):
+        """Stops faked and throws away the state file if it's the session's"""
+        self.stop()
+        if self.owns_state and os.path.exists(self.state_filename):
+            os.remove(self.state_filename)
+
+def get_session():
+    """Returns this thread's session, starting a new one if there isn't one"""
+    session = getattr(current, "session", None)
+    if session is None:
+        session = current.session = FakerootSession()
+    return session
+
+def end_session():
+    """Closes this thread's session, the next command gets a new one"""
+    session = getattr(current, "session", None)
+    if session is not None:
+        current.session = None
+        session.close()
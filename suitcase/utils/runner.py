@@ -0,0 +1,292 @@
+"""Runs external commands, a bounded number of them at a time
+
+Commands given as a list are run directly without a shell, strings still
+go through one. Output is read as it's printed, keeping at most max_output
+bytes of each stream so a chatty command can't fill memory, and a command
+still running after its timeout is killed. How long every command took is
+recorded.
+
+Each process has its own runner, set up from the global config by
+configure_runner: command_jobs is how many commands can run at once and
+command_timeout is how many seconds each gets.
+
+"""
+
+import os
+import time
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+# how many commands run at once unless command_jobs is set
+COMMAND_JOBS = 4
+
+# the most kept of each of a command's stdout and stderr
+MAX_OUTPUT = 64 * 1024 * 1024
+
+READ_SIZE = 65536
+
+# what the shell exits with for a command it can't find
+NOT_FOUND = 127
+
+settings = {}
+runners = {}
+
+def read_stream(stream, chunks, max_output, result):
+    """Reads stream until it closes, keeping at most max_output bytes"""
+    kept = 0
+    try:
+        while True:
+            data = os.read(stream.fileno(), READ_SIZE)
+            if not data:
+                break
+            if max_output is not None and kept + len(data) > max_output:
+                data = data[:max_output - kept]
+                result.truncated = True
+            kept += len(data)
+            if data:
+                chunks.append(data)
+    finally:
+        stream.close()
+
+def get_command_name(command):
+    """Returns the program a command runs, for messages"""
+    if isinstance(command, basestring):
+        return command.split()[0]
+    return command[0]
+
+class CommandResult(object):
+
+    """What a command exited with, what it printed and how long it took
+
+    returncode is NOT_FOUND if the command couldn't be run at all.
+
+    """
+
+    def __init__(self, command, cwd=None):
+        self.command = command
+        self.cwd = cwd
+        self.returncode = None
+        self.output = ""
+        self.error_output = ""
+        self.seconds = 0
+        self.timed_out = False
+        self.truncated = False
+
+class RunningCommand(object):
+
+    """A command started by a CommandRunner, stdout is read by the caller
+
+    stderr is read in the background so it can't fill up and stall the
+    command. wait or stop has to be called to give back its slot.
+
+    """
+
+    def __init__(self, runner, process, result, timeout):
+        self.runner = runner
+        self.process = process
+        self.result = result
+        self.start_time = time.time()
+        self.finished = False
+        self.stdout = process.stdout
+
+        self.error_chunks = []
+        self.error_reader = None
+        if process.stderr is not None:
+            self.error_reader = threading.Thread(
+                target=read_stream,
+                args=(process.stderr, self.error_chunks, runner.max_output,
+                    result)
+            )
+            self.error_reader.setDaemon(True)
+            self.error_reader.start()
+
+        self.timer = None
+        if timeout:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.setDaemon(True)
+            self.timer.start()
+
+    def kill(self):
+        """Kills the command for running past its timeout"""
+        self.result.timed_out = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def wait(self):
+        """Waits for the command to finish, returns its CommandResult"""
+        if self.finished:
+            return self.result
+
+        try:
+            self.process.wait()
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            if self.error_reader is not None:
+                self.error_reader.join()
+            self.finished = True
+            self.result.returncode = self.process.returncode
+            self.result.error_output = "".join(self.error_chunks)
+            self.result.seconds = time.time() - self.start_time
+            self.runner.finish(self.result)
+        return self.result
+
+    def stop(self):
+        """Stops the command early when the rest of its output isn't wanted"""
+        if self.stdout is not None:
+            self.stdout.close()
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        return self.wait()
+
+class CommandRunner(object):
+
+    """Runs commands, no more than jobs of them at once"""
+
+    def __init__(self, jobs=COMMAND_JOBS, timeout=None, max_output=MAX_OUTPUT):
+        self.jobs = max(int(jobs), 1)
+        self.timeout = timeout
+        self.max_output = max_output
+        self.slots = threading.BoundedSemaphore(self.jobs)
+        self.lock = threading.Lock()
+        self.timings = []
+
+    def start(self, command, cwd=None, env=None, timeout=None,
+        combine_output=False, universal_newlines=False):
+        """Starts a command and returns it as a RunningCommand
+
+        Waits for a free slot first. Raises OSError if the command can't
+        be run.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        result = CommandResult(command, cwd)
+        if combine_output:
+            stderr = subprocess.STDOUT
+        else:
+            stderr = subprocess.PIPE
+
+        self.slots.acquire()
+        # nothing gets to sit waiting for input that'll never come
+        stdin = open(os.devnull)
+        try:
+            process = subprocess.Popen(
+                command,
+                cwd=cwd,
+                env=env,
+                shell=isinstance(command, basestring),
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                close_fds=True,
+                universal_newlines=universal_newlines,
+            )
+        except:
+            self.slots.release()
+            raise
+        finally:
+            stdin.close()
+        return RunningCommand(self, process, result, timeout)
+
+    def finish(self, result):
+        """Records how long a command took and gives back its slot"""
+        self.lock.acquire()
+        try:
+            self.timings.append((
+                result.command,
+                result.cwd,
+                result.returncode,
+                result.seconds,
+            ))
+        finally:
+            self.lock.release()
+        self.slots.release()
+
+    def add_timings(self, timings):
+        """Records commands another process ran, so they're counted too"""
+        self.lock.acquire()
+        try:
+            self.timings.extend(timings)
+        finally:
+            self.lock.release()
+
+    def run(self, command, cwd=None, env=None, timeout=None,
+        combine_output=False):
+        """Runs a command to the end and returns its CommandResult"""
+        try:
+            running = self.start(command, cwd, env, timeout, combine_output)
+        except OSError, error:
+            result = CommandResult(command, cwd)
+            result.returncode = NOT_FOUND
+            result.error_output = str(error)
+            return result
+
+        chunks = []
+        try:
+            read_stream(running.stdout, chunks, self.max_output,
+                running.result)
+        finally:
+            running.wait()
+        running.result.output = "".join(chunks)
+        return running.result
+
+    def map(self, function, items):
+        """Calls function on every item, jobs at a time, in a thread pool
+
+        For work that spends its time waiting on commands. Returns the
+        results in the same order as items.
+
+        """
+        items = list(items)
+        if len(items) < 2 or self.jobs < 2:
+            return [function(item) for item in items]
+
+        pool = ThreadPool(min(self.jobs, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_many(self, commands, cwd=None, env=None, timeout=None,
+        combine_output=False):
+        """Runs several commands at once, returns their CommandResults"""
+        return self.map(
+            lambda command: self.run(command, cwd, env, timeout,
+                combine_output),
+            commands
+        )
+
+    def get_total_seconds(self):
+        """Returns how long all the commands run so far took between them"""
+        return sum([timing[3] for timing in self.timings])
+
+def configure_runner(global_config):
+    """Sets up the runners from command_jobs and command_timeout"""
+    settings["jobs"] = global_config.get("command_jobs") or COMMAND_JOBS
+    timeout = global_config.get("command_timeout")
+    settings["timeout"] = timeout and float(timeout) or None
+    runners.clear()
+
+def get_runner():
+    """Returns this process's runner
+
+    Worker processes get a runner of their own as locks and threads
+    don't survive a fork.
+
+    """
+    pid = os.getpid()
+    if pid not in runners:
+        runners.clear()
+        runners[pid] = CommandRunner(
+            settings.get("jobs", COMMAND_JOBS),
+            settings.get("timeout")
+        )
+    return runners[pid]
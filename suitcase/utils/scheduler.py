@@ -0,0 +1,229 @@
+"""Orders package builds by the dependencies between them
+
+Packages are handed out once everything they depend on that is also being
+built has finished. Of the packages that are ready, the one at the head of
+the longest remaining chain of builds goes first, with chains weighed by
+how long each package took last time, so the slowest chains start soonest.
+
+"""
+
+import os
+import heapq
+import cPickle as pickle
+from tempfile import mkstemp
+
+from suitcase.exceptions import SuitcasePackagingError
+
+def get_dependency_names(depends):
+    """Returns the package names in a list of debian style depends
+
+    Version restrictions and architectures are dropped and every choice in
+    an alternative counts.
+
+    """
+    if depends is None:
+        return []
+    if isinstance(depends, basestring):
+        depends = [depends]
+
+    names = []
+    for depend in depends:
+        for relation in str(depend).split(","):
+            for alternative in relation.split("|"):
+                name = alternative.split("(")[0].split(":")[0].strip()
+                if name and name not in names:
+                    names.append(name)
+    return names
+
+def get_timings_filename(global_config):
+    """Returns where the time taken to build each package is kept"""
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "timings"
+    )
+
+def read_timings(global_config):
+    """Loads the build times of the last runs, keyed by package name"""
+    try:
+        timings_file = open(get_timings_filename(global_config), "rb")
+        try:
+            timings = pickle.load(timings_file)
+        finally:
+            timings_file.close()
+    except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+        AttributeError, ImportError, IndexError):
+        return {}
+
+    if not isinstance(timings, dict):
+        return {}
+    return timings
+
+def save_timings(global_config, timings):
+    """Writes the build times out atomically, merged with what's there"""
+    filename = get_timings_filename(global_config)
+    directory = os.path.dirname(filename)
+    all_timings = read_timings(global_config)
+    all_timings.update(timings)
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        (handle, temp_filename) = mkstemp(dir=directory)
+        temp_file = os.fdopen(handle, "wb")
+        try:
+            pickle.dump(all_timings, temp_file, pickle.HIGHEST_PROTOCOL)
+        finally:
+            temp_file.close()
+        os.rename(temp_filename, filename)
+    except (IOError, OSError):
+        # timings only make builds faster so losing them isn't an error
+        pass
+
+class BuildScheduler(object):
+
+    """Hands out the packages of a build_dict in dependency order"""
+
+    def __init__(self, build_dict, timings=None):
+        self.build_dict = build_dict
+        self.timings = timings or {}
+
+        paths_by_name = {}
+        for path, package_config in build_dict.items():
+            if package_config.get("package"):
+                paths_by_name[package_config["package"]] = path
+
+        # only dependencies that are part of this build affect its order
+        self.dependencies = {}
+        self.dependents = {}
+        for path in build_dict:
+            self.dependents.setdefault(path, [])
+            self.dependencies[path] = []
+            for name in get_dependency_names(build_dict[path].get("depends")):
+                dependency = paths_by_name.get(name)
+                if dependency is not None and dependency != path and \
+                    dependency not in self.dependencies[path]:
+                    self.dependencies[path].append(dependency)
+                    self.dependents.setdefault(dependency, []).append(path)
+
+        cycle = self.find_cycle()
+        if cycle:
+            raise SuitcasePackagingError(
+                "Packages depend on each other in a cycle: %s" % " -> ".join(
+                    [build_dict[path].get("package") or path
+                        for path in cycle]
+                )
+            )
+
+        self.priorities = {}
+        for path in build_dict:
+            self.get_priority(path)
+
+        self.waiting = {}
+        self.ready = []
+        for path, dependencies in self.dependencies.items():
+            if dependencies:
+                self.waiting[path] = len(dependencies)
+            else:
+                heapq.heappush(self.ready, (-self.priorities[path], path))
+
+    def get_weight(self, path):
+        """Returns how long a package is expected to take to build
+
+        Packages that haven't been timed yet are taken to be average.
+
+        """
+        name = self.build_dict[path].get("package")
+        if name in self.timings:
+            return self.timings[name]
+        if self.timings:
+            return sum(self.timings.values()) / float(len(self.timings))
+        return 1.0
+
+    def get_priority(self, path):
+        """Works out the length of the longest chain of builds from path"""
+        # walks depth first without recursing so long chains are fine
+        stack = [path]
+        while stack:
+            current = stack[-1]
+            if current in self.priorities:
+                stack.pop()
+                continue
+            unknown = [dependent for dependent in self.dependents[current]
+                if dependent not in self.priorities]
+            if unknown:
+                stack.extend(unknown)
+                continue
+            self.priorities[current] = self.get_weight(current) + max(
+                [self.priorities[dependent]
+                    for dependent in self.dependents[current]] or [0]
+            )
+            stack.pop()
+        return self.priorities[path]
+
+    def find_cycle(self):
+        """Returns the paths in a dependency cycle, or None if there's none"""
+        visited = {}
+        for start in sorted(self.dependencies):
+            if start in visited:
+                continue
+            # each entry is a path and the dependencies still to look at
+            chain = [(start, list(self.dependencies[start]))]
+            on_chain = {start: True}
+            visited[start] = True
+            while chain:
+                (path, remaining) = chain[-1]
+                if not remaining:
+                    del on_chain[path]
+                    chain.pop()
+                    continue
+                dependency = remaining.pop()
+                if dependency in on_chain:
+                    cycle = [entry[0] for entry in chain]
+                    return cycle[cycle.index(dependency):] + [dependency]
+                if dependency not in visited:
+                    visited[dependency] = True
+                    on_chain[dependency] = True
+                    chain.append(
+                        (dependency, list(self.dependencies[dependency]))
+                    )
+        return None
+
+    def next_ready(self):
+        """Returns the next package that can be built, None if there's none
+
+        Nothing may be ready while packages are still building.
+
+        """
+        if self.ready:
+            return heapq.heappop(self.ready)[1]
+        return None
+
+    def finished(self, path, succeeded=True):
+        """Marks a package as built, releasing anything waiting on it
+
+        If the build failed everything depending on it, however indirectly,
+        is dropped. Returns the paths that were dropped.
+
+        """
+        if succeeded:
+            for dependent in self.dependents[path]:
+                if dependent in self.waiting:
+                    self.waiting[dependent] -= 1
+                    if not self.waiting[dependent]:
+                        del self.waiting[dependent]
+                        heapq.heappush(
+                            self.ready,
+                            (-self.priorities[dependent], dependent)
+                        )
+            return []
+
+        dropped = []
+        stack = list(self.dependents[path])
+        while stack:
+            dependent = stack.pop()
+            if dependent in self.waiting:
+                del self.waiting[dependent]
+                dropped.append(dependent)
+                stack.extend(self.dependents[dependent])
+        return sorted(dropped)
@@ -5,8 +5,19 @@ import sys
 import unittest
 import shutil
 import commands
+from tempfile import mkdtemp
 
-from suitcase.utils.copy import copy_files
+from suitcase.utils.copy import (
+    copy_files,
+    resolve_copy,
+    copy_file_list,
+    link_file,
+    break_link,
+    plan_copies,
+    write_manifest,
+    read_manifest,
+    remove_stale,
+)
 from suitcase.utils.common import (
     remove_leading_slash, 
     dynamic_import, 
@@ -18,7 +29,21 @@ from suitcase.utils.common import (
     merge_and_de_dupe, 
     merge
 )
+from suitcase.utils.scheduler import BuildScheduler, get_dependency_names
+from suitcase.utils.fakeroot import FakerootSession
+from suitcase.utils.runner import CommandRunner
+from suitcase.utils.config import ConfigCache
+from suitcase.utils.walker import walk_package_dirs
+from suitcase.packing.base import PackageBase
+from suitcase.exceptions import SuitcasePackagingError, SuitcaseCommandError
+
+def add_config_depends(global_config, package_config):
+    """pre_conf hook making app depend on config, as generate_depends would"""
+    if package_config["package"] == "app":
+        package_config["depends"] = package_config["depends"] + ["config"]
+    return package_config
 
+add_config_depends.discovery = True
 
 class UtilsTestCase(unittest.TestCase):
     
@@ -134,6 +159,86 @@ class UtilsTestCase(unittest.TestCase):
         self.clean_up_copy()
         self.assert_equal(file_list, ['test1.txt', 'test_dir'])
 
+    def test_copy_unchanged(self):
+        """Tests that files already copied aren't copied again"""
+        test_dir_a = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/A"
+        )
+        test_dir_b = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/B/"
+        )
+        first = copy_files(test_dir_b, test_dir_a)
+        second = copy_files(test_dir_b, test_dir_a)
+        self.clean_up_copy()
+        self.assert_equal((first.files, first.unchanged), (3, 0))
+        self.assert_equal((second.files, second.unchanged), (0, 3))
+
+    def test_break_link(self):
+        """Tests that changing a linked file leaves the original alone"""
+        test_dir_a = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/A"
+        )
+        test_file_b = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/B/test1.txt"
+        )
+        test_file_a = os.path.join(test_dir_a, "test1.txt")
+        original = open(test_file_b).read()
+        os.makedirs(test_dir_a)
+        copy_file_list([(test_file_b, test_file_a)], copy=link_file)
+        break_link(test_file_a)
+        open(test_file_a, "w").write("changed")
+        self.clean_up_copy()
+        self.assert_equal(open(test_file_b).read(), original)
+
+    def test_remove_stale(self):
+        """Tests that a kept copy loses what it no longer copies"""
+        test_dir_a = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/A"
+        )
+        test_dir_b = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/B/"
+        )
+        manifest_filename = os.path.join(test_dir_a, "../A.manifest")
+        copy_files(test_dir_b, test_dir_a)
+        open(os.path.join(test_dir_a, "generated.txt"), "w").write("hook")
+        write_manifest(manifest_filename, test_dir_a)
+
+        transfers = [(test_dir_b, test_dir_a, ["test2.txt"])]
+        (dirs, files) = plan_copies(transfers)
+        stats = remove_stale(
+            test_dir_a,
+            read_manifest(manifest_filename),
+            dirs,
+            files
+        )
+        file_list = commands.getstatusoutput("ls %s" % test_dir_a)[1].split()
+        os.remove(manifest_filename)
+        self.clean_up_copy()
+        self.assert_equal(stats.removed, 2)
+        self.assert_equal(file_list, ['test1.txt', 'test_dir'])
+
+    def test_resolve_copy(self):
+        """Tests working out a copy of a dir's contents with exclusions"""
+        test_dir_b = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/B/"
+        )
+        copies = [(destination, is_dir) for (source, destination, is_dir)
+            in resolve_copy(test_dir_b, "/A", exclusions=["test2.txt"])]
+        self.assert_equal(copies, [
+            ("/A/test1.txt", False),
+            ("/A/test_dir", True),
+            ("/A/test_dir/test_dir1.txt", False),
+        ])
+
+    def test_resolve_copy2(self):
+        """Tests working out a copy of a dir itself with anchored exclusions"""
+        test_dir_b = os.path.join(
+            os.path.dirname(__file__), "../tests/copy_test/B"
+        )
+        copies = [destination for (source, destination, is_dir)
+            in resolve_copy(test_dir_b, "/A", exclusions=["/B/test_dir/"])]
+        self.assert_equal(copies, ["/A/B", "/A/B/test1.txt", "/A/B/test2.txt"])
+
     @staticmethod
     def raw_input_mock_n(prompt):
         """mock of raw_input returns 'n'"""
@@ -162,6 +267,35 @@ class UtilsTestCase(unittest.TestCase):
         result = run_command(command)
         self.assert_equal(result[0], 0)
 
+    def test_run_command_arguments(self):
+        """testing arguments in a list aren't parsed by a shell"""
+        result = run_command(["echo", "$HOME;", "*"])
+        self.assert_equal(result, (0, "$HOME; *"))
+
+    def test_run_command_timeout(self):
+        """testing a command is killed once it runs past its timeout"""
+        self.assertRaises(
+            SuitcaseCommandError,
+            run_command,
+            ["sleep", "10"],
+            timeout=0.1
+        )
+
+    def test_runner_output_limit(self):
+        """testing output past the limit is thrown away"""
+        runner = CommandRunner(max_output=10)
+        result = runner.run(["echo", "0123456789abc"])
+        self.assert_equal(result.output, "0123456789")
+        self.assertTrue(result.truncated)
+        self.assert_equal(len(runner.timings), 1)
+
+    def test_runner_add_timings(self):
+        """testing commands run by build workers are counted"""
+        runner = CommandRunner()
+        runner.run(["true"])
+        runner.add_timings([(["false"], None, 1, 2.0)])
+        self.assert_equal(len(runner.timings), 2)
+        self.assertTrue(runner.get_total_seconds() >= 2.0)
 
     def test_list_merge(self):
         """testing merging lists 1"""
@@ -185,6 +319,261 @@ class UtilsTestCase(unittest.TestCase):
         self.assert_equal(new_list, [1, 2, 3, 4])
 
 
+class SchedulerTestCase(unittest.TestCase):
+
+    """Tests for ordering builds by their depends"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    @staticmethod
+    def make_build_dict(depends):
+        """Makes a build dict of packages named after their paths"""
+        return dict([(name, {"package": name, "depends": depends[name]})
+            for name in depends])
+
+    @staticmethod
+    def build_all(scheduler):
+        """Returns the order the scheduler hands the packages out in"""
+        order = []
+        path = scheduler.next_ready()
+        while path is not None:
+            order.append(path)
+            scheduler.finished(path)
+            path = scheduler.next_ready()
+        return order
+
+    def test_dependency_names(self):
+        """Test versions and alternatives are stripped from depends"""
+        self.assert_equal(
+            get_dependency_names(["a (>=0.5)", "b | c", "d:any, a"]),
+            ["a", "b", "c", "d"]
+        )
+
+    def test_dependencies_first(self):
+        """Test packages are only handed out after what they depend on"""
+        scheduler = BuildScheduler(self.make_build_dict({
+            "app": ["config", "libc6"],
+            "config": ["migrations (>=0.12)"],
+            "migrations": [],
+        }))
+        self.assert_equal(
+            self.build_all(scheduler),
+            ["migrations", "config", "app"]
+        )
+
+    def test_critical_path_first(self):
+        """Test the package heading the slowest chain starts first"""
+        build_dict = self.make_build_dict({
+            "quick": [],
+            "base": [],
+            "slow": ["base"],
+        })
+        scheduler = BuildScheduler(build_dict, {"quick": 5, "base": 1,
+            "slow": 10})
+        self.assert_equal(self.build_all(scheduler), ["base", "slow", "quick"])
+
+    def test_cycle(self):
+        """Test a dependency cycle is refused"""
+        self.assertRaises(
+            SuitcasePackagingError,
+            BuildScheduler,
+            self.make_build_dict({"a": ["b"], "b": ["c"], "c": ["a"]})
+        )
+
+    def test_discovered_depends(self):
+        """Test depends pre_conf hooks add at discovery order builds"""
+        build_dict = self.make_build_dict({"app": [], "config": []})
+        for package_config in build_dict.values():
+            package_config["path"] = "/branch/%s" % package_config["package"]
+            package_config["pre_conf"] = "suitcase.utils.tests."\
+                "add_config_depends"
+        packer = PackageBase({"base_path": "/branch", "jobs": 2})
+        packer.run_discovery_hooks(build_dict)
+        self.assert_equal(build_dict["app"]["depends"], ["config"])
+        self.assert_equal(
+            self.build_all(BuildScheduler(build_dict)),
+            ["config", "app"]
+        )
+
+        # it isn't run again when the package is built
+        packer.package_config = build_dict["app"]
+        packer.run_hook('pre_conf')
+        self.assert_equal(build_dict["app"]["depends"], ["config"])
+
+    def test_failure_drops_dependents(self):
+        """Test nothing depending on a failed package is built"""
+        scheduler = BuildScheduler(self.make_build_dict({
+            "a": [],
+            "b": ["a"],
+            "c": ["b"],
+        }))
+        path = scheduler.next_ready()
+        self.assert_equal(scheduler.finished(path, False), ["b", "c"])
+        self.assert_equal(scheduler.next_ready(), None)
+
+class FakerootSessionTestCase(unittest.TestCase):
+
+    """Tests commands run in a fakeroot session share one faked"""
+
+    def setUp(self):
+        """Makes a file to change the owner of"""
+        self.temp_dir = mkdtemp()
+        self.filename = os.path.join(self.temp_dir, "file")
+        open(self.filename, "w").close()
+        self.session = FakerootSession()
+
+    def tearDown(self):
+        """Ends the session and removes the file"""
+        self.session.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_owner(self):
+        """Returns the owner of the file as seen in the session"""
+        return run_command(
+            ["stat", "-c", "%u:%g", self.filename],
+            env=self.session.get_environment()
+        )[1]
+
+    def test_owner_kept(self):
+        """Test an owner set by one command is seen by the next"""
+        run_command(
+            ["chown", "123:45", self.filename],
+            env=self.session.get_environment()
+        )
+        self.assertEqual(self.get_owner(), "123:45")
+
+    def test_owner_saved(self):
+        """Test the owners are saved when the session stops and reloaded"""
+        run_command(
+            ["chown", "123:45", self.filename],
+            env=self.session.get_environment()
+        )
+        self.session.stop()
+        self.assertTrue("uid=123,gid=45" in
+            open(self.session.state_filename).read())
+        self.assertEqual(self.get_owner(), "123:45")
+
+class ConfigCacheTestCase(unittest.TestCase):
+
+    """Tests configs and globs are only worked out again when they change"""
+
+    def setUp(self):
+        """Makes a config file and some dirs for a glob to find"""
+        self.temp_dir = mkdtemp()
+        self.snapshot = os.path.join(self.temp_dir, "cache", "config")
+        self.filename = os.path.join(self.temp_dir, "debian.yml")
+        open(self.filename, "w").write("package: test\n")
+        os.makedirs(os.path.join(self.temp_dir, "apps", "one"))
+        open(os.path.join(self.temp_dir, "apps", "file"), "w").close()
+
+    def tearDown(self):
+        """Removes the config file and snapshot"""
+        shutil.rmtree(self.temp_dir)
+
+    def test_load(self):
+        """Test a config is parsed again only once its file changes"""
+        cache = ConfigCache(self.snapshot)
+        cache.load(self.filename)["package"] = "changed"
+        cache.save()
+
+        cache = ConfigCache(self.snapshot)
+        self.assertEqual(cache.load(self.filename), {"package": "test"})
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        open(self.filename, "w").write("package: other\n")
+        self.assertEqual(cache.load(self.filename), {"package": "other"})
+        self.assertEqual(cache.misses, 1)
+
+    def test_expand_dirs(self):
+        """Test a glob is expanded again only once a dir it lists changes"""
+        cache = ConfigCache(self.snapshot)
+        apps = os.path.join(self.temp_dir, "apps")
+        self.assertEqual(
+            cache.expand_dirs(self.temp_dir, "apps/*"),
+            [os.path.join(apps, "one")]
+        )
+        cache.save()
+
+        cache = ConfigCache(self.snapshot)
+        cache.expand_dirs(self.temp_dir, "apps/*")
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+        os.mkdir(os.path.join(apps, "two"))
+        self.assertEqual(
+            cache.expand_dirs(self.temp_dir, "apps/*"),
+            [os.path.join(apps, "one"), os.path.join(apps, "two")]
+        )
+
+class WalkerTestCase(unittest.TestCase):
+
+    """Tests the walker finds what os.walk would"""
+
+    def setUp(self):
+        """Makes a tree of package dirs with some to leave out"""
+        self.temp_dir = mkdtemp()
+        for path in ["apps/one/tests", "apps/two/lib.egg-info/one",
+            "apps/two/lib", "libs/three"]:
+            os.makedirs(os.path.join(self.temp_dir, path))
+        open(os.path.join(self.temp_dir, "apps/one/debian.yml"), "w").close()
+        os.symlink(
+            os.path.join(self.temp_dir, "apps"),
+            os.path.join(self.temp_dir, "libs/apps")
+        )
+
+    def tearDown(self):
+        """Removes the tree"""
+        shutil.rmtree(self.temp_dir)
+
+    def test_walk_package_dirs(self):
+        """Test dirs come in os.walk order with their conf and collection"""
+        exclusions = ["tests", "*.egg-info"]
+        expected = []
+        for root, dirs, files in os.walk(self.temp_dir):
+            dirs[:] = [name for name in dirs
+                if name != "tests" and not name.endswith(".egg-info")]
+            expected.append(root)
+
+        for threads in [1, 4]:
+            found = walk_package_dirs(
+                self.temp_dir,
+                "debian.yml",
+                exclusions,
+                self.temp_dir,
+                {"apps/two": "two", "apps/two/lib": "lib", "libs/": "none"},
+                threads
+            )
+            self.assertEqual([root for root, _, _ in found], expected)
+            self.assertEqual(
+                [root[len(self.temp_dir) + 1:] for root, has_conf, _ in found
+                    if has_conf],
+                ["apps/one"]
+            )
+            self.assertEqual(
+                dict([(root[len(self.temp_dir) + 1:], collection)
+                    for root, _, collection in found if collection]),
+                {"apps/two": "two", "apps/two/lib": "lib"}
+            )
+
+
 TEST_SUITE = unittest.TestLoader().loadTestsFromTestCase(UtilsTestCase)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(SchedulerTestCase)
+)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(ConfigCacheTestCase)
+)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(WalkerTestCase)
+)
+if commands.getstatusoutput("faked-sysv --version")[0] == 0:
+    TEST_SUITE.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(FakerootSessionTestCase)
+    )
 unittest.TextTestRunner(verbosity=2).run(TEST_SUITE)
 
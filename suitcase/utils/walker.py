@@ -0,0 +1,198 @@
+"""Walks the branch for package dirs, reading each directory once
+
+Every directory is listed once and the listing says which entries are
+dirs to walk into and whether the package config is there, using scandir
+where it's available (python 3.5+ or the scandir package) so nothing has
+to be stat'ed. Path exclusions are compiled once into a set of names and a
+regex for any globs, and the collection each dir belongs to is found by
+walking a trie of the collection dirs alongside the tree.
+
+Dirs are yielded in the order os.walk gives them. Subtrees can be walked
+by several threads, which pays off when listing directories means waiting
+on the disk or network.
+
+"""
+
+import os
+import re
+import stat
+import fnmatch
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+GLOB_CHARACTERS = "*?["
+
+def compile_exclusions(exclusions):
+    """Returns a function checking a dir name against names or name globs"""
+    names = set()
+    patterns = []
+    for exclusion in exclusions:
+        if [character for character in exclusion
+            if character in GLOB_CHARACTERS]:
+            patterns.append("(?:%s)" % fnmatch.translate(exclusion))
+        else:
+            names.add(exclusion)
+
+    if not patterns:
+        return names.__contains__
+
+    regex = re.compile("|".join(patterns))
+    def is_excluded(name):
+        """Checks name against the exclusions"""
+        return name in names or regex.match(name) is not None
+    return is_excluded
+
+def build_collection_index(collection_mapping):
+    """Turns a collection mapping into a trie keyed a dir name at a time
+
+    Each node is the collection of the dir it stands for, None if it
+    hasn't got one, and a dict of its children.
+
+    """
+    index = [None, {}]
+    for path, collection in collection_mapping.items():
+        node = index
+        if path:
+            for name in path.split("/"):
+                node = node[1].setdefault(name, [None, {}])
+        node[0] = collection
+    return index
+
+def find_collection_node(index, base_path, path):
+    """Returns the node of the collection index for path, None if none
+
+    Paths outside base_path don't belong to any collection.
+
+    """
+    path = os.path.abspath(path)
+    if path == base_path:
+        return index
+    if not path.startswith(base_path.rstrip("/") + "/"):
+        return None
+
+    node = index
+    for name in path[len(base_path):].strip("/").split("/"):
+        node = node[1].get(name)
+        if node is None:
+            return None
+    return node
+
+def read_dir(path, conf_name, is_excluded):
+    """Lists path, returns its dirs to walk into and whether conf_name is in it
+
+    Dirs are in listing order, symlinks to dirs are left out as os.walk
+    leaves them, as are excluded dirs.
+
+    """
+    dirs = []
+    has_conf = False
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_excluded(entry.name):
+                        dirs.append(entry.name)
+                elif entry.name == conf_name:
+                    has_conf = entry.is_file()
+            except OSError:
+                continue
+        return dirs, has_conf
+
+    for name in os.listdir(path):
+        if name == conf_name:
+            has_conf = os.path.isfile(os.path.join(path, name))
+            continue
+        if is_excluded(name):
+            continue
+        try:
+            mode = os.lstat(os.path.join(path, name)).st_mode
+        except OSError:
+            continue
+        if stat.S_ISDIR(mode):
+            dirs.append(name)
+    return dirs, has_conf
+
+def walk_tree(path, node, conf_name, is_excluded):
+    """Returns path and every dir below it, depth first
+
+    Each dir comes with whether it has conf_name in it and its collection.
+    Dirs that can't be listed are left out, along with everything below
+    them, as os.walk leaves them out.
+
+    """
+    found = []
+    stack = [(path, node)]
+    while stack:
+        (path, node) = stack.pop()
+        try:
+            (dirs, has_conf) = read_dir(path, conf_name, is_excluded)
+        except OSError:
+            continue
+        found.append((path, has_conf, node and node[0]))
+
+        children = node and node[1] or {}
+        for name in reversed(dirs):
+            stack.append((os.path.join(path, name), children.get(name)))
+    return found
+
+def walk_package_dirs(start_path, conf_name, exclusions=None, base_path=None,
+    collection_mapping=None, threads=1):
+    """Returns every dir below start_path that isn't excluded
+
+    Each comes as its path, whether conf_name is in it and the name of the
+    collection it belongs to. With several threads the subtrees below
+    start_path are walked at the same time.
+
+    """
+    is_excluded = compile_exclusions(exclusions or [])
+    node = None
+    if collection_mapping and base_path:
+        node = find_collection_node(
+            build_collection_index(collection_mapping),
+            os.path.abspath(base_path),
+            start_path
+        )
+
+    if threads < 2:
+        return walk_tree(start_path, node, conf_name, is_excluded)
+
+    # single dirs at the top are stepped through to where the tree splits
+    found = []
+    path = start_path
+    while True:
+        try:
+            (dirs, has_conf) = read_dir(path, conf_name, is_excluded)
+        except OSError:
+            return found
+        found.append((path, has_conf, node and node[0]))
+        children = node and node[1] or {}
+        if len(dirs) != 1:
+            break
+        path = os.path.join(path, dirs[0])
+        node = children.get(dirs[0])
+
+    def walk_subtree(name):
+        """Walks one of the subtrees"""
+        return walk_tree(
+            os.path.join(path, name),
+            children.get(name),
+            conf_name,
+            is_excluded
+        )
+
+    if dirs:
+        pool = ThreadPool(min(threads, len(dirs)))
+        try:
+            for subtree in pool.map(walk_subtree, dirs):
+                found += subtree
+        finally:
+            pool.close()
+            pool.join()
+    return found
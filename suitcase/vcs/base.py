@@ -1,15 +1,219 @@
 """base class for vcs"""
 
+import os
+
+from suitcase.exceptions import SuitcaseVcsError
 from suitcase.utils.singleton import Singleton
+from suitcase.utils.runner import get_runner, NOT_FOUND
 
 class VcsBase(Singleton):
-    
+
     """Base class for VCS.
-    
-    inherits the Singleton pattern
-    
+
+    inherits the Singleton pattern which means the memo of revisions
+    looked up is shared by everything in the run that asks for them.
+
     """
-    
-    def get_directory_revision(self):
-        """Placeholder for getting revs"""
+
+    def __init__(self):
+        if not "revisions" in self.__dict__:
+            self.revisions = {}
+            self.cache = None
+
+    def set_cache(self, cache):
+        """Puts a persistent RevisionCache in front of find_revisions"""
+        self.cache = cache
+
+    def find_root(self, path):
+        """Placeholder for finding the repository root above a path"""
         raise NotImplementedError
+
+    def get_freshness_token(self, root):
+        """Returns a cheap token that changes whenever revisions might
+
+        Returning None means the repository can't be cached.
+
+        """
+        return None
+
+    def find_revisions(self, paths):
+        """Placeholder for looking up the revs of many paths at once
+
+        Should return a dictionary keyed by the paths passed in, leaving
+        out paths that have no revision.
+
+        """
+        raise NotImplementedError
+
+    def find_changed_paths(self, root, since):
+        """Placeholder for listing what changed in root after since
+
+        Should return paths relative to root, found with a single query.
+
+        """
+        raise NotImplementedError
+
+    def get_changed_paths(self, path, since):
+        """Returns the absolute paths changed after revision since
+
+        path can be anywhere inside the tree that should be looked at.
+
+        """
+        root = self.find_root(path)
+        if root is None:
+            raise SuitcaseVcsError("%s isn't under %s version control" % (
+                path,
+                self.__class__.__name__.lower()
+            ))
+        return [os.path.join(root, changed_path)
+            for changed_path in self.find_changed_paths(root, since)]
+
+    def run_command(self, root, command):
+        """Runs a vcs command in root and returns what it printed"""
+        vcs_name = self.__class__.__name__.lower()
+        result = get_runner().run(command, cwd=root)
+        if result.returncode == NOT_FOUND:
+            raise SuitcaseVcsError("Can't run %s in %s: %s" % (
+                vcs_name,
+                root,
+                result.error_output
+            ))
+        self.check_result(result, "%s %s failed in %s" % (
+            vcs_name,
+            command[1],
+            root
+        ))
+        return result.output
+
+    def start_command(self, root, command):
+        """Starts a vcs command in root for its output to be read as it comes
+
+        Returns the RunningCommand, which has to be waited on or stopped.
+
+        """
+        try:
+            return get_runner().start(
+                command,
+                cwd=root,
+                universal_newlines=True
+            )
+        except OSError, error:
+            raise SuitcaseVcsError("Can't run %s in %s: %s" % (
+                self.__class__.__name__.lower(),
+                root,
+                error
+            ))
+
+    @staticmethod
+    def check_result(result, message):
+        """Raises SuitcaseVcsError with message if a command didn't succeed
+
+        Output cut short by the size limit counts as a failure, as what's
+        there can't be trusted to be complete.
+
+        """
+        if result.timed_out:
+            raise SuitcaseVcsError("%s\nCommand timed out after %.0fs" % (
+                message,
+                result.seconds
+            ))
+        if result.returncode != 0:
+            raise SuitcaseVcsError("%s\n"\
+                "Command exited with error (%s), %s" % (
+                    message,
+                    result.returncode,
+                    result.error_output,
+                )
+            )
+        if result.truncated:
+            raise SuitcaseVcsError("%s\nCommand printed too much" % message)
+
+    def get_revisions(self, paths):
+        """Returns a dictionary of revisions keyed by path
+
+        Only paths that haven't been asked for before in this run are
+        handed to the backend's find_revisions. Paths without a revision
+        are left out of the dictionary.
+
+        """
+        revisions = {}
+        unknown_paths = []
+        for path in paths:
+            key = os.path.abspath(path)
+            if key in self.revisions:
+                if self.revisions[key] is not None:
+                    revisions[path] = self.revisions[key]
+            elif path not in unknown_paths:
+                unknown_paths.append(path)
+
+        if unknown_paths:
+            found = self.lookup_revisions(unknown_paths)
+            for path in unknown_paths:
+                self.revisions[os.path.abspath(path)] = found.get(path)
+                if found.get(path) is not None:
+                    revisions[path] = found[path]
+
+        return revisions
+
+    def lookup_revisions(self, paths):
+        """Checks the persistent cache before asking find_revisions
+
+        Only the paths the cache can't answer are looked up, and what is
+        found for them is written back for the next run.
+
+        """
+        if self.cache is None:
+            return self.find_revisions(paths)
+
+        vcs_name = self.__class__.__name__.lower()
+        found = {}
+        tokens = {}
+        missing_paths = []
+        cached_roots = {}
+        for path in paths:
+            root = self.find_root(path)
+            if root is not None and root not in tokens:
+                tokens[root] = self.get_freshness_token(root)
+
+            if root is None or tokens[root] is None:
+                self.cache.misses += 1
+                missing_paths.append(path)
+                continue
+
+            cached = self.cache.get(vcs_name, root, tokens[root])
+            key = os.path.abspath(path)
+            if key in cached:
+                self.cache.hits += 1
+                if cached[key] is not None:
+                    found[path] = cached[key]
+            else:
+                self.cache.misses += 1
+                missing_paths.append(path)
+                cached_roots[path] = root
+
+        if missing_paths:
+            looked_up = self.find_revisions(missing_paths)
+            found.update(looked_up)
+
+            for path, root in cached_roots.items():
+                self.cache.get(vcs_name, root, tokens[root])\
+                    [os.path.abspath(path)] = looked_up.get(path)
+
+            for root in dict([(root, 1) for root in cached_roots.values()]):
+                self.cache.save(vcs_name, root)
+
+        return found
+
+    def get_directory_revision(self, directory):
+        """Returns the revision for a single path"""
+        revision = self.get_revisions([directory]).get(directory)
+        if revision is None:
+            raise SuitcaseVcsError("Can't find %s version for %s" % (
+                self.__class__.__name__.lower(),
+                directory
+            ))
+        return revision
+
+    def clear_revisions(self):
+        """Forgets every revision looked up so far"""
+        self.revisions = {}
@@ -1,36 +1,267 @@
 """Bazaar helpers"""
 
-import commands
 import os
 import re
+import urllib
+
+try:
+    import bzrlib
+    from bzrlib.errors import BzrError
+    from bzrlib.workingtree import WorkingTree
+except ImportError:
+    bzrlib = None
 
-from suitcase.exceptions import SuitcaseVcsError
 from suitcase.vcs.base import VcsBase
+from suitcase.utils.runner import get_runner
+
+# Sections of verbose log output that list changed paths
+FILE_SECTIONS = ["added:", "removed:", "modified:", "renamed:", "kind changed:"]
+
+REVNO_REGEX = re.compile(r"^revno: (\d+)")
 
 class Bazaar(VcsBase):
-    
-    """Class for handling the interface to the bazaar vcs"""
-    
-    def get_directory_revision(self, directory):
-    
-        """Works on the basis of looking up from the local checkout"""
-        result = commands.getstatusoutput("bzr log -q -l 1 %s" % directory)
-        if result[0] > 0:
-            raise SuitcaseVcsError("Can't find bzr version for %s (%s)\n"\
-                "Command exited with error (%s), %s" % (
-                    directory, 
-                    os.getcwd(), 
-                    result[0], 
-                    result[1]
+
+    """Class for handling the interface to the bazaar vcs
+
+    When bzrlib can be imported each tree is opened once and every revision
+    is answered from its inventory and mainline, otherwise (or if use_bzrlib
+    is turned off) the output of bzr log is walked instead.
+
+    """
+
+    use_bzrlib = True
+
+    def __init__(self):
+        VcsBase.__init__(self)
+        if not "trees" in self.__dict__:
+            self.trees = {}
+
+    @staticmethod
+    def find_root(path):
+        """Walks up from path to the root of the working tree"""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+
+        while True:
+            if os.path.isdir(os.path.join(path, ".bzr", "checkout")):
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    @staticmethod
+    def get_freshness_token(root):
+        """Returns the tip revision id of the tree's branch
+
+        Follows lightweight checkouts to local branches, anything else isn't
+        cached.
+
+        """
+        branch_dir = os.path.join(root, ".bzr", "branch")
+        try:
+            location_file = os.path.join(branch_dir, "location")
+            if os.path.isfile(location_file):
+                location = open(location_file).read().strip()
+                if not location.startswith("file://"):
+                    return None
+                branch_dir = os.path.join(
+                    urllib.unquote(location[len("file://"):]),
+                    ".bzr",
+                    "branch"
                 )
+            return open(os.path.join(branch_dir, "last-revision")).read()\
+                .strip()
+        except IOError:
+            return None
+
+    @staticmethod
+    def parse_changed_path(line):
+        """Returns the paths named in one file line of verbose log output"""
+        paths = []
+        for path in line.strip().split(" => "):
+            # strip the kind markers bzr adds to dirs, executables and links
+            path = path.rstrip("/*@")
+            if path:
+                paths.append(path)
+        return paths
+
+    def find_revisions(self, paths):
+        """Works out the revnos for many paths with one walk of the log
+
+        Returns a dictionary keyed by the paths passed in, leaving out any
+        that aren't versioned.
+
+        """
+        revisions = {}
+        trees = {}
+        for path in paths:
+            root = self.find_root(path)
+            if root is None:
+                continue
+            relative_path = os.path.abspath(path)[len(root):].strip("/")
+            trees.setdefault(root, {}).setdefault(
+                relative_path, []
+            ).append(path)
+
+        unread = []
+        for root, pending in trees.items():
+            if self.use_bzrlib and bzrlib is not None:
+                try:
+                    revisions.update(self.read_tree(root, pending))
+                    continue
+                except BzrError:
+                    pass
+            unread.append((root, pending))
+
+        # the logs of different trees are walked at the same time
+        def walk_log(tree):
+            return self.walk_log(*tree)
+        for found in get_runner().map(walk_log, unread):
+            revisions.update(found)
+
+        return revisions
+
+    def find_changed_paths(self, root, since):
+        """Lists the paths that differ between since and the tree
+
+        Both sides of a rename are listed. Unknown files aren't.
+
+        """
+        changed_paths = []
+        output = self.run_command(root, ["bzr", "status", "-S", "-r", since])
+        for line in output.splitlines():
+            # short status is three status characters, a space and the path
+            if line[:3].strip() in ["", "?", "P"]:
+                continue
+            changed_paths.extend(self.parse_changed_path(line[4:]))
+        return changed_paths
+
+    def clear_revisions(self):
+        """Forgets every revision and tree read so far"""
+        VcsBase.clear_revisions(self)
+        self.trees = {}
+
+    def read_tree(self, root, pending):
+        """Answers pending from the tree at root without running bzr
+
+        pending maps paths relative to root onto the paths the caller used.
+
+        """
+        if root not in self.trees:
+            self.trees[root] = self.load_tree(root)
+
+        revisions = {}
+        for relative_path, paths in pending.items():
+            revno = self.trees[root].get(relative_path)
+            if revno is not None:
+                for path in paths:
+                    revisions[path] = "0.%s" % revno
+        return revisions
+
+    @staticmethod
+    def load_tree(root):
+        """Loads the revision graph and inventory of the tree at root once
+
+        Returns the mainline revno that last changed each versioned path
+        relative to root. Changes made on merged branches count against
+        the mainline revision that merged them, and directories take the
+        newest revno of anything under them, as bzr log -n1 shows.
+
+        """
+        if getattr(bzrlib, "global_state", None) is None and \
+            hasattr(bzrlib, "initialize"):
+            bzrlib.initialize()
+
+        tree = WorkingTree.open(root)
+        tree.lock_read()
+        try:
+            # merge sorted revisions come newest first with the revisions
+            # each mainline revision merged straight after it
+            mainline = {}
+            revno = None
+            for (revision_id, depth, revno_tuple, end_of_merge) in \
+                tree.branch.iter_merge_sorted_revisions(
+                    start_revision_id=tree.last_revision()
+                ):
+                if depth == 0:
+                    revno = revno_tuple[0]
+                mainline[revision_id] = revno
+
+            revnos = {}
+            basis = tree.basis_tree()
+            basis.lock_read()
+            try:
+                for (path, entry) in basis.iter_entries_by_dir():
+                    revno = mainline.get(entry.revision)
+                    if revno is None:
+                        continue
+                    while True:
+                        if revnos.get(path, 0) < revno:
+                            revnos[path] = revno
+                        if not path:
+                            break
+                        path = "/".join(path.split("/")[:-1])
+            finally:
+                basis.unlock()
+        finally:
+            tree.unlock()
+
+        return revnos
+
+    def walk_log(self, root, pending):
+        """Walks the mainline log of the tree at root newest first
+
+        pending maps paths relative to root onto the paths the caller used.
+        Every changed path is matched against itself and its parent
+        directories until nothing is left pending.
+
+        """
+        revisions = {}
+
+        # Only walk history below the deepest directory shared by all paths
+        common_path = os.path.commonprefix(
+            [relative_path.split("/") for relative_path in pending.keys()]
+        )
+        command = ["bzr", "log", "-v", "-n1", "--long"]
+        if common_path and common_path != [""]:
+            command.append("/".join(common_path))
+
+        running = self.start_command(root, command)
+
+        revno = None
+        in_file_section = False
+        for line in running.stdout:
+            line = line.rstrip("\n")
+            if not line.startswith(" "):
+                match = REVNO_REGEX.match(line)
+                if match is not None:
+                    revno = match.group(1)
+                in_file_section = line in FILE_SECTIONS
+                continue
+            if not in_file_section or revno is None:
+                continue
+
+            for changed_path in self.parse_changed_path(line):
+                while True:
+                    if changed_path in pending:
+                        for path in pending.pop(changed_path):
+                            revisions[path] = "0.%s" % revno
+                    if not changed_path:
+                        break
+                    changed_path = "/".join(changed_path.split("/")[:-1])
+
+            if not pending:
+                break
+
+        if pending:
+            self.check_result(
+                running.wait(),
+                "Can't find bzr version for %s" % root
             )
-            
         else:
-            match = re.search(r"^revno: (\d+)$", result[1], re.M)
-            if match is None:
-                raise SuitcaseVcsError(
-                    "Can't find bzr version for %s" % directory
-                )
-                
-            rev = match.group(1)
-            return "0.%s" % rev
+            # everything is resolved so the rest of the history is unwanted
+            running.stop()
+
+        return revisions
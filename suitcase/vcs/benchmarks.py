@@ -0,0 +1,127 @@
+"""Times the in-process git reader against forking git
+
+Builds a throwaway repository laid out like a tree of packages, then finds
+the last change of every package with GitRepository, with one git log walk
+and with a git log per package as suitcase used to. Run it directly:
+
+    python suitcase/vcs/benchmarks.py --packages 200 --commits 500
+
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import commands
+from optparse import OptionParser
+from tempfile import mkdtemp
+
+from suitcase.vcs.git import Git
+from suitcase.vcs.gitrepo import GitRepository
+
+GIT_ENVIRONMENT = "GIT_AUTHOR_NAME=suitcase "\
+    "GIT_AUTHOR_EMAIL=suitcase@example.com "\
+    "GIT_COMMITTER_NAME=suitcase "\
+    "GIT_COMMITTER_EMAIL=suitcase@example.com"
+
+def run_git(repository, command):
+    """Runs git in the repository, exiting if it fails"""
+    result = commands.getstatusoutput("cd '%s' && %s git %s" % (
+        repository,
+        GIT_ENVIRONMENT,
+        command
+    ))
+    if result[0] > 0:
+        sys.exit("git %s failed: %s" % (command, result[1]))
+    return result[1]
+
+def create_repository(package_count, commit_count):
+    """Creates a repository where each commit touches a few packages"""
+    repository = mkdtemp()
+    run_git(repository, "init -q")
+    packages = ["packages/package%04d" % index
+        for index in range(package_count)]
+    for package in packages:
+        os.makedirs(os.path.join(repository, package))
+
+    generator = random.Random(package_count)
+    for commit in range(commit_count):
+        for package in generator.sample(packages, min(3, package_count)):
+            open(os.path.join(repository, package, "version.txt"), "w")\
+                .write("%s\n" % commit)
+        run_git(repository, "add -A")
+        run_git(repository, "commit -q -m 'commit %s'" % commit)
+
+    return repository, packages
+
+def time_call(function, *args):
+    """Returns how long function took along with what it returned"""
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+def fork_per_package(repository, packages):
+    """The old way, one git log per package"""
+    return dict([(package, run_git(repository,
+        "log -1 --pretty=format:%%H -- '%s'" % package))
+        for package in packages])
+
+def report(name, seconds, result, expected):
+    """Prints one timing and whether the answers agree with git"""
+    print "%-28s %8.3fs %s" % (
+        name,
+        seconds,
+        result == expected and "ok" or "DIFFERENT",
+    )
+
+def run_benchmarks(repository, packages):
+    """Times each way of finding the packages' last changes"""
+    git = Git()
+    paths = [os.path.join(repository, package) for package in packages]
+
+    seconds, expected = time_call(fork_per_package, repository, packages)
+    report("git log per package", seconds, expected, expected)
+
+    seconds, result = time_call(
+        GitRepository(repository).find_last_changes,
+        packages
+    )
+    report("in-process reader", seconds, result, expected)
+
+    pending = dict([(package, [package]) for package in packages])
+    seconds, result = time_call(git.walk_log, repository, pending)
+    result = dict([(path, revision[2:])
+        for path, revision in result.items()])
+    report("single git log walk", seconds, result, expected)
+
+    git.clear_revisions()
+    seconds, result = time_call(git.get_revisions, paths)
+    result = dict([(path[len(repository) + 1:], revision[2:])
+        for path, revision in result.items()])
+    report("Git.get_revisions", seconds, result, expected)
+
+def main():
+    """Builds the repository and times it loose and then packed"""
+    parser = OptionParser()
+    parser.add_option("--packages", type="int", default=200,
+        help="number of package directories to create")
+    parser.add_option("--commits", type="int", default=500,
+        help="number of commits to make")
+    (options, args) = parser.parse_args()
+
+    repository, packages = create_repository(
+        options.packages,
+        options.commits
+    )
+    try:
+        print "Loose objects"
+        run_benchmarks(repository, packages)
+        run_git(repository, "gc -q")
+        print "Packed objects"
+        run_benchmarks(repository, packages)
+    finally:
+        shutil.rmtree(repository)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Persistent cache of revisions that survives between suitcase runs
+
+Revisions are stored per repository root along with a freshness token that
+the vcs class works out cheaply (e.g. the commit HEAD points at). When the
+token changes every revision stored for that root is thrown away.
+
+"""
+
+import os
+import hashlib
+import cPickle as pickle
+from tempfile import mkstemp
+
+from suitcase.exceptions import SuitcaseVcsError
+
+def get_cache_directory(global_config):
+    """Returns where the revision cache lives for this config"""
+    return os.path.join(
+        os.path.expanduser(global_config["build_directory"]),
+        "cache",
+        "revisions"
+    )
+
+def is_cache_enabled(global_config):
+    """Checks both the config file and the CLI for the cache being off"""
+    return global_config.get("revision_cache", True) and \
+        not global_config.get("no_revision_cache")
+
+class RevisionCache(object):
+
+    """On-disk store of revisions keyed by vcs, repository root and path"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.roots = {}
+
+    def get_filename(self, vcs_name, root):
+        """Works out the cache file for a repository root"""
+        return os.path.join(
+            self.directory,
+            "%s-%s" % (vcs_name, hashlib.md5(root).hexdigest())
+        )
+
+    def get(self, vcs_name, root, token):
+        """Returns the revisions for root, empty if they're stale"""
+        key = (vcs_name, root)
+        if key not in self.roots:
+            self.roots[key] = self.read(self.get_filename(vcs_name, root))
+
+        if self.roots[key].get("token") != token:
+            self.roots[key] = {"token": token, "revisions": {}}
+
+        return self.roots[key]["revisions"]
+
+    @staticmethod
+    def read(filename):
+        """Loads a cache file, anything unreadable counts as empty"""
+        try:
+            cache_file = open(filename, "rb")
+            try:
+                data = pickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except (IOError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError, IndexError):
+            return {}
+
+        if not isinstance(data, dict) or \
+            not isinstance(data.get("revisions"), dict):
+            return {}
+        return data
+
+    def save(self, vcs_name, root):
+        """Writes the revisions for root out atomically
+
+        The file is written alongside and renamed into place so that a
+        reader never sees half a cache, even with several builds running.
+
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, error:
+                if not os.path.isdir(self.directory):
+                    raise SuitcaseVcsError(error)
+
+        (handle, temp_filename) = mkstemp(dir=self.directory)
+        try:
+            temp_file = os.fdopen(handle, "wb")
+            try:
+                pickle.dump(
+                    self.roots[(vcs_name, root)],
+                    temp_file,
+                    pickle.HIGHEST_PROTOCOL
+                )
+            finally:
+                temp_file.close()
+            os.rename(temp_filename, self.get_filename(vcs_name, root))
+        except (IOError, OSError), error:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise SuitcaseVcsError("Can't write revision cache: %s" % error)
+
+    def clear(self):
+        """Deletes every cache file"""
+        self.roots = {}
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, filename))
@@ -1,37 +1,187 @@
 """Git helpers"""
 
-import commands
 import os
-import re
+import zlib
 
 from suitcase.exceptions import SuitcaseVcsError
 from suitcase.vcs.base import VcsBase
+from suitcase.vcs.gitrepo import GitRepository
+from suitcase.utils.runner import get_runner
+
+# Marks the start of a commit in the log output walked by walk_log
+COMMIT_MARKER = "\0"
 
 class Git(VcsBase):
-    
-    """Class for handling the interface to the git vcs"""
-    
-    def get_directory_revision(self, directory):
-    
-        """Works on the basis of looking up from the local checkout"""
-        os.chdir(directory)
-        result = commands.getstatusoutput("git log -1")
-        if result[0] > 0:
-            raise SuitcaseVcsError("Can't find git version for %s (%s)\n"\
-                "Command exited with error (%s), %s" % (
-                    directory, 
-                    os.getcwd(), 
-                    result[0], 
-                    result[1]
-                )
+
+    """Class for handling the interface to the git vcs
+
+    Revisions are worked out by reading the repository in-process, falling
+    back to walking the output of git log if the repository can't be read
+    (or use_reader is turned off).
+
+    """
+
+    use_reader = True
+
+    def __init__(self):
+        VcsBase.__init__(self)
+        if not "repositories" in self.__dict__:
+            self.repositories = {}
+
+    @staticmethod
+    def find_root(path):
+        """Walks up from path to the directory holding the .git dir"""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+
+        while True:
+            if os.path.exists(os.path.join(path, ".git")):
+                return path
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def get_repository(self, root):
+        """Returns the in-process reader for root, kept for the whole run
+
+        Holding on to it means the commits and trees parsed for one batch
+        of paths are there for the next.
+
+        """
+        if root not in self.repositories:
+            self.repositories[root] = GitRepository(root)
+        return self.repositories[root]
+
+    def get_freshness_token(self, root):
+        """Returns the commit HEAD points at, read without running git
+
+        History can't change under a commit so every revision found while
+        HEAD stays put is still valid.
+
+        """
+        try:
+            return GitRepository(root).resolve_ref("HEAD")
+        except (SuitcaseVcsError, EnvironmentError):
+            return None
+
+    def find_revisions(self, paths):
+        """Finds the last commit touching each path in one pass of history
+
+        Returns a dictionary keyed by the paths passed in. Paths that are
+        not tracked by git are left out so that callers can decide on a
+        fallback. No git processes are run when the repository can be read
+        in-process, and at most one per repository when it can't.
+
+        """
+        revisions = {}
+        repositories = {}
+        for path in paths:
+            root = self.find_root(path)
+            if root is None:
+                continue
+            relative_path = os.path.abspath(path)[len(root):].strip("/")
+            repositories.setdefault(root, {}).setdefault(
+                relative_path, []
+            ).append(path)
+
+        unread = []
+        for root, pending in repositories.items():
+            if self.use_reader:
+                try:
+                    revisions.update(self.read_history(root, pending))
+                    continue
+                except (SuitcaseVcsError, EnvironmentError, ValueError,
+                    zlib.error):
+                    pass
+            unread.append((root, pending))
+
+        # the logs of different repositories are walked at the same time
+        def walk_log(repository):
+            return self.walk_log(*repository)
+        for found in get_runner().map(walk_log, unread):
+            revisions.update(found)
+
+        return revisions
+
+    def find_changed_paths(self, root, since):
+        """Lists the files that differ between since and HEAD"""
+        output = self.run_command(root, [
+            "git", "diff", "--no-renames", "--name-only", "-z",
+            since, "HEAD", "--",
+        ])
+        return [path for path in output.split("\0") if path]
+
+    def clear_revisions(self):
+        """Forgets every revision and repository read so far"""
+        VcsBase.clear_revisions(self)
+        self.repositories = {}
+
+    def read_history(self, root, pending):
+        """Works out the last commits for pending without running git
+
+        pending maps paths relative to root onto the paths the caller used.
+
+        """
+        revisions = {}
+        changes = self.get_repository(root).find_last_changes(pending.keys())
+        for relative_path, commit in changes.items():
+            for path in pending[relative_path]:
+                revisions[path] = "0.%s" % commit
+        return revisions
+
+    def walk_log(self, root, pending):
+        """Walks the log of the repository at root newest first
+
+        pending maps paths relative to root onto the paths the caller
+        used. Each changed file is matched against itself and all of its
+        parent directories, and the walk stops as soon as every pending
+        path has been resolved.
+
+        """
+        revisions = {}
+
+        # Only walk history below the deepest directory shared by all paths
+        common_path = os.path.commonprefix(
+            [relative_path.split("/") for relative_path in pending.keys()]
+        )
+        command = [
+            "git", "log", "--no-renames", "--name-only",
+            "--pretty=format:%x00%H",
+        ]
+        if common_path and common_path != [""]:
+            command += ["--", "/".join(common_path)]
+
+        running = self.start_command(root, command)
+
+        commit = None
+        for line in running.stdout:
+            line = line.rstrip("\n")
+            if line.startswith(COMMIT_MARKER):
+                commit = line[len(COMMIT_MARKER):]
+                continue
+            if not line or commit is None:
+                continue
+
+            while True:
+                if line in pending:
+                    for path in pending.pop(line):
+                        revisions[path] = "0.%s" % commit
+                if not line:
+                    break
+                line = "/".join(line.split("/")[:-1])
+
+            if not pending:
+                break
+
+        if pending:
+            self.check_result(
+                running.wait(),
+                "Can't find git version for %s" % root
             )
-            
         else:
-            match = re.search(r"^commit ([A-Za-z0-9_-]+)", result[1], re.M)
-            if match is None:
-                raise SuitcaseVcsError(
-                    "Can't find git version for %s" % directory
-                )
-                
-            rev = match.group(1)
-            return "0.%s" % rev
+            # everything is resolved so the rest of the history is unwanted
+            running.stop()
+
+        return revisions
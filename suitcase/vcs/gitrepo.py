@@ -0,0 +1,553 @@
+"""Reads git repositories in-process without running git
+
+Understands loose and packed refs, loose objects and pack files (through
+their idx, following both offset and ref deltas) and parses commits and
+trees. That's enough to work out the last commit to change any path, which
+is all suitcase needs, without forking a single git process.
+
+"""
+
+import os
+import mmap
+import zlib
+import struct
+from binascii import hexlify, unhexlify
+from heapq import heappush, heappop
+
+from suitcase.exceptions import SuitcaseVcsError
+
+OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+TREE_MODE = "40000"
+
+# How many delta bases and parsed trees to keep hold of
+BASE_CACHE_SIZE = 512
+TREE_CACHE_SIZE = 65536
+
+def find_git_dir(root):
+    """Returns the git dir for root, following .git files to worktrees"""
+    git_dir = os.path.join(root, ".git")
+    if os.path.isfile(git_dir):
+        contents = open(git_dir).read().strip()
+        if contents.startswith("gitdir:"):
+            git_dir = os.path.join(root, contents[len("gitdir:"):].strip())
+    return git_dir
+
+def map_file(path):
+    """Memory maps a file read only"""
+    map_handle = open(path, "rb")
+    try:
+        return mmap.mmap(map_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        map_handle.close()
+
+def read_varint(data, index):
+    """Reads a little endian base 128 number as used in delta headers"""
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[index])
+        index += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, index
+
+def apply_delta(base, delta):
+    """Rebuilds an object from its delta base and a git delta"""
+    base_size, index = read_varint(delta, 0)
+    result_size, index = read_varint(delta, index)
+    if base_size != len(base):
+        raise SuitcaseVcsError("Git delta base is the wrong size")
+
+    result = []
+    length = len(delta)
+    while index < length:
+        opcode = ord(delta[index])
+        index += 1
+        if opcode & 0x80:
+            # copy a slice of the base
+            copy_offset = 0
+            for bit in range(4):
+                if opcode & (1 << bit):
+                    copy_offset |= ord(delta[index]) << (bit * 8)
+                    index += 1
+            copy_size = 0
+            for bit in range(3):
+                if opcode & (0x10 << bit):
+                    copy_size |= ord(delta[index]) << (bit * 8)
+                    index += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            result.append(base[copy_offset:copy_offset + copy_size])
+        elif opcode:
+            # insert the next opcode bytes of the delta
+            result.append(delta[index:index + opcode])
+            index += opcode
+        else:
+            raise SuitcaseVcsError("Git delta has an invalid opcode")
+
+    result = "".join(result)
+    if len(result) != result_size:
+        raise SuitcaseVcsError("Git delta result is the wrong size")
+    return result
+
+
+class PackFile(object):
+
+    """A pack file along with the idx used to find objects in it"""
+
+    def __init__(self, idx_path):
+        self.idx_path = idx_path
+        self.pack_path = "%s.pack" % idx_path[:-len(".idx")]
+        self.idx = map_file(idx_path)
+        self.pack = None
+
+        if self.idx[:4] == "\377tOc":
+            version = struct.unpack(">I", self.idx[4:8])[0]
+            if version != 2:
+                raise SuitcaseVcsError(
+                    "Unsupported pack idx version %s in %s" % (
+                        version,
+                        idx_path
+                    )
+                )
+            self.version = 2
+            fanout_offset = 8
+        else:
+            self.version = 1
+            fanout_offset = 0
+
+        self.fanout = struct.unpack(
+            ">256I",
+            self.idx[fanout_offset:fanout_offset + 1024]
+        )
+        self.count = self.fanout[255]
+        self.sha_offset = fanout_offset + 1024
+        self.offset_offset = self.sha_offset + 24 * self.count
+        self.large_offset_offset = self.offset_offset + 4 * self.count
+
+    def get_sha(self, index):
+        """Returns the binary sha of entry index in the idx"""
+        if self.version == 2:
+            start = self.sha_offset + 20 * index
+        else:
+            start = self.sha_offset + 24 * index + 4
+        return self.idx[start:start + 20]
+
+    def get_offset(self, index):
+        """Returns the offset into the pack of entry index in the idx"""
+        if self.version == 1:
+            start = self.sha_offset + 24 * index
+            return struct.unpack(">I", self.idx[start:start + 4])[0]
+
+        start = self.offset_offset + 4 * index
+        offset = struct.unpack(">I", self.idx[start:start + 4])[0]
+        if offset & 0x80000000:
+            start = self.large_offset_offset + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack(">Q", self.idx[start:start + 8])[0]
+        return offset
+
+    def find_offset(self, binary_sha):
+        """Binary searches the idx for a sha, returns None if it's not here"""
+        first_byte = ord(binary_sha[0])
+        low = first_byte and self.fanout[first_byte - 1] or 0
+        high = self.fanout[first_byte]
+        while low < high:
+            middle = (low + high) // 2
+            middle_sha = self.get_sha(middle)
+            if middle_sha < binary_sha:
+                low = middle + 1
+            elif middle_sha > binary_sha:
+                high = middle
+            else:
+                return self.get_offset(middle)
+        return None
+
+    def read_header(self, offset):
+        """Reads the type and inflated size at the start of a pack entry"""
+        if self.pack is None:
+            self.pack = map_file(self.pack_path)
+
+        byte = ord(self.pack[offset])
+        offset += 1
+        object_type = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        while byte & 0x80:
+            byte = ord(self.pack[offset])
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return object_type, size, offset
+
+    def inflate(self, offset, size):
+        """Inflates size bytes of zlib data starting at offset"""
+        decompressor = zlib.decompressobj()
+        chunks = []
+        inflated = 0
+        # compressed data is rarely much bigger than what it inflates to
+        chunk_size = size + 1024
+        while inflated < size:
+            chunk = self.pack[offset:offset + chunk_size]
+            if not chunk:
+                raise SuitcaseVcsError(
+                    "Truncated object in %s" % self.pack_path
+                )
+            offset += len(chunk)
+            data = decompressor.decompress(chunk)
+            inflated += len(data)
+            chunks.append(data)
+            if decompressor.unused_data:
+                break
+            chunk_size = 65536
+        return "".join(chunks)[:size]
+
+    def read_object(self, offset, repository):
+        """Returns the (type, data) of the entry at offset
+
+        Deltas are resolved against their bases, which are looked up through
+        the repository so ref deltas can point into other packs.
+
+        """
+        object_type, size, data_offset = self.read_header(offset)
+
+        if object_type == OFS_DELTA:
+            byte = ord(self.pack[data_offset])
+            data_offset += 1
+            base_distance = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(self.pack[data_offset])
+                data_offset += 1
+                base_distance = ((base_distance + 1) << 7) | (byte & 0x7f)
+            base_type, base = repository.read_pack_base(
+                self,
+                offset - base_distance
+            )
+            return base_type, apply_delta(base, self.inflate(data_offset, size))
+
+        if object_type == REF_DELTA:
+            base_sha = self.pack[data_offset:data_offset + 20]
+            base_type, base = repository.read_binary_object(base_sha)
+            return base_type, apply_delta(
+                base,
+                self.inflate(data_offset + 20, size)
+            )
+
+        if object_type not in OBJECT_TYPES:
+            raise SuitcaseVcsError(
+                "Unknown object type %s in %s" % (object_type, self.pack_path)
+            )
+        return OBJECT_TYPES[object_type], self.inflate(data_offset, size)
+
+
+class GitRepository(object):
+
+    """In-process reader for the objects and refs of a git repository"""
+
+    def __init__(self, root):
+        self.root = root
+        self.git_dir = find_git_dir(root)
+        self.common_dir = self.git_dir
+
+        commondir_file = os.path.join(self.git_dir, "commondir")
+        if os.path.isfile(commondir_file):
+            self.common_dir = os.path.join(
+                self.git_dir,
+                open(commondir_file).read().strip()
+            )
+
+        if not os.path.isdir(os.path.join(self.common_dir, "objects")):
+            raise SuitcaseVcsError("%s is not a git repository" % root)
+
+        self.object_dirs = [os.path.join(self.common_dir, "objects")]
+        alternates = os.path.join(
+            self.common_dir,
+            "objects",
+            "info",
+            "alternates"
+        )
+        if os.path.isfile(alternates):
+            for line in open(alternates):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    self.object_dirs.append(
+                        os.path.join(self.object_dirs[0], line)
+                    )
+
+        self.shallow = {}
+        shallow_file = os.path.join(self.common_dir, "shallow")
+        if os.path.isfile(shallow_file):
+            for line in open(shallow_file):
+                self.shallow[line.strip()] = 1
+
+        self.packs = None
+        self.commits = {}
+        self.trees = {}
+        self.bases = {}
+
+    #=========================================================================
+    # Refs
+    #=========================================================================
+    def resolve_ref(self, name="HEAD"):
+        """Returns the hex sha a ref points at, following symbolic refs"""
+        for _ in range(10):
+            value = None
+            for ref_dir in (self.git_dir, self.common_dir):
+                ref_file = os.path.join(ref_dir, name)
+                if os.path.isfile(ref_file):
+                    value = open(ref_file).read().strip()
+                    break
+
+            if value is None:
+                value = self.read_packed_ref(name)
+                if value is None:
+                    raise SuitcaseVcsError("Can't find git ref %s" % name)
+
+            if not value.startswith("ref: "):
+                return value
+            name = value[len("ref: "):]
+
+        raise SuitcaseVcsError("Git ref %s is nested too deeply" % name)
+
+    def read_packed_ref(self, name):
+        """Looks a ref up in packed-refs"""
+        packed_refs = os.path.join(self.common_dir, "packed-refs")
+        if os.path.isfile(packed_refs):
+            for line in open(packed_refs):
+                if line.startswith("#") or line.startswith("^"):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == name:
+                    return parts[0]
+        return None
+
+    #=========================================================================
+    # Objects
+    #=========================================================================
+    def get_packs(self):
+        """Opens the idx of every pack file"""
+        if self.packs is None:
+            self.packs = []
+            for object_dir in self.object_dirs:
+                pack_dir = os.path.join(object_dir, "pack")
+                if not os.path.isdir(pack_dir):
+                    continue
+                for filename in sorted(os.listdir(pack_dir)):
+                    if filename.endswith(".idx"):
+                        self.packs.append(
+                            PackFile(os.path.join(pack_dir, filename))
+                        )
+        return self.packs
+
+    def read_pack_base(self, pack, offset):
+        """Reads a delta base, keeping recently used ones to hand"""
+        key = (pack.pack_path, offset)
+        if key not in self.bases:
+            if len(self.bases) >= BASE_CACHE_SIZE:
+                self.bases = {}
+            self.bases[key] = pack.read_object(offset, self)
+        return self.bases[key]
+
+    def read_binary_object(self, binary_sha):
+        """Returns the (type, data) of an object from its binary sha"""
+        hex_sha = hexlify(binary_sha)
+        for object_dir in self.object_dirs:
+            loose_path = os.path.join(object_dir, hex_sha[:2], hex_sha[2:])
+            if os.path.isfile(loose_path):
+                loose_file = open(loose_path, "rb")
+                try:
+                    data = zlib.decompress(loose_file.read())
+                finally:
+                    loose_file.close()
+                header_end = data.index("\0")
+                object_type = data[:header_end].split(" ")[0]
+                return object_type, data[header_end + 1:]
+
+        for pack in self.get_packs():
+            offset = pack.find_offset(binary_sha)
+            if offset is not None:
+                return pack.read_object(offset, self)
+
+        raise SuitcaseVcsError("Can't find git object %s" % hex_sha)
+
+    def read_object(self, sha):
+        """Returns the (type, data) of an object from its hex sha"""
+        return self.read_binary_object(unhexlify(sha))
+
+    def read_commit(self, sha):
+        """Returns the (tree, parents, commit time) of a commit"""
+        if sha not in self.commits:
+            object_type, data = self.read_object(sha)
+            if object_type != "commit":
+                raise SuitcaseVcsError("Git object %s isn't a commit" % sha)
+
+            tree = None
+            parents = []
+            commit_time = 0
+            for line in data[:data.find("\n\n")].split("\n"):
+                if line.startswith("tree "):
+                    tree = line[5:]
+                elif line.startswith("parent "):
+                    parents.append(line[7:])
+                elif line.startswith("committer "):
+                    commit_time = int(line.split()[-2])
+
+            if sha in self.shallow:
+                parents = []
+            self.commits[sha] = (tree, parents, commit_time)
+        return self.commits[sha]
+
+    def read_tree(self, sha):
+        """Returns a tree as a dictionary of name: (mode, hex sha)"""
+        if sha not in self.trees:
+            object_type, data = self.read_object(sha)
+            if object_type != "tree":
+                raise SuitcaseVcsError("Git object %s isn't a tree" % sha)
+
+            entries = {}
+            index = 0
+            length = len(data)
+            while index < length:
+                space = data.index(" ", index)
+                null = data.index("\0", space)
+                entries[data[space + 1:null]] = (
+                    data[index:space],
+                    hexlify(data[null + 1:null + 21])
+                )
+                index = null + 21
+
+            if len(self.trees) >= TREE_CACHE_SIZE:
+                self.trees = {}
+            self.trees[sha] = entries
+        return self.trees[sha]
+
+    def find_path(self, tree, path):
+        """Returns the sha of path within tree or None if it isn't there"""
+        sha = tree
+        mode = TREE_MODE
+        for name in path.split("/"):
+            if not name:
+                continue
+            if mode != TREE_MODE:
+                return None
+            entry = self.read_tree(sha).get(name)
+            if entry is None:
+                return None
+            mode, sha = entry
+        return sha
+
+    #=========================================================================
+    # History
+    #=========================================================================
+    def find_changed(self, tree, parent_tree, paths, depth=0):
+        """Returns which of paths differ between tree and parent_tree
+
+        paths are tuples of names. Only subtrees that differ are read, so a
+        whole group of paths below an unchanged directory costs one
+        comparison. Either tree can be None for one that doesn't exist.
+
+        """
+        if tree == parent_tree:
+            return []
+
+        changed = []
+        groups = {}
+        for path in paths:
+            if len(path) == depth:
+                changed.append(path)
+            else:
+                groups.setdefault(path[depth], []).append(path)
+
+        if not groups:
+            return changed
+
+        entries = tree and self.read_tree(tree) or {}
+        parent_entries = parent_tree and self.read_tree(parent_tree) or {}
+        for name, group in groups.items():
+            entry = entries.get(name)
+            parent_entry = parent_entries.get(name)
+            if entry == parent_entry:
+                continue
+
+            subtree = None
+            if entry and entry[0] == TREE_MODE:
+                subtree = entry[1]
+            parent_subtree = None
+            if parent_entry and parent_entry[0] == TREE_MODE:
+                parent_subtree = parent_entry[1]
+
+            deeper = []
+            for path in group:
+                if len(path) == depth + 1:
+                    changed.append(path)
+                else:
+                    deeper.append(path)
+            if deeper:
+                changed += self.find_changed(
+                    subtree,
+                    parent_subtree,
+                    deeper,
+                    depth + 1
+                )
+
+        return changed
+
+    def find_last_changes(self, paths, commit=None):
+        """Works out the last commit to change each path
+
+        paths are relative to the root of the repository, "" being the
+        root itself. History is walked newest first from commit (HEAD by
+        default) and each path follows the first parent it is unchanged
+        in, as git log does. Every commit is read once however many paths
+        go through it. Returns a dictionary of path: hex sha and leaves
+        out paths that don't exist at commit.
+
+        """
+        if commit is None:
+            commit = self.resolve_ref("HEAD")
+
+        tree = self.read_commit(commit)[0]
+        pending = {commit: {}}
+        for path in paths:
+            if self.find_path(tree, path) is not None:
+                pending[commit][tuple([name for name in path.split("/")
+                    if name])] = 1
+
+        changes = {}
+        queue = [(-self.read_commit(commit)[2], commit)]
+        while queue:
+            commit = heappop(queue)[1]
+            undecided = pending.pop(commit, {}).keys()
+            if not undecided:
+                continue
+
+            tree, parents, _ = self.read_commit(commit)
+            for parent in parents:
+                parent_tree = self.read_commit(parent)[0]
+                changed = dict([
+                    (path, 1) for path in
+                    self.find_changed(tree, parent_tree, undecided)
+                ])
+
+                # paths unchanged in this parent carry on down its history
+                for path in undecided:
+                    if path not in changed:
+                        if parent not in pending:
+                            pending[parent] = {}
+                            heappush(
+                                queue,
+                                (-self.read_commit(parent)[2], parent)
+                            )
+                        pending[parent][path] = 1
+
+                undecided = changed.keys()
+                if not undecided:
+                    break
+
+            for path in undecided:
+                changes["/".join(path)] = commit
+
+        return changes
@@ -1,57 +1,271 @@
 """Subversion helpers"""
 
-import commands
 import os
 import re
+import urllib
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 
 from suitcase.exceptions import SuitcaseVcsError
 from suitcase.vcs.base import VcsBase
+from suitcase.utils.runner import get_runner
 
 class Subversion(VcsBase):
-    
+
     """Class interface to subversion"""
 
+    def __init__(self):
+        VcsBase.__init__(self)
+        if not "working_copies" in self.__dict__:
+            self.working_copies = {}
+
+    @staticmethod
+    def find_root(path):
+        """Walks up from path to the top of the working copy it's in
+
+        Copes with both the single .svn dir of subversion 1.7+ and the
+        per-directory .svn dirs of older working copies.
+
+        """
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+
+        while not os.path.isdir(os.path.join(path, ".svn")):
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+        while True:
+            parent = os.path.dirname(path)
+            if parent == path or \
+                not os.path.isdir(os.path.join(parent, ".svn")):
+                return path
+            path = parent
+
+    @staticmethod
+    def get_freshness_token(root):
+        """Returns the size and mtime of the working copy db
+
+        Every update or commit rewrites the db. Older working copies without
+        one aren't cached.
+
+        """
+        try:
+            stat = os.stat(os.path.join(root, ".svn", "wc.db"))
+        except OSError:
+            return None
+        return "%s-%s" % (stat.st_mtime, stat.st_size)
+
+    @staticmethod
+    def read_wc_db(root):
+        """Reads last changed revisions straight out of the working copy db
+
+        Only works for subversion 1.7+ working copies, returns None if the
+        db can't be used so that the caller can fall back to svn info.
+
+        """
+        wc_db = os.path.join(root, ".svn", "wc.db")
+        if sqlite3 is None or not os.path.isfile(wc_db):
+            return None
+
+        try:
+            connection = sqlite3.connect(wc_db)
+            try:
+                rows = connection.execute(
+                    "SELECT local_relpath, changed_revision FROM nodes "\
+                    "WHERE op_depth = 0 AND presence = 'normal' "\
+                    "AND changed_revision IS NOT NULL"
+                ).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return None
+
+        return dict([(str(path), int(revision)) for path, revision in rows])
+
+    def read_info_xml(self, root):
+        """Reads last changed revisions from a recursive svn info
+
+        svn info only looks at the local working copy metadata so this is
+        a single process and never touches the server.
+
+        """
+        running = self.start_command(root, ["svn", "info", "--xml", "-R", "."])
+
+        revisions = {}
+        try:
+            for event, element in ElementTree.iterparse(running.stdout):
+                if element.tag != "entry":
+                    continue
+                commit = element.find("commit")
+                if commit is not None and commit.get("revision"):
+                    path = element.get("path")
+                    if path == ".":
+                        path = ""
+                    revisions[path] = int(commit.get("revision"))
+                element.clear()
+        except SyntaxError:
+            # the rest is read so svn isn't left blocked writing it
+            running.stdout.read()
+
+        self.check_result(
+            running.wait(),
+            "Can't find svn versions for %s" % root
+        )
+        return revisions
+
+    def read_working_copy(self, root):
+        """Returns the last changed revision of everything below root
+
+        Each path is keyed relative to root and every directory carries the
+        newest revision of anything inside it, so a directory lookup gives
+        the same answer as svn log on its URL would.
+
+        """
+        revisions = self.read_wc_db(root)
+        if revisions is None:
+            revisions = self.read_info_xml(root)
+
+        subtree_revisions = {}
+        for path, revision in revisions.items():
+            while True:
+                if subtree_revisions.get(path, 0) < revision:
+                    subtree_revisions[path] = revision
+                if not path:
+                    break
+                path = "/".join(path.split("/")[:-1])
+
+        return subtree_revisions
+
+    def find_revisions(self, paths):
+        """Works out the revnos for many paths from working copy metadata
+
+        Every working copy involved is read once per run, no matter how many
+        paths are asked for, and nothing goes over the network. Revisions are as
+        of the last update of the working copy. Paths that aren't under
+        version control are left out.
+
+        """
+        revisions = {}
+        working_copies = {}
+        for path in paths:
+            root = self.find_root(path)
+            if root is None:
+                continue
+            relative_path = os.path.abspath(path)[len(root):].strip("/")
+            working_copies.setdefault(root, []).append((relative_path, path))
+
+        # working copies that haven't been read yet are read at once
+        unread = [unread_root for unread_root in working_copies.keys()
+            if unread_root not in self.working_copies]
+        for root, subtree_revisions in zip(
+            unread,
+            get_runner().map(self.read_working_copy, unread)
+        ):
+            self.working_copies[root] = subtree_revisions
+
+        for root, wanted in working_copies.items():
+            subtree_revisions = self.working_copies[root]
+            for relative_path, path in wanted:
+                if subtree_revisions.get(relative_path):
+                    revisions[path] = "0.%s" % \
+                        subtree_revisions[relative_path]
+
+        return revisions
+
+    def find_changed_paths(self, root, since):
+        """Lists the paths changed in commits after since up to HEAD
+
+        The log gives paths from the top of the repository, so the
+        working copy's own place in the repository (read locally with svn
+        info) is stripped off and anything outside it is dropped.
+
+        """
+        info = ElementTree.fromstring(
+            self.run_command(root, ["svn", "info", "--xml", "."])
+        )
+        branch_path = urllib.unquote(
+            info.findtext("entry/url")[
+                len(info.findtext("entry/repository/root")):
+            ]
+        ).rstrip("/")
+
+        log = ElementTree.fromstring(self.run_command(root, [
+            "svn", "log", "-v", "--xml", "-r", "%s:HEAD" % since, ".",
+        ]))
+        changed_paths = []
+        for entry in log.findall("logentry"):
+            # the range includes since itself, which isn't wanted
+            if entry.get("revision") == str(since):
+                continue
+            for path in entry.findall("paths/path"):
+                path = path.text or ""
+                if path == branch_path:
+                    changed_paths.append("")
+                elif path.startswith(branch_path + "/"):
+                    changed_paths.append(path[len(branch_path) + 1:])
+        return changed_paths
+
+    def clear_revisions(self):
+        """Forgets every revision and working copy read so far"""
+        VcsBase.clear_revisions(self)
+        self.working_copies = {}
+
     def get_remote_branch_location(self, directory):
-    
+
         """Works out the URL of remote branch"""
-        result = commands.getstatusoutput("svn info %s" % directory)
-        if result[0] > 0:
+        result = get_runner().run(
+            ["svn", "info", directory],
+            combine_output=True
+        )
+        if result.returncode != 0 or result.timed_out:
             raise SuitcaseVcsError("Can't find svn version for %s (%s)\n"\
                 "Command exited with error (%s), %s" % (
                     directory,
                     os.getcwd(),
-                    result[0],
-                    result[1],
+                    result.returncode,
+                    result.output or result.error_output,
                 )
             )
-            
+
         else:
-            match = re.search(r"^URL: (.*?)$", result[1], re.M)
+            match = re.search(r"^URL: (.*?)$", result.output, re.M)
             if match is None:
                 raise SuitcaseVcsError("Can't find svn url for %s" % directory)
             url = match.group(1)
-                
+
             return url
 
-    def get_directory_revision(self, directory):
-    
+    def get_remote_directory_revision(self, directory):
+
         """Works out the revno for a path by querying the remote repo"""
         remote_dir = self.get_remote_branch_location(directory)
-        result = commands.getstatusoutput(
-            "svn log -q --limit 1 %s" % remote_dir
+        result = get_runner().run(
+            ["svn", "log", "-q", "--limit", "1", remote_dir],
+            combine_output=True
         )
-        
-        if result[0] > 0:
+
+        if result.returncode != 0 or result.timed_out:
             raise SuitcaseVcsError("Can't find svn version for %s (%s)\n"\
                 "Command exited with error (%s), %s" % (
-                    directory, 
-                    os.getcwd(), 
-                    result[0], 
-                    result[1]
+                    directory,
+                    os.getcwd(),
+                    result.returncode,
+                    result.output or result.error_output,
                 )
             )
         else:
-            match = re.search(r"^r(\d+) ", result[1], re.MULTILINE)
+            match = re.search(r"^r(\d+) ", result.output, re.MULTILINE)
             if match is None:
                 raise SuitcaseVcsError(
                     "Can't find svn version for %s" % directory
@@ -0,0 +1,461 @@
+"""Tests for the vcs classes"""
+
+import os
+import unittest
+import shutil
+import commands
+from tempfile import mkdtemp
+
+from suitcase.vcs import bazaar
+from suitcase.vcs.base import VcsBase
+from suitcase.vcs.cache import RevisionCache
+from suitcase.vcs.git import Git
+from suitcase.vcs.gitrepo import GitRepository
+from suitcase.vcs.subversion import Subversion
+
+
+class CountingVcs(VcsBase):
+
+    """A fake vcs that records the paths it is asked to look up"""
+
+    token = "1"
+
+    def find_root(self, path):
+        """Everything lives in one repository"""
+        return "/"
+
+    def get_freshness_token(self, root):
+        """Returns whatever the test has set"""
+        return self.token
+
+    def find_revisions(self, paths):
+        """Gives every path except missing ones revision 1"""
+        self.lookups.append(paths)
+        return dict([
+            (path, "0.1") for path in paths if not path.endswith("missing")
+        ])
+
+
+class VcsBaseTestCase(unittest.TestCase):
+
+    """Tests for the shared revision memo"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    def setUp(self):
+        """Sets up a fresh fake vcs"""
+        self.vcs = CountingVcs()
+        self.vcs.clear_revisions()
+        self.vcs.lookups = []
+
+    def test_bulk_lookup(self):
+        """Test paths are looked up together and misses are left out"""
+        revisions = self.vcs.get_revisions(["/a", "/b", "/missing"])
+        self.assert_equal(revisions, {"/a": "0.1", "/b": "0.1"})
+        self.assert_equal(self.vcs.lookups, [["/a", "/b", "/missing"]])
+
+    def test_memo(self):
+        """Test no path is looked up twice, including misses"""
+        self.vcs.get_revisions(["/a", "/missing"])
+        revisions = self.vcs.get_revisions(["/a", "/b", "/missing", "/b"])
+        self.assert_equal(revisions, {"/a": "0.1", "/b": "0.1"})
+        self.assert_equal(self.vcs.lookups, [["/a", "/missing"], ["/b"]])
+
+    def test_memo_is_shared(self):
+        """Test the memo is shared between instances of the singleton"""
+        CountingVcs().get_revisions(["/a"])
+        self.assert_equal(CountingVcs().get_directory_revision("/a"), "0.1")
+        self.assert_equal(self.vcs.lookups, [["/a"]])
+
+
+class RevisionCacheTestCase(unittest.TestCase):
+
+    """Tests for the persistent revision cache"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    def setUp(self):
+        """Sets up the fake vcs with a cache in a temp dir"""
+        self.temp_dir = mkdtemp()
+        self.vcs = CountingVcs()
+        self.vcs.clear_revisions()
+        self.vcs.lookups = []
+        self.vcs.token = "1"
+        self.vcs.set_cache(RevisionCache(self.temp_dir))
+
+    def tearDown(self):
+        """Removes the cache"""
+        self.vcs.set_cache(None)
+        shutil.rmtree(self.temp_dir)
+
+    def new_run(self):
+        """Starts again as a fresh suitcase run would"""
+        self.vcs.clear_revisions()
+        self.vcs.set_cache(RevisionCache(self.temp_dir))
+
+    def test_warm_run(self):
+        """Test a second run is answered from disk"""
+        self.vcs.get_revisions(["/a", "/missing"])
+        self.new_run()
+        revisions = self.vcs.get_revisions(["/a", "/missing"])
+        self.assert_equal(revisions, {"/a": "0.1"})
+        self.assert_equal(self.vcs.lookups, [["/a", "/missing"]])
+        self.assert_equal((self.vcs.cache.hits, self.vcs.cache.misses), (2, 0))
+
+    def test_token_change(self):
+        """Test a new freshness token invalidates the cache"""
+        self.vcs.get_revisions(["/a"])
+        self.new_run()
+        self.vcs.token = "2"
+        self.vcs.get_revisions(["/a"])
+        self.assert_equal(self.vcs.lookups, [["/a"], ["/a"]])
+        self.assert_equal((self.vcs.cache.hits, self.vcs.cache.misses), (0, 1))
+
+    def test_clear(self):
+        """Test clearing the cache"""
+        self.vcs.get_revisions(["/a"])
+        RevisionCache(self.temp_dir).clear()
+        self.new_run()
+        self.vcs.get_revisions(["/a"])
+        self.assert_equal(self.vcs.lookups, [["/a"], ["/a"]])
+
+    def test_corrupt_cache(self):
+        """Test an unreadable cache file is treated as empty"""
+        self.vcs.get_revisions(["/a"])
+        for filename in os.listdir(self.temp_dir):
+            open(os.path.join(self.temp_dir, filename), "w").write("junk")
+        self.new_run()
+        self.assert_equal(self.vcs.get_revisions(["/a"]), {"/a": "0.1"})
+        self.assert_equal(self.vcs.lookups, [["/a"], ["/a"]])
+
+
+class SubversionTestCase(unittest.TestCase):
+
+    """Tests for the offline subversion lookups against a local repo"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    @staticmethod
+    def run_svn(command):
+        """Runs an svn command and fails loudly"""
+        result = commands.getstatusoutput(command)
+        if result[0] > 0:
+            raise AssertionError("%s failed: %s" % (command, result[1]))
+        return result[1]
+
+    def commit_file(self, path, contents):
+        """Writes out path in the working copy and commits it"""
+        full_path = os.path.join(self.working_copy, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        exists = os.path.exists(full_path)
+        open(full_path, "w").write(contents)
+        if not exists:
+            self.run_svn("svn add -q --parents '%s'" % full_path)
+        self.run_svn("svn commit -q -m test '%s'" % self.working_copy)
+
+    def setUp(self):
+        """Creates a repository, checks it out and makes some commits
+
+        r1 adds apps/foo, r2 adds apps/bar, r3 changes apps/foo
+        """
+        self.temp_dir = mkdtemp()
+        repository = os.path.join(self.temp_dir, "repo")
+        self.working_copy = os.path.join(self.temp_dir, "wc")
+        self.run_svn("svnadmin create '%s'" % repository)
+        self.run_svn("svn checkout -q 'file://%s' '%s'" % (
+            repository,
+            self.working_copy
+        ))
+        self.commit_file("apps/foo/views.py", "foo")
+        self.commit_file("apps/bar/views.py", "bar")
+        self.commit_file("apps/foo/views.py", "foo foo")
+        self.run_svn("svn update -q '%s'" % self.working_copy)
+        self.svn = Subversion()
+        self.svn.clear_revisions()
+
+    def tearDown(self):
+        """Removes the repository and working copy"""
+        shutil.rmtree(self.temp_dir)
+
+    def test_directory_revisions(self):
+        """Test directories get the newest revision of anything inside them"""
+        apps = os.path.join(self.working_copy, "apps")
+        revisions = self.svn.get_revisions([
+            self.working_copy,
+            apps,
+            os.path.join(apps, "foo"),
+            os.path.join(apps, "bar"),
+        ])
+        self.assert_equal(revisions, {
+            self.working_copy: "0.3",
+            apps: "0.3",
+            os.path.join(apps, "foo"): "0.3",
+            os.path.join(apps, "bar"): "0.2",
+        })
+
+    def test_file_revision(self):
+        """Test a single file lookup"""
+        path = os.path.join(self.working_copy, "apps/bar/views.py")
+        self.assert_equal(self.svn.get_directory_revision(path), "0.2")
+
+    def test_offline(self):
+        """Test lookups still work once the repository has gone away"""
+        shutil.rmtree(os.path.join(self.temp_dir, "repo"))
+        path = os.path.join(self.working_copy, "apps/foo")
+        self.assert_equal(self.svn.get_directory_revision(path), "0.3")
+
+    def test_info_matches_wc_db(self):
+        """Test svn info and the working copy db agree"""
+        from_wc_db = self.svn.read_wc_db(self.working_copy)
+        if from_wc_db is not None:
+            self.assert_equal(
+                self.svn.read_info_xml(self.working_copy),
+                from_wc_db
+            )
+
+    def test_unversioned_path(self):
+        """Test paths outside version control are left out"""
+        path = os.path.join(self.working_copy, "apps/unversioned")
+        os.makedirs(path)
+        self.assert_equal(self.svn.get_revisions([path]), {})
+
+
+class GitRepositoryTestCase(unittest.TestCase):
+
+    """Tests the in-process git reader agrees with git itself"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    def run_git(self, command):
+        """Runs a git command in the repository and fails loudly"""
+        result = commands.getstatusoutput(
+            "cd '%s' && GIT_AUTHOR_NAME=suitcase "\
+            "GIT_AUTHOR_EMAIL=suitcase@example.com "\
+            "GIT_COMMITTER_NAME=suitcase "\
+            "GIT_COMMITTER_EMAIL=suitcase@example.com git %s" % (
+                self.repository,
+                command
+            )
+        )
+        if result[0] > 0:
+            raise AssertionError("git %s failed: %s" % (command, result[1]))
+        return result[1]
+
+    def commit_file(self, path, contents):
+        """Writes out path in the repository and commits it"""
+        full_path = os.path.join(self.repository, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        open(full_path, "w").write(contents)
+        self.run_git("add '%s'" % path)
+        self.run_git("commit -q -m '%s'" % path)
+
+    def setUp(self):
+        """Creates a repository with a merged branch in its history"""
+        self.repository = mkdtemp()
+        self.run_git("init -q")
+        self.commit_file("apps/foo/views.py", "foo\n" * 200)
+        self.commit_file("apps/bar/views.py", "bar\n" * 200)
+        self.run_git("checkout -q -b feature")
+        self.commit_file("apps/bar/views.py", "bar\n" * 201)
+        self.run_git("checkout -q -")
+        self.commit_file("apps/foo/views.py", "foo\n" * 201)
+        self.run_git("merge -q --no-ff -m merge feature")
+        self.paths = [
+            "",
+            "apps",
+            "apps/foo",
+            "apps/bar",
+            "apps/bar/views.py",
+        ]
+
+    def tearDown(self):
+        """Removes the repository"""
+        shutil.rmtree(self.repository)
+
+    def check_against_git_log(self):
+        """Checks the reader finds what git log -1 does for every path"""
+        changes = GitRepository(self.repository).find_last_changes(self.paths)
+        for path in self.paths:
+            self.assert_equal(
+                changes[path],
+                self.run_git("log -1 --format=%%H -- '%s'" % (path or "."))
+            )
+
+    def test_loose_objects(self):
+        """Test last changes read from loose objects"""
+        self.check_against_git_log()
+
+    def test_packed_objects(self):
+        """Test last changes read from a delta compressed pack"""
+        self.run_git("gc -q --aggressive")
+        self.check_against_git_log()
+
+    def test_read_object(self):
+        """Test a packed blob comes back byte for byte"""
+        self.run_git("gc -q")
+        sha = self.run_git("rev-parse HEAD:apps/bar/views.py")
+        self.assert_equal(
+            GitRepository(self.repository).read_object(sha),
+            ("blob", "bar\n" * 201)
+        )
+
+    def test_missing_path(self):
+        """Test paths that aren't in HEAD are left out"""
+        changes = GitRepository(self.repository).find_last_changes(["nope"])
+        self.assert_equal(changes, {})
+
+    def test_changed_paths(self):
+        """Test the files changed after a commit are found in one diff"""
+        since = self.run_git("rev-parse HEAD")
+        self.commit_file("apps/baz/views.py", "baz")
+        self.assert_equal(
+            Git().get_changed_paths(self.repository, since),
+            [os.path.join(self.repository, "apps/baz/views.py")]
+        )
+
+    def test_reader_matches_git_log_walk(self):
+        """Test the backend gives the same answers with and without forks
+
+        Only paths changed on one side of the merge are compared as the
+        git log fallback doesn't list the files a merge commit brings in.
+
+        """
+        git = Git()
+        paths = [
+            os.path.join(self.repository, path)
+            for path in ["apps/foo", "apps/bar", "apps/bar/views.py"]
+        ]
+        try:
+            git.clear_revisions()
+            from_reader = git.find_revisions(paths)
+            git.use_reader = False
+            from_log = git.find_revisions(paths)
+        finally:
+            git.use_reader = True
+        self.assert_equal(from_reader, from_log)
+
+
+class BazaarTestCase(unittest.TestCase):
+
+    """Tests bzrlib and bzr log give the same revisions"""
+
+    def assert_equal(self, result, expected):
+        """Wraps assertEqual for convenience"""
+        return self.assertEqual(
+            result,
+            expected,
+            "%s should be %s" % (result, expected,),
+        )
+
+    def run_bzr(self, command):
+        """Runs a bzr command in the branch and fails loudly"""
+        result = commands.getstatusoutput("cd '%s' && bzr %s" % (
+            self.branch,
+            command
+        ))
+        if result[0] > 0:
+            raise AssertionError("bzr %s failed: %s" % (command, result[1]))
+        return result[1]
+
+    def commit_file(self, branch, path, contents):
+        """Writes out path in branch and commits it"""
+        full_path = os.path.join(branch, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        open(full_path, "w").write(contents)
+        self.run_bzr("add -q '%s'" % full_path)
+        self.run_bzr("commit -q -m test '%s'" % branch)
+
+    def setUp(self):
+        """Creates a branch with a merge from a feature branch
+
+        r1 adds apps/foo, r2 adds apps/bar, r3 changes apps/foo and r4
+        merges a change to apps/bar
+        """
+        self.temp_dir = mkdtemp()
+        self.branch = os.path.join(self.temp_dir, "trunk")
+        feature = os.path.join(self.temp_dir, "feature")
+        self.run_bzr("init -q '%s'" % self.branch)
+        self.run_bzr("whoami --branch 'suitcase <suitcase@example.com>'")
+        self.commit_file(self.branch, "apps/foo/views.py", "foo")
+        self.commit_file(self.branch, "apps/bar/views.py", "bar")
+        self.run_bzr("branch -q . '%s'" % feature)
+        self.commit_file(self.branch, "apps/foo/views.py", "foo foo")
+        self.commit_file(feature, "apps/bar/views.py", "bar bar")
+        self.run_bzr("merge -q '%s'" % feature)
+        self.run_bzr("commit -q -m merge")
+        self.paths = [
+            os.path.join(self.branch, path)
+            for path in ["", "apps", "apps/foo", "apps/bar/views.py"]
+        ]
+        self.bzr = bazaar.Bazaar()
+        self.bzr.clear_revisions()
+
+    def tearDown(self):
+        """Removes the branches"""
+        shutil.rmtree(self.temp_dir)
+
+    def test_mainline_revnos(self):
+        """Test merged changes count against the revision merging them"""
+        self.assert_equal(self.bzr.get_revisions(self.paths), {
+            self.paths[0]: "0.4",
+            self.paths[1]: "0.4",
+            self.paths[2]: "0.3",
+            self.paths[3]: "0.4",
+        })
+
+    def test_bzrlib_matches_bzr_log(self):
+        """Test reading the tree in-process agrees with walking the log"""
+        try:
+            from_bzrlib = self.bzr.find_revisions(self.paths)
+            self.bzr.use_bzrlib = False
+            from_log = self.bzr.find_revisions(self.paths)
+        finally:
+            self.bzr.use_bzrlib = True
+        self.assert_equal(from_bzrlib, from_log)
+
+
+TEST_SUITE = unittest.TestLoader().loadTestsFromTestCase(VcsBaseTestCase)
+TEST_SUITE.addTests(
+    unittest.TestLoader().loadTestsFromTestCase(RevisionCacheTestCase)
+)
+if commands.getstatusoutput("git --version")[0] == 0:
+    TEST_SUITE.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(GitRepositoryTestCase)
+    )
+if bazaar.bzrlib is not None and \
+    commands.getstatusoutput("bzr --version")[0] == 0:
+    TEST_SUITE.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(BazaarTestCase)
+    )
+if commands.getstatusoutput("svnadmin --version")[0] == 0:
+    TEST_SUITE.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(SubversionTestCase)
+    )
+unittest.TextTestRunner(verbosity=2).run(TEST_SUITE)